@@ -10,6 +10,8 @@ from . import consens_se
 from . import clustmap_across
 from . import write_outputs
 from . import utils
+from . import aligner
+from . import clustdb
 
 # from . import refmap
 # from . import cluster_across
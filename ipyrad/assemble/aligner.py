@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+A persistent aligner worker used to align clusters in steps 3 and 6. 
+The worker is a small python process that is started once per engine
+and is sent fasta strings over its stdin, and returns alignments over
+its stdout, using length-prefixed frames. The worker runs muscle
+directly, without a shell, so sequences are never escaped through bash
+and whole alignments are read back as one buffer. A worker that hangs
+or dies is killed and restarted.
+
+This file is also the worker script itself (it is run by path, so it
+should only import from the standard library at the top level).
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import errno
+import atexit
+import select
+import signal
+import struct
+import subprocess as sps
+
+
+# request header is the payload length, response header adds a status
+REQUEST = struct.Struct("<Q")
+RESPONSE = struct.Struct("<BQ")
+
+# seconds to wait for one alignment before the worker is restarted
+ALIGN_TIMEOUT = 600
+
+# the aligner of this process (e.g., an ipyparallel engine), see get_aligner
+ALIGNER = []
+
+
+class AlignerTimeout(Exception):
+    "raised when an aligner worker does not respond in time"
+    pass
+
+
+class Aligner(object):
+    """
+    A persistent aligner worker process. align() sends a fasta string
+    and returns the aligned fasta string, restarting the worker if it 
+    does not respond within timeout seconds.
+    """
+    def __init__(self, binary, timeout=ALIGN_TIMEOUT):
+        self.binary = binary
+        self.timeout = timeout
+        self.proc = None
+        self.start()
+
+
+    def start(self):
+        "start the worker in its own session so it can be killed with muscle"
+        self.proc = sps.Popen(
+            [sys.executable, os.path.abspath(__file__), self.binary],
+            stdin=sps.PIPE,
+            stdout=sps.PIPE,
+            bufsize=0,
+            close_fds=True,
+            preexec_fn=os.setsid,
+        )
+
+
+    def restart(self):
+        "kill the worker and any running aligner, and start a new one"
+        self.close(kill=True)
+        self.start()
+
+
+    def send(self, fasta):
+        "write one framed fasta request to the worker"
+        payload = fasta.encode()
+        frame = memoryview(REQUEST.pack(len(payload)) + payload)
+        while frame:
+            frame = frame[self.proc.stdin.write(frame):]
+
+
+    def recv(self):
+        "read one framed response, raises AlignerTimeout if it takes too long"
+        deadline = time.time() + self.timeout
+        status, size = RESPONSE.unpack(
+            self.read_exact(RESPONSE.size, deadline))
+        payload = self.read_exact(size, deadline).decode()
+        if status:
+            raise_align_error(payload)
+        return payload
+
+
+    def read_exact(self, size, deadline):
+        "read size bytes from the worker stdout before the deadline"
+        fd = self.proc.stdout.fileno()
+        chunks = []
+        while size:
+            wait = deadline - time.time()
+            if wait <= 0 or not select.select([fd], [], [], wait)[0]:
+                raise AlignerTimeout("aligner did not respond")
+            chunk = os.read(fd, min(size, int(2 ** 20)))
+            if not chunk:
+                raise IOError(errno.EPIPE, "aligner worker exited")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+    def align(self, fasta):
+        "align a fasta string, restarting the worker once if it fails"
+        try:
+            self.send(fasta)
+            return self.recv()
+        except (AlignerTimeout, IOError, OSError):
+            self.restart()
+        try:
+            self.send(fasta)
+            return self.recv()
+        except (AlignerTimeout, IOError, OSError) as inst:
+            self.restart()
+            raise_align_error(
+                "aligner failed twice on the same cluster: {}".format(inst))
+
+
+    def close(self, kill=False):
+        "stop the worker by closing its stdin, or kill it and its children"
+        if self.proc is None:
+            return
+        if kill:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+        self.proc.wait()
+        self.proc = None
+
+
+
+def get_aligner(binary):
+    """
+    Returns the aligner of this process, starting it on first use so that
+    the worker persists across the jobs an engine runs. Engines run one 
+    job per core, so each has a single worker.
+    """
+    if not ALIGNER:
+        ALIGNER.append(Aligner(binary))
+        atexit.register(ALIGNER[0].close)
+    return ALIGNER[0]
+
+
+
+def raise_align_error(message):
+    "raise an IPyradError (imported here since the worker script can't)"
+    from ipyrad.assemble.utils import IPyradError
+    raise IPyradError("error in aligner: {}".format(message))
+
+
+
+def serve(binary):
+    """
+    Worker loop: read framed fasta requests from stdin, align each with
+    muscle and write framed responses to stdout until stdin is closed.
+    """
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    while 1:
+        header = stdin.read(REQUEST.size)
+        if len(header) < REQUEST.size:
+            break
+        fasta = stdin.read(REQUEST.unpack(header)[0])
+        proc = sps.Popen(
+            [binary, "-quiet", "-in", "-"],
+            stdin=sps.PIPE,
+            stdout=sps.PIPE,
+            stderr=sps.PIPE,
+            close_fds=True,
+        )
+        out, err = proc.communicate(fasta + b"\n")
+        status = 1 if proc.returncode else 0
+        payload = err if status else out
+        stdout.write(RESPONSE.pack(status, len(payload)) + payload)
+        stdout.flush()
+
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
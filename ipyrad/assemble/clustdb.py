@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+"""
+Indexed binary store of the clusters of a sample (clustS). It is written
+next to the clustS.gz text file as {sample}.clustS.hdf5 and holds the
+aligned seqs and names of all reads as uint8 arrays, the depth, strand, 
+and declone tag of each read, and an offset index of clusters, so that 
+a step can seek to cluster i or pull the depths of all clusters without
+parsing text. The text file remains the primary output, and steps that
+read all clusters once, in order, read the text. The store is built from
+it by get_clustdb() for random access, and can be converted back to text
+with ClustDB.to_text().
+"""
+
+from __future__ import print_function
+
+import os
+import gzip
+
+import h5py
+import numpy as np
+from .utils import IPyradError
+
+
+# bump when the datasets of the store change, so older stores are rebuilt
+CLUSTDB_VERSION = 2
+
+# strand (last char of a read name) as ints in the 'strands' dataset
+STRANDS = {"*": 0, "+": 1, "-": 2}
+
+# per-read and per-cluster datasets, and their dtypes
+READ_DSETS = {
+    "seqs": np.uint8,
+    "seqoffs": np.int64,
+    "names": np.uint8,
+    "nameoffs": np.int64,
+    "depths": np.int32,
+    "strands": np.uint8,
+    "tags": np.uint8,
+    "tagoffs": np.int64,
+}
+CLUST_DSETS = {
+    "clustoffs": np.int64,
+    "clustdepths": np.int64,
+    "clustlens": np.int32,
+}
+
+
+# per-cluster rows of the small index written next to clustS.gz in step 3
+CLUSTIDX_DTYPE = np.dtype([
+    ("depth", np.int64),
+    ("length", np.int32),
+    ("offset", np.int64),
+])
+
+
+def get_clustdb_path(clustfile):
+    "Returns the path of the binary store of a clustS.gz file"
+    if clustfile.endswith(".gz"):
+        clustfile = clustfile[:-3]
+    return clustfile + ".hdf5"
+
+
+def get_clustdb(clustfile):
+    """
+    Returns an open ClustDB of a clustS.gz file, first converting the
+    text file if it has no store yet or if the store is out of date.
+    """
+    db5 = get_clustdb_path(clustfile)
+    if not is_current(clustfile, db5):
+        convert(clustfile, db5)
+    return ClustDB(db5)
+
+
+def is_current(clustfile, db5):
+    "True if the store exists and was built from the clustfile as it is now"
+    if not os.path.exists(db5):
+        return False
+    fstat = os.stat(clustfile)
+    try:
+        with h5py.File(db5, 'r') as io5:
+            return (
+                io5.attrs.get("version") == CLUSTDB_VERSION and
+                io5.attrs["source_size"] == fstat.st_size and
+                io5.attrs["source_mtime"] == fstat.st_mtime)
+    except (IOError, OSError, KeyError):
+        return False
+
+
+def convert(clustfile, db5):
+    "Writes the clusters of a clustS.gz text file to a binary store"
+    tmp5 = db5 + ".tmp"
+    writer = ClustDBWriter(tmp5)
+    try:
+        for names, seqs in iter_clusts_text(clustfile):
+            writer.add(names, seqs)
+    except (ValueError, IndexError):
+        writer.io5.close()
+        os.remove(tmp5)
+        raise IPyradError(
+            "clustfile formatting error in {}".format(clustfile))
+    fstat = os.stat(clustfile)
+    writer.close(source_size=fstat.st_size, source_mtime=fstat.st_mtime)
+    os.rename(tmp5, db5)
+
+
+def iter_clusts_text(clustfile):
+    "Yields (names, seqs) of each cluster in a clustS.gz text file"
+    with gzip.open(clustfile, 'rt') as infile:
+        names = []
+        seqs = []
+        for line in infile:
+            line = line.strip()
+            if line == "//":
+                if names:
+                    yield names, seqs
+                names = []
+                seqs = []
+            elif line:
+                if len(names) == len(seqs):
+                    names.append(line)
+                else:
+                    seqs.append(line)
+        if names:
+            yield names, seqs
+
+
+def get_clustidx_path(clustfile):
+    "Returns the path of the depth/length index of a clustS.gz file"
+    if clustfile.endswith(".gz"):
+        clustfile = clustfile[:-3]
+    return clustfile + ".idx.npy"
+
+
+def load_clustidx(clustfile):
+    """
+    Returns the (depth, length, offset) index of the clusters of a 
+    clustS.gz file, or None if it was not written or is older than the 
+    clusters file.
+    """
+    idxfile = get_clustidx_path(clustfile)
+    if not os.path.exists(idxfile):
+        return None
+    if os.path.getmtime(idxfile) < os.path.getmtime(clustfile):
+        return None
+    return np.load(idxfile)
+
+
+
+class ClustIndex(object):
+    """
+    Collects the depth, aligned length, and offset (in the uncompressed 
+    text) of each cluster as blocks of clusters are written to a clustS
+    file, and saves them as a small numpy index next to it, so that
+    stats (e.g., get_quick_depths) never need to re-read the clusters.
+    """
+    def __init__(self):
+        self.rows = []
+        self.offset = 0
+
+
+    def add(self, text):
+        "index a block of '//\\n//\\n'-terminated clusters written to file"
+        pos = 0
+        for clust in text.split("//\n//\n"):
+            lines = clust.strip().split("\n")
+            if lines[0]:
+                self.rows.append((
+                    sum(get_name_depth(i) for i in lines[0::2]),
+                    len(lines[-1]),
+                    self.offset + pos,
+                ))
+            pos += len(clust) + 6
+        self.offset += len(text)
+
+
+    def save(self, clustfile):
+        "write the index for a clusters file after it is closed"
+        arr = np.array(self.rows, dtype=CLUSTIDX_DTYPE)
+        with open(get_clustidx_path(clustfile), 'wb') as out:
+            np.save(out, arr)
+
+
+
+def get_name_depth(name):
+    "Returns the derep depth stored in a read name (e.g., 'x;size=3;+')"
+    return int(name.split("=")[-1][:-2])
+
+
+def get_name_tag(name):
+    """
+    Returns the i5 tag stored in a read name by declone_PCR_duplicates 
+    (e.g., 'x;tag=TATCGGTC;size=3;+'), or an empty string.
+    """
+    for field in name.split(";"):
+        if field.startswith("tag="):
+            return field[4:]
+    return ""
+
+
+
+class ClustDBWriter(object):
+    """
+    Appends clusters to a new binary store, buffering chunksize clusters
+    in memory between writes to the resizable datasets.
+    """
+    def __init__(self, db5, chunksize=5000):
+        self.io5 = h5py.File(db5, 'w')
+        self.chunksize = chunksize
+        for key, dtype in list(READ_DSETS.items()) + list(CLUST_DSETS.items()):
+            self.io5.create_dataset(
+                key, shape=(0,), maxshape=(None,), dtype=dtype,
+                chunks=(int(2 ** 16),), compression="lzf")
+
+        # offsets start at 0 and are stored cumulatively
+        self.nbases = 0
+        self.nchars = 0
+        self.ntagchars = 0
+        self.nreads = 0
+        for key in ("seqoffs", "nameoffs", "tagoffs", "clustoffs"):
+            self.append(key, [0])
+        self.clear()
+
+
+    def clear(self):
+        "empty the buffers"
+        self.buffers = {key: [] for key in READ_DSETS}
+        self.buffers.update({key: [] for key in CLUST_DSETS})
+        self.nbuffered = 0
+
+
+    def add(self, names, seqs):
+        "add one cluster of read names and aligned seqs"
+        buf = self.buffers
+        for name, seq in zip(names, seqs):
+            buf["seqs"].append(seq)
+            buf["names"].append(name)
+            self.nbases += len(seq)
+            self.nchars += len(name)
+            buf["seqoffs"].append(self.nbases)
+            buf["nameoffs"].append(self.nchars)
+            buf["depths"].append(get_name_depth(name))
+            buf["strands"].append(STRANDS.get(name[-1], 0))
+            tag = get_name_tag(name)
+            buf["tags"].append(tag)
+            self.ntagchars += len(tag)
+            buf["tagoffs"].append(self.ntagchars)
+        self.nreads += len(names)
+        buf["clustoffs"].append(self.nreads)
+        buf["clustdepths"].append(sum(buf["depths"][-len(names):]))
+        buf["clustlens"].append(len(seqs[-1]))
+        self.nbuffered += 1
+        if self.nbuffered >= self.chunksize:
+            self.flush()
+
+
+    def flush(self):
+        "write the buffered clusters to the datasets"
+        for key in ("seqs", "names", "tags"):
+            self.append(key, np.frombuffer(
+                "".join(self.buffers.pop(key)).encode(), dtype=np.uint8))
+        for key, values in self.buffers.items():
+            self.append(key, values)
+        self.clear()
+
+
+    def append(self, key, values):
+        "extend a dataset with an array of values"
+        values = np.asarray(values, dtype=self.io5[key].dtype)
+        dset = self.io5[key]
+        size = dset.shape[0]
+        dset.resize((size + values.size,))
+        dset[size:] = values
+
+
+    def close(self, **attrs):
+        "flush, store attrs, and close the file"
+        self.flush()
+        self.io5.attrs["nclusters"] = self.io5["clustoffs"].shape[0] - 1
+        self.io5.attrs["version"] = CLUSTDB_VERSION
+        for key, value in attrs.items():
+            self.io5.attrs[key] = value
+        self.io5.close()
+
+
+
+class ClustDB(object):
+    """
+    Read access to a binary cluster store. Indexing returns the (names,
+    seqs, depths) of cluster i, iter_clusters() streams them in blocks,
+    iter_tags() streams the declone tags of their reads, and the 
+    clustdepths and clustlens attributes are the total depth and aligned
+    length of every cluster.
+    """
+    def __init__(self, db5):
+        self.db5 = db5
+        self.io5 = h5py.File(db5, 'r')
+        self.clustoffs = self.io5["clustoffs"][:]
+        self.seqoffs = self.io5["seqoffs"][:]
+        self.nameoffs = self.io5["nameoffs"][:]
+        self.tagoffs = self.io5["tagoffs"][:]
+        self.clustdepths = self.io5["clustdepths"][:]
+        self.clustlens = self.io5["clustlens"][:]
+
+
+    def __len__(self):
+        return self.clustoffs.size - 1
+
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("cluster index out of range")
+        return next(self.iter_clusters(idx, idx + 1))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def iter_clusters(self, start=0, end=None, blocksize=5000):
+        "Yields (names, seqs, depths) of clusters start to end"
+        end = (len(self) if end is None else min(end, len(self)))
+        for bstart in range(start, end, blocksize):
+            bend = min(end, bstart + blocksize)
+            rstart, rend = self.clustoffs[bstart], self.clustoffs[bend]
+            seqs = self.read_strings("seqs", self.seqoffs, rstart, rend)
+            names = self.read_strings("names", self.nameoffs, rstart, rend)
+            depths = self.io5["depths"][rstart:rend].tolist()
+            for cidx in range(bstart, bend):
+                lo = self.clustoffs[cidx] - rstart
+                hi = self.clustoffs[cidx + 1] - rstart
+                yield names[lo:hi], seqs[lo:hi], depths[lo:hi]
+
+
+    def iter_tags(self, start=0, end=None, blocksize=5000):
+        "Yields the tags of the reads of clusters start to end"
+        end = (len(self) if end is None else min(end, len(self)))
+        for bstart in range(start, end, blocksize):
+            bend = min(end, bstart + blocksize)
+            rstart, rend = self.clustoffs[bstart], self.clustoffs[bend]
+            tags = self.read_strings("tags", self.tagoffs, rstart, rend)
+            for cidx in range(bstart, bend):
+                lo = self.clustoffs[cidx] - rstart
+                hi = self.clustoffs[cidx + 1] - rstart
+                yield tags[lo:hi]
+
+
+    def read_strings(self, key, offsets, rstart, rend):
+        "Returns a list of the strings of reads rstart to rend"
+        offs = offsets[rstart:rend + 1]
+        text = self.io5[key][offs[0]:offs[-1]].tobytes().decode()
+        offs = (offs - offs[0]).tolist()
+        return [text[i:j] for i, j in zip(offs[:-1], offs[1:])]
+
+
+    def to_text(self, clustfile):
+        "Writes the clusters back to a clustS.gz text file"
+        with gzip.open(clustfile, 'wt') as out:
+            for names, seqs, _ in self.iter_clusters():
+                out.write("\n".join(
+                    "{}\n{}".format(i, j) for i, j in zip(names, seqs)))
+                out.write("\n//\n//\n")
+
+
+    def close(self):
+        "close the hdf5 file"
+        self.io5.close()
@@ -15,15 +15,64 @@ except ImportError:
 import os
 import gzip
 import glob
+import mmap
 import time
+import json
+import heapq
 import shutil
+import struct
+import hashlib
+import tempfile
 import warnings
 import subprocess as sps
 
 import numpy as np
 import pysam
+from numba import njit
 import ipyrad as ip
-from .utils import IPyradError, bcomp, comp
+from .utils import IPyradError, comp
+from .utils import open_fastq, fifo_concat, iter_fastq_blocks
+from .utils import sort_userout, iter_sorted_userout
+from .utils import FileHashes, hash_file
+from . import aligner
+from . import clustdb
+
+
+# band (diagonals) and max fraction of differing columns of a hit to its
+# seed for a cluster to be aligned natively instead of with muscle.
+NATIVE_BAND = 10
+NATIVE_MAXDIFF = 0.05
+
+# read pairs per block when joining R1 and R2 with a nnnn spacer
+JOIN_BLOCKSIZE = 20000
+
+# translation table to complement seqs in the same way as bcomp()
+_BCOMP = bytearray(range(256))
+for _base in range(97, 123):
+    if _base != 110:
+        _BCOMP[_base] = _base - 32
+for _base, _comp in zip(b"ATCG", b"TAGC"):
+    _BCOMP[bytearray([_base])[0]] = bytearray([_comp])[0]
+BCOMP_TABLE = bytes(_BCOMP)
+
+# params and hackersonly params whose values change the step 3 clusters of
+# a sample, hashed with its edit files into the key of its cached results.
+CACHE_PARAMS = [
+    "assembly_method",
+    "datatype",
+    "clust_threshold",
+    "filter_min_trim_len",
+    "max_low_qual_bases",
+    "reference_sequence",
+    "reference_as_filter",
+]
+CACHE_HACKERS = [
+    "bwa_args",
+    "declone_PCR_duplicates",
+    "max_inner_mate_distance",
+    "query_cov",
+    "native_align_max_seqs",
+]
 
 
 class Step3:
@@ -37,6 +86,12 @@ class Step3:
         self.maxindels = 8
         self.force = force
         self.ipyclient = ipyclient
+        self.nchunks = {}
+        self.cached = []
+        self.cache_keys = {}
+        # user-set values, before max_inner_mate_distance is estimated
+        self.cache_hackers = [
+            (i, getattr(self.data.hackersonly, i)) for i in CACHE_HACKERS]
         self.gbs = bool("gbs" in self.data.params.datatype)
         self.print_headers()
         self.samples = self.get_subsamples()
@@ -49,20 +104,28 @@ class Step3:
     def run(self):
         "Run the assembly functions for this step"
 
+        # link clusters of samples already built with the same inputs
+        self.remote_run_cache_lookup()
+        if self.samples:
+            self.run_samples()
+
+        # stats of cached samples are re-computed from their cluster index
+        self.samples += self.cached
+        self.remote_run_sample_cleanup()
+        self.store_to_cache()
+        self.cleanup()
+
+
+    def run_samples(self):
+        "Run the clustering/mapping functions on samples not in the cache"
+
         # index reference fa files if there are any (bwa and sam index)
         if (self.data.params.reference_sequence or \
            self.data.params.reference_as_filter):
             self.remote_index_refs()
 
-        # i: sample.files.edits is [(r1,r2),(r1,r2),(...)] for multiple fastq
-        # o: tmpdir/[r1,r2]_concatedit.fastq
-        if any(len(sample.files.edits) > 1 for sample in self.samples):
-            self.remote_run(
-                function=concat_multiple_edits,
-                printstr=("concatenating       ", "s3"),
-                args=(),
-                threaded=True,  # needed?
-            )
+        # sample.files.edits is [(r1,r2),(r1,r2),(...)] for multiple fastq,
+        # which are streamed as one input by the functions below.
 
         # paired-end data methods ------------------------------
         if "pair" in self.data.params.datatype:
@@ -70,22 +133,15 @@ class Step3:
             # DENOVO (paired, denovo, optional refminus)
             if self.data.params.assembly_method == "denovo":
 
-                # vsearch merge read pairs back together based on overlap.
-                # i: tmpdir/concatedits.fq.gz or sample.files.edits
-                # o: tmpdir/{}_merged.fastq, tmpdir/{}_nonmerged_R[1,2].fastq
+                # vsearch merge read pairs back together based on overlap,
+                # and append non-merged reads joined with a spacer (nnnn).
+                # i: sample.files.edits
+                # o: tmpdir/{}_merged.fastq
                 self.remote_run(
                     function=merge_pairs_with_vsearch,
                     printstr=("join merged pairs   ", "s3"),
                     args=(True,),
                 )
-                # join non-merged reads with a spacer (nnnn)
-                # i: tmpdir/{}_nonmerged_R[1,2].fastq
-                # o: tmpdir/{}_merged.fastq (appended to)
-                self.remote_run(
-                    function=merge_end_to_end,
-                    printstr=("join unmerged pairs ", "s3"),
-                    args=(True, True,),
-                )
 
                 # [optional] tag for declone by moving i5 tag to sequence 5'
                 # i: tmpdir/{}_merged.fastq
@@ -231,11 +287,7 @@ class Step3:
 
                 # i: refmapping/{}.bam
                 # o: clustdir/{}.clustS.gz
-                self.remote_run(
-                    function=build_clusters_from_cigars,
-                    printstr=("building clusters   ", "s3"),
-                    args=(),
-                )
+                self.remote_run_ref_cluster_build()
 
             # DENOVO MINUS
             elif self.data.params.assembly_method == "denovo-reference":
@@ -268,8 +320,7 @@ class Step3:
                 #         threaded=True,
                 #     )
 
-                # i: edits/{}_trimmed_R1.fastq    # trimmed 
-                # i: tmpdir/r1_concatedit.fastq   # concat trimmed 
+                # i: sample.files.edits           # trimmed 
                 # i: tmpdir/{}-tmp-umap1.fastq    # " + refminus
                 # o: tmpdir/{}_derep.fa
                 self.remote_run(
@@ -297,19 +348,12 @@ class Step3:
                     args=(self.nthreads,),
                     threaded=True,
                 )
-                self.remote_run(
-                    function=build_clusters_from_cigars,
-                    printstr=("building clusters   ", "s3"),
-                    args=(),
-                )
+                self.remote_run_ref_cluster_build()
 
             else:
                 raise NotImplementedError(
                     "datatype + assembly_method combo not currently supported.")
 
-        self.remote_run_sample_cleanup()
-        self.cleanup()
-
 
     def print_headers(self):
         # print headers
@@ -496,6 +540,71 @@ class Step3:
                 job.get()
 
 
+    def remote_run_cache_lookup(self):
+        """
+        Hashes the edit files of each sample (on engines, unless their 
+        hash is cached from an earlier run) and its step 3 params into a 
+        key, and hardlinks the clusters of samples whose key is in the 
+        cache (e.g., built by another branch) instead of building them 
+        again. Cached samples are moved from self.samples to self.cached.
+        """
+        start = time.time()
+        printstr = ("checking s3 cache   ", "s3")
+        hashes = FileHashes(self.data)
+        rasyncs = {}
+        for sample in self.samples:
+            for fname in chain(*sample.files.edits):
+                if fname and fname not in rasyncs:
+                    if hashes.get(fname) is None:
+                        rasyncs[fname] = self.lbview.apply(hash_file, fname)
+
+        # track job
+        while 1:
+            ready = [rasyncs[i].ready() for i in rasyncs]
+            self.data._progressbar(len(ready), sum(ready), start, printstr)
+            time.sleep(0.1)
+            if len(ready) == sum(ready):
+                break
+        self.data._print("")
+        for fname in rasyncs:
+            hashes.put(fname, rasyncs[fname].get())
+        hashes.save()
+
+        for sample in self.samples:
+            self.cache_keys[sample.name] = get_cache_key(
+                self.data, sample, self.cache_hackers, hashes)
+
+        for sample in list(self.samples):
+            key = self.cache_keys[sample.name]
+            if link_from_cache(self.data, sample, key):
+                self.cached.append(sample)
+                self.samples.remove(sample)
+
+            # old outputs may be hardlinks to the cache, so they are 
+            # removed rather than overwritten in place.
+            else:
+                for path in (
+                    sample.files.clusters, 
+                    clustdb.get_clustidx_path(sample.files.clusters)):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        if self.cached:
+            self.data._print(
+                "using cached clusters for samples:\n{}"
+                .format([i.name for i in self.cached]))
+
+
+    def store_to_cache(self):
+        "hardlink the new clusters and stats of each sample into the cache"
+        for sample in self.samples:
+            if sample in self.cached:
+                continue
+            if sample.stats.state == 3:
+                store_in_cache(
+                    self.data, sample, self.cache_keys[sample.name])
+
+
     def remote_run_cluster_build(self):
         # submit clustering/mapping job
         start = time.time()
@@ -515,13 +624,14 @@ class Step3:
                     *(self.data, sample, self.maxindels)
                 )
 
-        # submit cluster chunking job
+        # submit cluster chunking job, to as many chunks as engines in all
         hasyncs = {}
+        nchunks = self.get_sample_nchunks()
         for sample in self.samples:
             with self.lbview.temp_flags(after=basyncs[sample.name]):
                 hasyncs[sample.name] = self.lbview.apply(
                     muscle_chunker,
-                    *(self.data, sample)
+                    *(self.data, sample, nchunks[sample.name])
                 )
 
         # track job progress
@@ -565,16 +675,33 @@ class Step3:
         for job in hasyncs:
             if not hasyncs[job].successful():
                 hasyncs[job].get()
+            self.nchunks[job] = hasyncs[job].get()
+
+
+    def get_sample_nchunks(self):
+        """
+        Returns the number of alignment chunks of each sample, so that the 
+        chunks of all samples are about as many as engines, each sample 
+        getting its share of engines by its reads (at least 1).
+        """
+        nengines = len(self.ipyclient.ids)
+        nreads = {i.name: i.stats.reads_passed_filter for i in self.samples}
+        total = float(sum(nreads.values()))
+        return {
+            sname: max(1, int(np.ceil(nengines * nreads[sname] / total)))
+            if total else 1
+            for sname in nreads
+        }
 
 
     def remote_run_align_cleanup(self):
 
-        # submit ten aligning jobs for each sample
+        # submit an aligning job for each chunk of each sample
         start = time.time()
         aasyncs = {}
         for sample in self.samples:
             aasyncs[sample.name] = []
-            for idx in range(10):
+            for idx in range(self.nchunks[sample.name]):
                 handle = os.path.join(
                     self.data.tmpdir,
                     "{}_chunk_{}.ali".format(sample.name, idx))
@@ -582,7 +709,8 @@ class Step3:
                 rasync = self.lbview.apply(
                     align_and_parse,
                     *(handle, self.maxindels, self.gbs, 
-                        self.data.hackersonly.declone_PCR_duplicates)
+                        self.data.hackersonly.declone_PCR_duplicates,
+                        self.data.hackersonly.native_align_max_seqs)
                 )
                 aasyncs[sample.name].append(rasync)
 
@@ -673,6 +801,66 @@ class Step3:
         self.data._print("")
 
 
+    def remote_run_ref_cluster_build(self):
+        """
+        Builds reference clusters in shards of regions with about equal
+        numbers of reads, built on separate engines from the same bam, and
+        concatenated in order into each sample's clustS.gz.
+        """
+        start = time.time()
+        printstr = ("building clusters   ", "s3")
+        nshards = self.get_sample_nchunks()
+
+        # get merged regions and split them into shards
+        sasyncs = {}
+        for sample in self.samples:
+            sasyncs[sample.name] = self.lbview.apply(
+                get_region_shards, *(self.data, sample, nshards[sample.name]))
+        while 1:
+            ready = [sasyncs[i].ready() for i in sasyncs]
+            self.data._progressbar(
+                3, sum(ready) / float(len(ready)), start, printstr)
+            time.sleep(0.1)
+            if all(ready):
+                break
+        shards = {i: sasyncs[i].get() for i in sasyncs}
+
+        # build clusters of each shard of each sample
+        basyncs = {}
+        for sample in self.samples:
+            basyncs[sample.name] = [
+                self.lbview.apply(
+                    build_region_shard, 
+                    *(self.data, sample, sidx, rstart, rend))
+                for sidx, (rstart, rend) in enumerate(shards[sample.name])
+            ]
+        allasyncs = list(chain(*basyncs.values()))
+        while 1:
+            ready = [i.ready() for i in allasyncs]
+            self.data._progressbar(
+                3, 1 + sum(ready) / float(len(ready)), start, printstr)
+            time.sleep(0.1)
+            if all(ready):
+                break
+
+        # concatenate shards of each sample in order
+        casyncs = {}
+        for sample in self.samples:
+            lengths = [i.get() for i in basyncs[sample.name]]
+            casyncs[sample.name] = self.lbview.apply(
+                concat_region_shards, *(self.data, sample, lengths))
+        while 1:
+            ready = [casyncs[i].ready() for i in casyncs]
+            self.data._progressbar(
+                3, 2 + sum(ready) / float(len(ready)), start, printstr)
+            time.sleep(0.1)
+            if all(ready):
+                break
+        self.data._print("")
+        for job in casyncs:
+            casyncs[job].get()
+
+
     def remote_run(self, printstr, function, args, threaded=False):
         # submit job
         start = time.time()
@@ -701,6 +889,108 @@ class Step3:
         self.ipyclient.purge_everything()
 
 
+def get_cache_dir(data):
+    "Returns the dir of step 3 results shared by branches in project_dir"
+    return os.path.join(
+        os.path.realpath(data.params.project_dir), "ipyrad_s3_cache")
+
+
+
+def get_cache_files(data, key):
+    "Returns the cached clusters, cluster index, and stats paths of a key"
+    prefix = os.path.join(get_cache_dir(data), key)
+    return (
+        prefix + ".clustS.gz", 
+        prefix + ".clustS.idx.npy", 
+        prefix + ".stats.json",
+    )
+
+
+
+def get_cache_key(data, sample, hackers, hashes):
+    """
+    Returns a hash of the contents of the edit files of a sample (from 
+    the FileHashes cache) and the params that change its step 3 clusters.
+    References are hashed by their path, size and mtime, since they can 
+    be large. hackers is (param, value) of CACHE_HACKERS as set before 
+    step 3 started, so a max_inner_mate_distance estimated from a sample
+    does not change its key.
+    """
+    hasher = hashlib.sha1()
+    hasher.update("{} {}\n".format(ip.__version__, sample.name).encode())
+    for param in CACHE_PARAMS:
+        hasher.update("{}={}\n".format(
+            param, getattr(data.params, param)).encode())
+    for param, value in hackers:
+        hasher.update("{}={}\n".format(param, value).encode())
+
+    for ref in (data.params.reference_sequence, 
+                data.params.reference_as_filter):
+        if ref and os.path.exists(ref):
+            fstat = os.stat(ref)
+            hasher.update("{} {}\n".format(
+                fstat.st_size, fstat.st_mtime).encode())
+
+    for fname in chain(*sample.files.edits):
+        if fname:
+            hasher.update("{}\n".format(hashes.get(fname)).encode())
+    return hasher.hexdigest()
+
+
+
+def link_file(src, dst):
+    "hardlink src to dst (replacing dst), or copy it across filesystems"
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+
+def link_from_cache(data, sample, key):
+    """
+    Links the cached clusters and index of key to the sample files and 
+    restores its step 3 stats. Returns False if key is not in the cache.
+    """
+    cclust, cidx, cstats = get_cache_files(data, key)
+    if not all(os.path.exists(i) for i in (cclust, cidx, cstats)):
+        return False
+    with open(cstats, 'r') as infile:
+        stats = json.load(infile)
+    link_file(cclust, sample.files.clusters)
+    link_file(cidx, clustdb.get_clustidx_path(sample.files.clusters))
+    sample.stats.reads_merged = stats["reads_merged"]
+    for key, val in stats["s3"].items():
+        sample.stats_dfs.s3[key] = val
+    return True
+
+
+
+def store_in_cache(data, sample, key):
+    "Hardlinks the clusters, index, and step 3 stats of a sample to the cache"
+    idxfile = clustdb.get_clustidx_path(sample.files.clusters)
+    if not (os.path.exists(sample.files.clusters) and os.path.exists(idxfile)):
+        return
+    cache = get_cache_dir(data)
+    if not os.path.exists(cache):
+        os.mkdir(cache)
+    cclust, cidx, cstats = get_cache_files(data, key)
+    link_file(sample.files.clusters, cclust)
+    link_file(idxfile, cidx)
+
+    # the stats file is written last, it marks the entry as complete
+    stats = {
+        "reads_merged": sample.stats.reads_merged,
+        "s3": sample.stats_dfs.s3.to_dict(),
+    }
+    with open(cstats + ".tmp", 'w') as out:
+        json.dump(stats, out, default=float)
+    os.rename(cstats + ".tmp", cstats)
+
+
+
 def dereplicate(data, sample, nthreads):
     """
     Dereplicates reads and sorts so reads that were highly replicated are at
@@ -711,14 +1001,8 @@ def dereplicate(data, sample, nthreads):
     dereplication that we need for 3rad (5/29/15 iao).
     """
     # find input file with following precedence:
-    # .trimmed.fastq.gz, .concatedit.fq.gz, ._merged.fastq, ._declone.fastq
+    # ._declone.fastq, ._merged.fastq, .trimmed.fastq.gz (edits files)
     infiles = [
-        os.path.join(
-            data.dirs.edits,
-            "{}.trimmed_R1_.fastq.gz".format(sample.name)),
-        os.path.join(
-            data.tmpdir,
-            "{}_R1_concatedit.fq.gz".format(sample.name)),
         os.path.join(
             data.tmpdir, 
             "{}_merged.fastq".format(sample.name)),
@@ -727,7 +1011,7 @@ def dereplicate(data, sample, nthreads):
             "{}_declone.fastq".format(sample.name)),
     ]
     infiles = [i for i in infiles if os.path.exists(i)]
-    infile = infiles[-1]
+    infiles = (infiles[-1:] or [i[0] for i in sample.files.edits])
 
     # datatypes options
     strand = "plus"
@@ -737,7 +1021,6 @@ def dereplicate(data, sample, nthreads):
     # do dereplication with vsearch
     cmd = [
         ip.bins.vsearch,
-        "--derep_fulllength", infile,
         "--strand", strand,
         "--output", os.path.join(data.tmpdir, sample.name + "_derep.fa"),
         # "--threads", str(nthreads),
@@ -751,67 +1034,43 @@ def dereplicate(data, sample, nthreads):
 
     # decompress argument (IF ZLIB is missing this will not work!!) 
     # zlib is part of the conda installation.
-    if infile.endswith(".gz"):
+    if infiles[0].endswith(".gz"):
         cmd.append("--gzip_decompress")
 
-    # build PIPEd job   
-    proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    errmsg = proc.communicate()[0]
+    # build PIPEd job. Multiple edits are streamed through a named pipe.
+    with fifo_concat(infiles, get_edits_fifo(data, sample, 1)) as infile:
+        cmd.insert(1, infile)
+        cmd.insert(1, "--derep_fulllength")
+        proc = sps.Popen(
+            cmd, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
+        errmsg = proc.communicate()[0]
     if proc.returncode:
         raise IPyradError(errmsg.decode())
 
 
-def concat_multiple_edits(data, sample):
-
-    # define output files
-    concat1 = os.path.join(
-        data.tmpdir,
-        "{}_R1_concatedit.fq.gz".format(sample.name))
-    concat2 = os.path.join(
+def get_edits_fifo(data, sample, read):
+    "path of the named pipe a sample's edits are streamed to (fifo_concat)"
+    return os.path.join(
         data.tmpdir,
-        "{}_R2_concatedit.fq.gz".format(sample.name))
-
-    # check for files to concat
-    if len(sample.files.edits) > 1:
-        # cat all inputs; index 0 b/c files are in tuples for r1, r2
-        cmd1 = ["cat"] + [i[0] for i in sample.files.edits]
-
-        # write to new concat handle
-        with open(concat1, 'w') as cout1:
-            proc1 = sps.Popen(
-                cmd1, stderr=sps.STDOUT, stdout=cout1, close_fds=True)
-            res1 = proc1.communicate()[0]
-            if proc1.returncode:
-                raise IPyradError("error in: %s, %s", cmd1, res1)
-
-        # Only set conc2 if R2 actually exists
-        if os.path.exists(str(sample.files.edits[0][1])):
-            cmd2 = ["cat"] + [i[1] for i in sample.files.edits]
-            with gzip.open(concat2, 'w') as cout2:
-                proc2 = sps.Popen(
-                    cmd2, stderr=sps.STDOUT, stdout=cout2, close_fds=True)
-                res2 = proc2.communicate()[0]
-                if proc2.returncode:
-                    raise IPyradError("error in: %s, %s", cmd2, res2)
+        "{}_R{}_concatedit.fq.gz".format(sample.name, read))
 
 
 def merge_pairs_with_vsearch(data, sample, revcomp):
-    "Merge PE reads using vsearch to find overlap."
+    """
+    Merge PE reads using vsearch to find overlap, and then append the
+    non-merged pairs joined with a 'nnnn' separator (R2 revcomped if 
+    revcomp) to the merged file in blocks.
+    """
 
-    # input files (select only the top one)
-    in1 = [
-        os.path.join(data.tmpdir, "{}-tmp-umap1.fastq".format(sample.name)),
-        os.path.join(data.tmpdir, "{}_R1_concatedit.fq.gz".format(sample.name)),
-        sample.files.edits[0][0],        
-    ]
-    in2 = [
-        os.path.join(data.tmpdir, "{}-tmp-umap2.fastq".format(sample.name)),
-        os.path.join(data.tmpdir, "{}_R2_concatedit.fq.gz".format(sample.name)),
-        sample.files.edits[0][1],
-    ]
-    index = min([i for i, j in enumerate(in1) if os.path.exists(j)])
-    infile1 = in1[index]
-    infile2 = in2[index]
+    # input files (unmapped reads if refminus, else the edits)
+    umap1 = os.path.join(data.tmpdir, "{}-tmp-umap1.fastq".format(sample.name))
+    umap2 = os.path.join(data.tmpdir, "{}-tmp-umap2.fastq".format(sample.name))
+    if os.path.exists(umap1):
+        in1 = [umap1]
+        in2 = [umap2]
+    else:
+        in1 = [i[0] for i in sample.files.edits]
+        in2 = [i[1] for i in sample.files.edits]
 
     # define output files
     mergedfile = os.path.join(
@@ -834,8 +1093,6 @@ def merge_pairs_with_vsearch(data, sample, revcomp):
     # vsearch merge can now take gzipped files (v.2.8)
     cmd = [
         ip.bins.vsearch,
-        "--fastq_mergepairs", infile1,
-        "--reverse", infile2,
         "--fastqout", mergedfile,
         "--fastqout_notmerged_fwd", nonmerged1,
         "--fastqout_notmerged_rev", nonmerged2,
@@ -849,11 +1106,68 @@ def merge_pairs_with_vsearch(data, sample, revcomp):
         "--threads", "2",
         "--fastq_allowmergestagger",
     ]
-    proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE)
-    res = proc.communicate()[0].decode()
+
+    # multiple edits are streamed through named pipes
+    with fifo_concat(in1, get_edits_fifo(data, sample, 1)) as infile1:
+        with fifo_concat(in2, get_edits_fifo(data, sample, 2)) as infile2:
+            cmd[1:1] = [
+                "--fastq_mergepairs", infile1,
+                "--reverse", infile2,
+            ]
+            proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE)
+            res = proc.communicate()[0].decode()
     if proc.returncode:
         raise IPyradError("Error merge pairs:\n {}\n{}".format(cmd, res))
 
+    # join non-merged pairs and append them to the merged file
+    with open(mergedfile, 'ab') as out:
+        with open(nonmerged1, 'rb') as fr1:
+            with open(nonmerged2, 'rb') as fr2:
+                for block1, block2 in iter_fastq_blocks(
+                        fr1, fr2, JOIN_BLOCKSIZE):
+                    out.write(join_fastq_blocks(block1, block2, revcomp))
+    for tmpfile in (nonmerged1, nonmerged2):
+        os.remove(tmpfile)
+
+
+def join_fastq_blocks(block1, block2, revcomp, identical=False):
+    """
+    Joins a block of R1 and R2 fastq records with a 'nnnn' separator, and 
+    returns the block of joined fastq records (or fasta if identical). R2
+    seqs of the whole block are complemented with a translation table and
+    reversed as one string if revcomp. See merge_end_to_end.
+    """
+    lines1 = block1.split(b"\n")
+    lines2 = block2.split(b"\n")
+    nreads = min(len(lines1), len(lines2)) // 4
+    heads = lines1[0:4 * nreads:4]
+    seqs1 = lines1[1:4 * nreads:4]
+    seqs2 = lines2[1:4 * nreads:4]
+
+    # [paired-denovo-refminus option] do not join truly merged reads
+    if identical:
+        joined = [None] * (2 * nreads)
+        joined[0::2] = [b">" + i[1:] for i in heads]
+        joined[1::2] = [
+            i if i == j else i + b"nnnn" + j for i, j in zip(seqs1, seqs2)
+        ]
+        return b"\n".join(joined) + b"\n"
+
+    quals2 = lines2[3:4 * nreads:4]
+    if revcomp:
+        # reversing the joined lines reverses each read and their order
+        seqs2 = b"\n".join(seqs2).translate(BCOMP_TABLE)[::-1]
+        seqs2 = seqs2.split(b"\n")[::-1]
+        quals2 = b"\n".join(quals2)[::-1].split(b"\n")[::-1]
+
+    joined = [None] * (4 * nreads)
+    joined[0::4] = heads
+    joined[1::4] = [i + b"nnnn" + j for i, j in zip(seqs1, seqs2)]
+    joined[2::4] = lines1[2:4 * nreads:4]
+    joined[3::4] = [
+        i + b"nnnn" + j for i, j in zip(lines1[3:4 * nreads:4], quals2)]
+    return b"\n".join(joined) + b"\n"
+
 
 def merge_end_to_end(data, sample, revcomp, append, identical=False):
     """ 
@@ -895,102 +1209,29 @@ def merge_end_to_end(data, sample, revcomp, append, identical=False):
     nonmerged2 = os.path.join(
         data.tmpdir, 
         "{}_nonmerged_R2_.fastq".format(sample.name))
-    concat1 = os.path.join(
-        data.tmpdir,
-        "{}_R1_concatedit.fq.gz".format(sample.name))
-    concat2 = os.path.join(
-        data.tmpdir, 
-        "{}_R2_concatedit.fq.gz".format(sample.name))
     # data.dirs.edits doesn't exist if you merge after step 2, so
     # here we access the edits files through the sample object.
     # Sorry it makes the code less harmonious. iao 12/31/19.
-    edits1 = sample.files.edits[0][0]
-    edits2 = sample.files.edits[0][1]
+    edits1 = [i[0] for i in sample.files.edits]
+    edits2 = [i[1] for i in sample.files.edits]
 
-    # file precedence
-    order1 = (edits1, concat1, nonmerged1, altmapped1)
-    order2 = (edits2, concat2, nonmerged2, altmapped2)
-    nonm1 = [i for i in order1 if os.path.exists(i)][-1]
-    nonm2 = [i for i in order2 if os.path.exists(i)][-1]
+    # file precedence, multiple edits files are read as one.
+    order1 = [i for i in (nonmerged1, altmapped1) if os.path.exists(i)]
+    order2 = [i for i in (nonmerged2, altmapped2) if os.path.exists(i)]
+    nonm1 = (order1[-1:] or edits1)
+    nonm2 = (order2[-1:] or edits2)
 
     # Combine the unmerged pairs and append to the merge file
     if append:
-        combout = open(mergedfile, 'a')
-    else:
-        combout = open(mergedfile, 'w')
-
-    # read in paired end read files 4 lines at a time
-    if nonm1.endswith(".gz"):
-        fr1 = gzip.open(nonm1, 'rb')
-    else:
-        fr1 = open(nonm1, 'rb')
-    quart1 = izip(*[iter(fr1)] * 4)
-
-    if nonm2.endswith(".gz"):
-        fr2 = gzip.open(nonm2, 'rb')
+        combout = open(mergedfile, 'ab')
     else:
-        fr2 = open(nonm2, 'rb')
-    quart2 = izip(*[iter(fr2)] * 4)
-    quarts = izip(quart1, quart2)
+        combout = open(mergedfile, 'wb')
 
-    # a list to store until writing
-    writing = []
-    counts = 0
-
-    # iterate until done
-    while 1:
-        try:
-            read1s, read2s = next(quarts)
-        except StopIteration:
-            break
-
-        # [paired-denovo-refminus option] do not join truly merged reads
-        if identical:
-            # keep already merged r1 and the read, or combine with nnnn
-            if read1s[1] == read2s[1]:
-                newread = [
-                    b">" + read1s[0][1:],
-                    read1s[1],
-                ]
-            else:
-                newread = [
-                    b">" + read1s[0][1:],
-                    read1s[1].strip() + b"nnnn" + read2s[1].strip() + b"\n",
-                ]
-            writing.append(b"".join(newread))
-
-        # the standard pipeline
-        else:
-            # revcomp for denovo data
-            if revcomp:
-                writing.append(b"".join([
-                    read1s[0],
-                    read1s[1].strip() + b"nnnn" + (
-                        bcomp(read2s[1].strip()[::-1]) + b"\n"),
-                    read1s[2],
-                    read1s[3].strip() + b"nnnn" + (
-                        read2s[3].strip()[::-1] + b"\n"),
-                    ]))
-
-            # no revcomp for reference mapped data
-            else:
-                writing.append(b"".join([
-                    read1s[0],
-                    read1s[1].strip() + b"nnnn" + (
-                        read2s[1]),
-                    read1s[2],
-                    read1s[3].strip() + b"nnnn" + (
-                        read2s[3]),
-                    ]))
-
-        # keep count
-        counts += 1
-        if not counts % 5000:
-            combout.write(b"".join(writing).decode())
-            writing = []
-
-    if writing:
-        combout.write(b"".join(writing).decode())
+    # read in paired end read files in blocks of read pairs
+    fr1 = open_fastq(nonm1)
+    fr2 = open_fastq(nonm2)
+    for block1, block2 in iter_fastq_blocks(fr1, fr2, JOIN_BLOCKSIZE):
+        combout.write(join_fastq_blocks(block1, block2, revcomp, identical))
 
     # close handles
     fr1.close()
@@ -1100,7 +1341,6 @@ def build_clusters(data, sample, maxindels):
 
     # i/o vsearch files
     uhandle = os.path.join(data.dirs.clusts, sample.name + ".utemp")
-    usort = os.path.join(data.dirs.clusts, sample.name + ".utemp.sort")
     hhandle = os.path.join(data.dirs.clusts, sample.name + ".htemp")
     clustsout = open(
         os.path.join(
@@ -1108,78 +1348,79 @@ def build_clusters(data, sample, maxindels):
             "{}.clust.txt".format(sample.name)), 
         'w')
 
-    # Sort the uhandle file so we can read through matches efficiently
-    cmd = ["sort", "-k", "2", uhandle, "-o", usort]
-    proc = sps.Popen(cmd, close_fds=True)
-    proc.communicate()[0]
+    # Group hits by seed (written to .utemp.sort) to read through matches
+    sort_userout(uhandle)
 
     # load ALL derep reads into a dictionary (this can be a few GB of RAM)
     # and is larger if names are larger. We are grabbing two lines at a time.
-    alldereps = {}
-    with open(derepfile, 'rt') as ioderep:
-        dereps = izip(*[iter(ioderep)] * 2)
-        for namestr, seq in dereps:
-            nnn, sss = [i.strip() for i in (namestr, seq)]  
-            alldereps[nnn[1:]] = sss
+    # In lowmem mode reads are instead read from the file when needed.
+    if data.hackersonly.build_clusters_lowmem:
+        alldereps = DerepIndex(derepfile)
+    else:
+        alldereps = {}
+        with open(derepfile, 'rt') as ioderep:
+            dereps = izip(*[iter(ioderep)] * 2)
+            for namestr, seq in dereps:
+                nnn, sss = [i.strip() for i in (namestr, seq)]  
+                alldereps[nnn[1:]] = sss
 
     # store observed seeds (this could count up to >million in bad data sets)
     seedsseen = set()
 
-    # Iterate through the usort file grabbing matches to build clusters
-    with open(usort, 'rt') as insort:
-        # iterator, seed null, seqlist null
-        isort = iter(insort)
-        lastseed = 0
-        fseqs = []
-        seqlist = []
-        seqsize = 0
-        while 1:
+    # Iterate through the grouped hits grabbing matches to build clusters
+    # iterator, seed null, seqlist null
+    isort = iter_sorted_userout(uhandle)
+    lastseed = 0
+    fseqs = []
+    seqlist = []
+    seqsize = 0
+    while 1:
 
-            # grab the next line and parse the informative columns
-            try:
-                hit, seed, _, ind, ori, _ = next(isort).strip().split()
-            except StopIteration:
-                break
+        # grab the next line and parse the informative columns
+        try:
+            hit, seed, _, ind, ori, _ = next(isort).strip().split()
+        except StopIteration:
+            break
 
-            # same seed, append match
-            if seed != lastseed:
-                seedsseen.add(seed)
-
-                # store the last cluster (fseq), count it, and clear fseq
-                if fseqs:
-                    # sort hits by size, which is at the end of the header
-                    fsort = sorted(
-                        fseqs[1:], 
-                        key=(lambda x: int(x.split(";size=")[-1].split("\n")[0][:-2])),
-                        reverse=True,
-                    )
-                    # seed first then sorted hits
-                    fseqs = [fseqs[0]] + fsort
-                    seqlist.append("\n".join(fseqs))
-                    seqsize += 1
-                    fseqs = []
-
-                # occasionally write/dump stored clusters to file and clear mem
-                if not seqsize % 10000:
-                    if seqlist:
-                        clustsout.write(
-                            "\n//\n//\n".join(seqlist) + "\n//\n//\n")
-                        # reset list and counter
-                        seqlist = []
-
-                # store the new seed on top of fseq list
-                fseqs.append(">{};*\n{}".format(seed, alldereps[seed]))
-                lastseed = seed
-
-            # add match to the seed
-            # revcomp if orientation is reversed (comp preserves nnnn)
-            if ori == "-":
-                seq = comp(alldereps[hit])[::-1]
-            else:
-                seq = alldereps[hit]
-            # only save if not too many indels
-            if int(ind) <= maxindels:
-                fseqs.append(">{};{}\n{}".format(hit, ori, seq))
+        # same seed, append match
+        if seed != lastseed:
+            seedsseen.add(seed)
+
+            # store the last cluster (fseq), count it, and clear fseq
+            if fseqs:
+                # sort hits by size, which is at the end of the header
+                fsort = sorted(
+                    fseqs[1:], 
+                    key=(lambda x: int(x.split(";size=")[-1].split("\n")[0][:-2])),
+                    reverse=True,
+                )
+                # seed first then sorted hits
+                fseqs = [fseqs[0]] + fsort
+                seqlist.append("\n".join(fseqs))
+                seqsize += 1
+                fseqs = []
+
+            # occasionally write/dump stored clusters to file and clear mem
+            if not seqsize % 10000:
+                if seqlist:
+                    clustsout.write(
+                        "\n//\n//\n".join(seqlist) + "\n//\n//\n")
+                    # reset list and counter
+                    seqlist = []
+
+            # store the new seed on top of fseq list
+            fseqs.append(">{};*\n{}".format(seed, alldereps[seed]))
+            lastseed = seed
+
+        # add match to the seed
+        # revcomp if orientation is reversed (comp preserves nnnn)
+        if ori == "-":
+            seq = comp(alldereps[hit])[::-1]
+        else:
+            seq = alldereps[hit]
+        # only save if not too many indels
+        if int(ind) <= maxindels:
+            fseqs.append(">{};{}\n{}".format(hit, ori, seq))
 
     # write whatever is left over to the clusts file
     if fseqs:
@@ -1216,58 +1457,149 @@ def build_clusters(data, sample, maxindels):
 
     # close the file handle
     clustsout.close()
+    if isinstance(alldereps, DerepIndex):
+        alldereps.close()
     del alldereps
 
 
-def muscle_chunker(data, sample):
+
+class DerepIndex(object):
     """
-    Splits the muscle alignment into chunks. Each chunk is run on a separate
-    computing core. Because the largest clusters are at the beginning of the 
-    clusters file, assigning equal clusters to each file would put all of the 
-    large cluster, that take longer to align, near the top. So instead we 
-    randomly distribute the clusters among the files. If assembly method is
-    reference then this step is just a placeholder and nothing happens. 
+    Read-only {name: seq} mapping of a derep fasta (one line per seq) that
+    does not hold the reads in memory. Stores a sorted array of 64-bit 
+    hashes of the read names and the byte offsets of their records (16 
+    bytes per read), and reads sequences from the memory-mapped file.
+    """
+    def __init__(self, derepfile):
+        self.ofile = open(derepfile, 'rb')
+        self.mmap = None
+        if os.path.getsize(derepfile):
+            self.mmap = mmap.mmap(
+                self.ofile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # hashes and offsets of headers, filled in a single pass
+        hashes = np.zeros(0, dtype=np.uint64)
+        offsets = np.zeros(0, dtype=np.int64)
+        if self.mmap is not None:
+            hashes, offsets = self.index_headers()
+        order = np.argsort(hashes, kind="mergesort")
+        self.hashes = hashes[order]
+        self.offsets = offsets[order]
+
+
+    def index_headers(self, chunksize=int(1e6)):
+        "returns the hashes and offsets of all headers in the file"
+        hchunks = []
+        ochunks = []
+        hashes = []
+        offsets = []
+        pos = 0
+        self.ofile.seek(0)
+        for line in self.ofile:
+            if line.startswith(b">"):
+                hashes.append(name_hash(line[1:].rstrip()))
+                offsets.append(pos)
+                if len(hashes) == chunksize:
+                    hchunks.append(np.array(hashes, dtype=np.uint64))
+                    ochunks.append(np.array(offsets, dtype=np.int64))
+                    hashes = []
+                    offsets = []
+            pos += len(line)
+        hchunks.append(np.array(hashes, dtype=np.uint64))
+        ochunks.append(np.array(offsets, dtype=np.int64))
+        return np.concatenate(hchunks), np.concatenate(ochunks)
+
+
+    def __getitem__(self, name):
+        bname = name.encode()
+        nhash = np.uint64(name_hash(bname))
+        idx = int(np.searchsorted(self.hashes, nhash))
+
+        # check the name at the offset in case of a hash collision
+        while (idx < self.hashes.size) and (self.hashes[idx] == nhash):
+            start = int(self.offsets[idx])
+            end = self.mmap.find(b"\n", start)
+            if self.mmap[start + 1:end].rstrip() == bname:
+                send = self.mmap.find(b"\n", end + 1)
+                if send < 0:
+                    send = len(self.mmap)
+                return self.mmap[end + 1:send].strip().decode()
+            idx += 1
+        raise KeyError(name)
+
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.ofile.close()
+
+
+
+def name_hash(name):
+    "64-bit hash of a read name (bytes)"
+    return struct.unpack("<Q", hashlib.md5(name).digest()[:8])[0]
+
+
+def muscle_chunker(data, sample, nchunks=10):
+    """
+    Splits the clusters into chunks. Each chunk is run on a separate 
+    computing core. The alignment cost of each cluster is estimated as its
+    number of seqs (up to the 200 that are aligned) times its seed length,
+    and clusters are bin-packed into chunks of about equal cost, largest
+    first (LPT), so that the deep clusters at the top of the clusters file
+    are spread across chunks. The clusters file is streamed twice rather
+    than read into memory. If assembly method is reference then this step
+    is just a placeholder and nothing happens. Returns the nchunks written.
     """
 
     # only chunk up denovo data, refdata has its own chunking method which 
     # makes equal size chunks, instead of uneven chunks like in denovo
-    if data.params.assembly_method != "reference":
-        # get the number of clusters
-        clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
-        with iter(open(clustfile, 'rt')) as clustio:
-            nloci = sum(1 for i in clustio if "//" in i) // 2
-            optim = (nloci // 20) + (nloci % 20)
-            #io
-            #optim = int(nloci/10)
-
-        # write optim clusters to each tmp file
-        clustio = open(clustfile, 'rt')
-        inclusts = iter(clustio.read().strip().split("//\n//\n"))
-
-        # splitting loci so first file is smaller and last file is bigger
-        inc = optim // 10
-        for idx in range(10):
-            # how big is this chunk?
-            this = optim + (idx * inc)
-            left = nloci - this
-            ## Distribute all loci equally among chunks
-            ## io
-            ##left = nloci - optim
-            ##this = optim
-            if idx == 9:
-                # grab everything left
-                grabchunk = list(islice(inclusts, int(1e9)))
-            else:
-                # grab next chunks-worth of data
-                grabchunk = list(islice(inclusts, this))
-                nloci = left
+    if data.params.assembly_method == "reference":
+        return 0
 
-            # write the chunk to file
-            tmpfile = os.path.join(
-                data.tmpdir, sample.name + "_chunk_{}.ali".format(idx))
-            with open(tmpfile, 'wb') as out:
-                out.write(str.encode("//\n//\n".join(grabchunk)))
-        clustio.close()
+    # get the estimated cost of each cluster
+    clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
+    costs = np.array(
+        [min(len(i) // 2, 200) * len(i[1]) for i in iter_clust_txt(clustfile)],
+        dtype=np.int64,
+    )
+
+    # assign clusters, most costly first, to the least loaded chunk
+    chunkidx = np.zeros(costs.size, dtype=np.int32)
+    loads = [(0, idx) for idx in range(nchunks)]
+    for cidx in np.argsort(-costs, kind="mergesort").tolist():
+        load, idx = heapq.heappop(loads)
+        chunkidx[cidx] = idx
+        heapq.heappush(loads, (load + int(costs[cidx]), idx))
+
+    # write clusters to their chunk files in file order
+    outs = [
+        open(os.path.join(
+            data.tmpdir, sample.name + "_chunk_{}.ali".format(idx)), 'wt')
+        for idx in range(nchunks)
+    ]
+    try:
+        for cidx, clust in enumerate(iter_clust_txt(clustfile)):
+            outs[chunkidx[cidx]].write("".join(clust) + "//\n//\n")
+    finally:
+        for out in outs:
+            out.close()
+    return nchunks
+
+
+def iter_clust_txt(clustfile):
+    "Yields the lines (name, seq, ...) of each cluster in a .clust.txt file"
+    with open(clustfile, 'rt') as clustio:
+        clust = []
+        for line in clustio:
+            if line.startswith("//"):
+                if clust:
+                    yield clust
+                clust = []
+            elif line.strip():
+                clust.append(line)
+        if clust:
+            yield clust
 
 
 def declone_clusters(aligned):
@@ -1348,7 +1680,8 @@ def declone_clusters(aligned):
     return decloned, nwdups, nwodups
 
 
-def align_and_parse(handle, max_internal_indels=5, is_gbs=False, declone=False):
+def align_and_parse(
+    handle, max_internal_indels=5, is_gbs=False, declone=False, native_max=0):
     """ much faster implementation for aligning chunks """
 
     # CHECK: data are already chunked, read in the whole thing. bail if no data
@@ -1373,7 +1706,7 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False, declone=False):
     nwodups = 0
 
     # iterate over clusters sending each to muscle, splits and aligns pairs
-    aligned = persistent_popen_align3(clusts, 200, is_gbs)
+    aligned = persistent_popen_align3(clusts, 200, is_gbs, native_max)
 
     # store good alignments to be written to file
     refined = []
@@ -1404,11 +1737,11 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False, declone=False):
 
 
 def reconcat(data, sample):
-    """ takes aligned chunks (usually 10) and concatenates them """
+    """ takes aligned chunks (one or more) and concatenates them """
 
     # get chunks
     chunks = glob.glob(
-        os.path.join(data.tmpdir, sample.name + "_chunk_[0-9].aligned"))       
+        os.path.join(data.tmpdir, sample.name + "_chunk_[0-9]*.aligned"))
 
     # sort by chunk number, cuts off last 8 =(aligned)
     chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-8]))
@@ -1417,7 +1750,8 @@ def reconcat(data, sample):
     sample.files.clusters = os.path.join(
         data.dirs.clusts, sample.name + ".clustS.gz")
 
-    # reconcats aligned clusters
+    # reconcats aligned clusters, indexing their depths and lengths
+    clustidx = clustdb.ClustIndex()
     with gzip.open(sample.files.clusters, 'wb') as out:
         for fname in chunks:
             with open(fname) as infile:
@@ -1427,78 +1761,54 @@ def reconcat(data, sample):
                     out.write(dat)
                 except TypeError:
                     out.write(dat.encode())
+                clustidx.add(dat)
             os.remove(fname)
+    clustidx.save(sample.files.clusters)
 
 
-def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
-    "keeps a persistent bash shell open and feeds it muscle alignments"
+def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False, native_max=0):
+    "aligns clusters natively if small, else with the engine's muscle worker"
 
-    # create a separate shell for running muscle in, this is much faster
-    # than spawning a separate subprocess for each muscle call
-    proc = sps.Popen(
-        ["bash"],
-        stdin=sps.PIPE,
-        stdout=sps.PIPE,
-        bufsize=0,
-    )
+    # build the muscle jobs of each cluster: none if only one seq, read1s 
+    # and read2s separately if there is a PE insert, else the whole cluster.
+    jobs = []
+    for clust in clusts:
+        if clust.count(">") == 1:
+            jobs.append([])
+            continue
+
+        # make into list (only read maxseqs lines, 2X cuz names)
+        lclust = clust.split()[:maxseqs * 2]
+
+        # do we need to split the alignment? (is there a PE insert?)
+        try:
+            # try to split cluster list at nnnn separator for each read
+            lclust1 = list(chain(*zip(
+                lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
+            lclust2 = list(chain(*zip(
+                lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
+            jobs.append(["\n".join(lclust1), "\n".join(lclust2)])
+
+        # Either reads are SE, or at least some pairs are merged.
+        except IndexError:
+            jobs.append(["\n".join(lclust)])
+
+    # align all jobs, small ones natively and the rest with muscle
+    results = iter(align_fastas(list(chain(*jobs)), native_max))
 
     # iterate over clusters in this file until finished
     aligned = []
-    for clust in clusts:
-
-        # new alignment string for read1s and read2s
-        align1 = []
-        align2 = []
+    for clust, job in zip(clusts, jobs):
 
         # don't bother aligning if only one seq
-        if clust.count(">") == 1:
+        if not job:
             aligned.append(clust.replace(">", "").strip())
-        else:
 
-            # do we need to split the alignment? (is there a PE insert?)
+        # join up aligned read1 and read2 and ensure names order match
+        elif len(job) == 2:
+            lines1 = next(results)[1:].split("\n>")
+            lines2 = next(results)[1:].split("\n>")
             try:
-                # make into list (only read maxseqs lines, 2X cuz names)
-                lclust = clust.split()[:maxseqs * 2]
-
-                # try to split cluster list at nnnn separator for each read
-                lclust1 = list(chain(*zip(
-                    lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
-                lclust2 = list(chain(*zip(
-                    lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
-
-                # put back into strings
-                clust1 = "\n".join(lclust1)
-                clust2 = "\n".join(lclust2)
-
-                # Align the first reads.
-                # The muscle command with alignment as stdin and // as split
-                cmd1 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                        .format(clust1, ip.bins.muscle, "//\n"))
-
-                # send cmd1 to the bash shell
-                proc.stdin.write(cmd1.encode())
-
-                # read the stdout by line until splitter is reached
-                # meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align1.append(line.decode())
-
-                # Align the second reads.
-                # The muscle command with alignment as stdin and // as split
-                cmd2 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                        .format(clust2, ip.bins.muscle, "//\n"))
-
-                # send cmd2 to the bash shell
-                proc.stdin.write(cmd2.encode())
-
-                # read the stdout by line until splitter is reached
-                # meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align2.append(line.decode())
-
-                # join up aligned read1 and read2 and ensure names order match
-                lines1 = "".join(align1)[1:].split("\n>")
-                lines2 = "".join(align2)[1:].split("\n>")
                 dalign1 = dict([i.split("\n", 1) for i in lines1])
                 dalign2 = dict([i.split("\n", 1) for i in lines2])
 
@@ -1526,53 +1836,28 @@ def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
                       .format(clust, lines1, lines2)
                       )
 
-            ## Either reads are SE, or at least some pairs are merged.
-            except IndexError:
-
-                # limit the number of input seqs
-                # use lclust already built before checking pairs
-                lclust = "\n".join(clust.split()[:maxseqs * 2])
-
-                # the muscle command with alignment as stdin and // as splitter
-                cmd = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                       .format(lclust, ip.bins.muscle, "//\n"))
-
-                ## send cmd to the bash shell (TODO: PIPE could overflow here!)
-                proc.stdin.write(cmd.encode())
-
-                ## read the stdout by line until // is reached. This BLOCKS.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align1.append(line.decode())
-
-                ## remove '>' from names, and '\n' from inside long seqs                
-                lines = "".join(align1)[1:].split("\n>")
-
-                ## find seed of the cluster and put it on top.
-                #seed = [i for i in lines if i.split(";")[-1][0] == "*"][0]
-                seed = [i for i in lines if i.split('\n')[0][-1] == "*"][0]
-                lines.pop(lines.index(seed))
-                lines = [seed] + sorted(
-                    lines, key=get_derep_num, reverse=True)
+        else:
+            ## remove '>' from names, and '\n' from inside long seqs                
+            lines = next(results)[1:].split("\n>")
 
-                ## format remove extra newlines from muscle
-                aa = [i.split("\n", 1) for i in lines]
-                align1 = [i[0] + '\n' + "".join([j.replace("\n", "")
-                          for j in i[1:]]) for i in aa]
+            ## find seed of the cluster and put it on top.
+            seed = [i for i in lines if i.split('\n')[0][-1] == "*"][0]
+            lines.pop(lines.index(seed))
+            lines = [seed] + sorted(
+                lines, key=get_derep_num, reverse=True)
 
-                # trim edges in sloppy gbs/ezrad data.
-                # Maybe relevant to other types too...
-                if is_gbs:
-                    align1 = gbs_trim(align1)
+            ## format remove extra newlines from muscle
+            aa = [i.split("\n", 1) for i in lines]
+            align1 = [i[0] + '\n' + "".join([j.replace("\n", "")
+                      for j in i[1:]]) for i in aa]
 
-                ## append to aligned
-                aligned.append("\n".join(align1))
+            # trim edges in sloppy gbs/ezrad data.
+            # Maybe relevant to other types too...
+            if is_gbs:
+                align1 = gbs_trim(align1)
 
-    # cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
+            ## append to aligned
+            aligned.append("\n".join(align1))
 
     ## return the aligned clusters
     return aligned
@@ -1654,6 +1939,182 @@ def gbs_trim(align1):
     return newalign1
 
 
+def align_fastas(fastas, native_max=0):
+    """
+    Aligns a list of fasta strings and returns muscle-style fasta strings.
+    Fastas with up to native_max seqs are aligned with the builtin banded
+    aligner, and only those that are too divergent for it, or larger, are
+    sent to muscle in the persistent aligner of the engine.
+    """
+    results = [
+        native_align(i) if i.count(">") <= native_max else None 
+        for i in fastas
+    ]
+    todo = [idx for idx, res in enumerate(results) if res is None]
+    if todo:
+        worker = aligner.get_aligner(ip.bins.muscle)
+        for idx in todo:
+            results[idx] = worker.align(fastas[idx])
+    return results
+
+
+def native_align(fasta, band=NATIVE_BAND, maxdiff=NATIVE_MAXDIFF):
+    """
+    Star alignment of a small cluster (fasta string) to its first seq (the
+    seed) by banded pairwise alignment, merging the gaps each hit opens in
+    the seed into a multiple alignment. Returns None if any hit touches the
+    band or differs from the seed at more than maxdiff of its overlapping
+    columns, in which case the cluster should be aligned with muscle. Seqs
+    are compared in uppercase but keep their case in the alignment, as 
+    with muscle.
+    """
+    lines = fasta.strip().split("\n")
+    names = lines[::2]
+    raws = lines[1::2]
+    seqs = [i.upper() for i in raws]
+    seed = seqs[0]
+    sarr = np.frombuffer(seed.encode(), dtype=np.uint8)
+
+    # gaps before each seed position needed by the widest hit insertion
+    nseed = len(seed)
+    ninserts = [0] * (nseed + 1)
+    rows = []
+    for seq, raw in zip(seqs[1:], raws[1:]):
+        harr = np.frombuffer(seq.encode(), dtype=np.uint8)
+        ops, diffs, ncols, edge = banded_align(sarr, harr, band)
+        if edge or diffs > maxdiff * max(ncols, 1):
+            return None
+
+        # hit base at each seed position, and hit bases inserted before it
+        cols = ["-"] * nseed
+        inserts = [""] * (nseed + 1)
+        sidx = hidx = 0
+        for oper in ops:
+            if oper == 0:
+                cols[sidx] = raw[hidx]
+                sidx += 1
+                hidx += 1
+            elif oper == 1:
+                sidx += 1
+            else:
+                inserts[sidx] += raw[hidx]
+                hidx += 1
+        for idx, insert in enumerate(inserts):
+            ninserts[idx] = max(ninserts[idx], len(insert))
+        rows.append((cols, inserts))
+
+    # build rows, overhangs at the start are right justified to the seed
+    rows.insert(0, (list(raws[0]), [""] * (nseed + 1)))
+    aligned = []
+    for name, (cols, inserts) in zip(names, rows):
+        row = [inserts[0].rjust(ninserts[0], "-")]
+        for idx in range(nseed):
+            row.append(cols[idx])
+            row.append(inserts[idx + 1].ljust(ninserts[idx + 1], "-"))
+        aligned.append("{}\n{}".format(name, "".join(row)))
+    return "\n".join(aligned) + "\n"
+
+
+@njit
+def banded_align(seed, hit, band):
+    """
+    Global alignment of hit to seed (uint8 arrays) with free end gaps 
+    in a band of diagonals around the main diagonal. Returns the ops (0=
+    aligned, 1=gap in hit, 2=base inserted in hit), the number of 
+    mismatches and internal gaps, the number of columns between the first
+    and last aligned base, and whether the path touched the band.
+    """
+    nseed = seed.shape[0]
+    nhit = hit.shape[0]
+    score = np.full((nseed + 1, nhit + 1), -(2 ** 40), dtype=np.int64)
+    trace = np.zeros((nseed + 1, nhit + 1), dtype=np.int8)
+
+    # fill the band, leading gaps are free
+    for sidx in range(nseed + 1):
+        for hidx in range(max(0, sidx - band), min(nhit, sidx + band) + 1):
+            if sidx == 0 or hidx == 0:
+                score[sidx, hidx] = 0
+                trace[sidx, hidx] = 1 if sidx else 2
+                continue
+            sbase = seed[sidx - 1]
+            hbase = hit[hidx - 1]
+            if sbase == 78 or hbase == 78:
+                diag = score[sidx - 1, hidx - 1]
+            elif sbase == hbase:
+                diag = score[sidx - 1, hidx - 1] + 5
+            else:
+                diag = score[sidx - 1, hidx - 1] - 4
+            upper = score[sidx - 1, hidx] - 8
+            left = score[sidx, hidx - 1] - 8
+            if diag >= upper and diag >= left:
+                score[sidx, hidx] = diag
+            elif upper >= left:
+                score[sidx, hidx] = upper
+                trace[sidx, hidx] = 1
+            else:
+                score[sidx, hidx] = left
+                trace[sidx, hidx] = 2
+
+    # trailing gaps are free: best end in the last row or column
+    bsidx = nseed
+    bhidx = min(nhit, nseed + band)
+    best = score[bsidx, bhidx]
+    for hidx in range(max(0, nseed - band), min(nhit, nseed + band) + 1):
+        if score[nseed, hidx] > best:
+            best = score[nseed, hidx]
+            bsidx = nseed
+            bhidx = hidx
+    for sidx in range(max(0, nhit - band), min(nseed, nhit + band) + 1):
+        if score[sidx, nhit] > best:
+            best = score[sidx, nhit]
+            bsidx = sidx
+            bhidx = nhit
+
+    # trace back from the end, writing ops in reverse
+    ops = np.zeros(nseed + nhit, dtype=np.int8)
+    nops = 0
+    for _ in range(nhit - bhidx):
+        ops[nops] = 2
+        nops += 1
+    for _ in range(nseed - bsidx):
+        ops[nops] = 1
+        nops += 1
+    sidx = bsidx
+    hidx = bhidx
+    edge = False
+    diffs = 0
+    while sidx > 0 or hidx > 0:
+        if sidx and hidx and abs(sidx - hidx) >= band:
+            edge = True
+        oper = trace[sidx, hidx]
+        if oper == 0:
+            sbase = seed[sidx - 1]
+            hbase = hit[hidx - 1]
+            if sbase != hbase and sbase != 78 and hbase != 78:
+                diffs += 1
+            sidx -= 1
+            hidx -= 1
+        elif oper == 1:
+            sidx -= 1
+        else:
+            hidx -= 1
+        ops[nops] = oper
+        nops += 1
+    ops = ops[:nops][::-1].copy()
+
+    # count gaps between the first and last aligned base
+    first = 0
+    while first < nops and ops[first] != 0:
+        first += 1
+    last = nops - 1
+    while last > first and ops[last] != 0:
+        last -= 1
+    for idx in range(first, last):
+        if ops[idx]:
+            diffs += 1
+    return ops, diffs, last - first + 1, edge
+
+
 def index_ref_with_bwa(data, alt=False):
     "Index the reference sequence, unless it already exists"
 
@@ -1735,7 +2196,9 @@ def mapping_reads(data, sample, nthreads, altref=False):
     Map reads to reference sequence. This reads in the fasta files
     (samples.files.edits), and maps each read to the reference. Unmapped reads
     are dropped right back in the de novo pipeline.
-    Mapped reads end up in a sam file.
+    The SAM output of bwa is streamed through samtools view, which writes
+    the unmapped reads to a bam file and pipes the mapped reads to samtools
+    sort, so no intermediate sam file is written.
 
     Parameters
     -----------
@@ -1745,10 +2208,6 @@ def mapping_reads(data, sample, nthreads, altref=False):
         if True then unmapped reads from previous run are used for mapping.
     """
     # outfiles
-    samout = os.path.join(
-        data.dirs.refmapping,
-        "{}.sam".format(sample.name))
-
     bamout = os.path.join(
         data.dirs.refmapping,
         "{}-mapped-sorted.bam".format(sample.name))
@@ -1766,18 +2225,16 @@ def mapping_reads(data, sample, nthreads, altref=False):
     # select (derep-declone or non-derep) non-merged readpairs
     if "pair" in data.params.datatype:
         read1s = [
-            os.path.join(data.tmpdir, "{}_R1-tmp.fa".format(sample.name)),
-            os.path.join(data.tmpdir, "{}_R1_concatedit.fq.gz".format(sample.name)),
-            sample.files.edits[0][0],
+            [os.path.join(data.tmpdir, "{}_R1-tmp.fa".format(sample.name))],
+            [i[0] for i in sample.files.edits],
         ]
         read2s = [
-            os.path.join(data.tmpdir, "{}_R2-tmp.fa".format(sample.name)),
-            os.path.join(data.tmpdir, "{}_R2_concatedit.fq.gz".format(sample.name)),
-            sample.files.edits[0][1],
+            [os.path.join(data.tmpdir, "{}_R2-tmp.fa".format(sample.name))],
+            [i[1] for i in sample.files.edits],
         ]
-        index = min([i for i, j in enumerate(read1s) if os.path.exists(j)])
+        index = (0 if os.path.exists(read1s[0][0]) else 1)
 
-        # the files for mapping        
+        # the files for mapping (lists of edits are streamed as one)
         infiles = [read1s[index], read2s[index]]
 
     # single (w/ or w/o refminus)
@@ -1789,7 +2246,7 @@ def mapping_reads(data, sample, nthreads, altref=False):
             sample.files.edits[0][0],
         ]
         index = min([i for i, j in enumerate(read1s) if os.path.exists(j)])
-        infiles = [read1s[index]]      
+        infiles = [[read1s[index]]]
 
     # select the appropriate reference file
     if altref:
@@ -1867,12 +2324,15 @@ def mapping_reads(data, sample, nthreads, altref=False):
     #        0xb1 
     #  -U = Write out all reads that don't pass the -F filter
     #       (all unmapped reads go to this file).
+    #  -u = write uncompressed bam (sort re-compresses the mapped reads,
+    #       and the unmapped bam is only a temp file for bam2fq)
 
     # (cmd3) samtools sort [options...] [in.bam]
     #  -T = Temporary file name, this is required by samtools, ignore it
     #       Here we hack it to be samhandle.tmp cuz samtools cleans it up
     #  -O = Output file format, in this case bam
     #  -o = Output file name
+    #  -@ = Number of additional sorting and compression threads
 
     # (cmd5) samtools bam2fq -v 45 [in.bam]
     #   -v45 set the default qscore arbirtrarily high
@@ -1891,7 +2351,6 @@ def mapping_reads(data, sample, nthreads, altref=False):
         "-M",
         reference,
     ]
-    cmd1 += infiles
 
     # Insert optional flags for bwa
     bwa_args = data.hackersonly.bwa_args.split()
@@ -1899,27 +2358,26 @@ def mapping_reads(data, sample, nthreads, altref=False):
     for arg in bwa_args:
         cmd1.insert(2, arg)
 
-    with open(samout, 'wb') as outfile:
-        proc1 = sps.Popen(cmd1, stderr=None, stdout=outfile)
-        error1 = proc1.communicate()[0]
-        if proc1.returncode:
-            raise IPyradError("bwa error: {}".format(error1))
-
-    # sends unmapped reads to a files and will PIPE mapped reads to cmd3
+    # sends unmapped reads to a file and will PIPE mapped reads to cmd3
     cmd2 = [
         ip.bins.samtools, "view",
-        "-b",
+        "-b", "-u",
         "-F", "0x904",
         "-U", ubamout,
-        samout,
+        "-",
     ]
 
-    # this is gonna catch mapped bam output from cmd2 and write to file
+    # this is gonna catch mapped bam output from cmd2 and write to file.
+    # bwa is mostly done by the time sort merges and compresses, so it 
+    # gets the same threads.
     cmd3 = [
         ip.bins.samtools, "sort",
+        "-@", str(max(0, nthreads - 1)),
         "-T", os.path.join(data.dirs.refmapping, sample.name + ".sam.tmp"),
         "-O", "bam",
-        "-o", bamout]
+        "-o", bamout,
+        "-",
+    ]
 
     # Later we're gonna use samtools to grab out regions using 'view'
     cmd4 = [ip.bins.samtools, "index", bamout]
@@ -1952,16 +2410,44 @@ def mapping_reads(data, sample, nthreads, altref=False):
         cmd5.insert(2, ufastqout)
         cmd5.insert(2, "-0")
 
-    # cmd2 writes to sname.unmapped.bam and fills pipe with mapped BAM data
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
-
-    # cmd3 pulls mapped BAM from pipe and writes to sname.mapped-sorted.bam
-    proc3 = sps.Popen(
-        cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
-    error3 = proc3.communicate()[0]
+    # the stderr of cmd2 goes to a file, since it is only read when the
+    # pipeline is done, and warnings filling a pipe would block it.
+    stderr2 = tempfile.TemporaryFile()
+
+    # multiple edits files are streamed through named pipes
+    with fifo_concat(infiles[0], get_edits_fifo(data, sample, 1)) as infile1:
+        with fifo_concat(
+            infiles[-1], get_edits_fifo(data, sample, 2)) as infile2:
+            cmd1 += [infile1, infile2][:len(infiles)]
+
+            # cmd1 maps reads and fills pipe with SAM data
+            proc1 = sps.Popen(cmd1, stderr=None, stdout=sps.PIPE)
+
+            # cmd2 writes to sname.unmapped.bam and fills pipe with mapped
+            # BAM data
+            proc2 = sps.Popen(
+                cmd2, stderr=stderr2, stdout=sps.PIPE, stdin=proc1.stdout)
+            proc1.stdout.close()
+
+            # cmd3 pulls mapped BAM from pipe and writes to 
+            # sname.mapped-sorted.bam
+            proc3 = sps.Popen(
+                cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
+            proc2.stdout.close()
+            error3 = proc3.communicate()[0]
+            proc2.wait()
+            proc1.wait()
+    stderr2.seek(0)
+    error2 = stderr2.read()
+    stderr2.close()
+
+    # report the first tool in the pipeline that failed
+    if proc1.returncode:
+        raise IPyradError("bwa error: {}".format(proc1.returncode))
+    if proc2.returncode:
+        raise IPyradError(error2)
     if proc3.returncode:
         raise IPyradError(error3)
-    proc2.stdout.close()
 
     # cmd4 indexes the bam file
     proc4 = sps.Popen(cmd4, stderr=sps.STDOUT, stdout=sps.PIPE)
@@ -2039,7 +2525,7 @@ def check_insert_size(data, sample):
         data.hackersonly.max_inner_mate_distance = 300
 
 
-def bedtools_merge(data, sample):
+def bedtools_merge(data, sample, count=False):
     """
     Get all contiguous genomic regions with one or more overlapping
     reads. This is the shell command we'll eventually run
@@ -2047,6 +2533,7 @@ def bedtools_merge(data, sample):
     bedtools bamtobed -i 1A_0.sorted.bam | bedtools merge [-d 100]
         -i <input_bam>  :   specifies the input file to bed'ize
         -d <int>        :   For PE set max distance between reads
+        -c 1 -o count   :   if count, add the number of reads in each region
     """
     mappedreads = os.path.join(
         data.dirs.refmapping,
@@ -2077,6 +2564,10 @@ def bedtools_merge(data, sample):
     #    cmd2.insert(2, str(-1 * data._hackersonly["min_SE_refmap_overlap"]))
     #    cmd2.insert(2, "-d")
 
+    # count reads merged into each region
+    if count:
+        cmd2.extend(["-c", "1", "-o", "count"])
+
     ## pipe output from bamtobed into merge
     proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
     proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc1.stdout)
@@ -2092,24 +2583,14 @@ def bedtools_merge(data, sample):
     return result
 
 
-def build_clusters_from_cigars(data, sample):
+def build_region_clusters(data, sample, regions, opath):
     """
-    Directly building clusters relative to reference. Uses the function 
-    cigared() to impute indels relative to reference. This means add - for 
-    insertion and skip* deletions. Skipping is not a good final solution.
+    Builds the clusters of a list of regions from the mapped-sorted bam 
+    and writes them to opath (gzip) and its cluster index. Reads of each
+    region are pulled at once, and placed into a uint8 region matrix by
+    their cigars with numba, from which the cluster text is written. 
+    Returns the length of the (uncompressed) cluster text.
     """
-    # get all regions with reads. Generator to yield (str, int, int)
-    fullregions = bedtools_merge(data, sample).strip().split("\n")
-    # If no reads map to reference the fullregions will be [''], so
-    # we test for it and handle it properly. If you don't do this the regions
-    # genrator will be empty and this will raise a ValueError. This will just
-    # pass through samples without any mapped reads with a 0 length clustS file
-    if len(fullregions[0]):
-        regions = (i.split("\t") for i in fullregions)
-        regions = ((i, int(j), int(k)) for (i, j, k) in regions)
-    else:
-        regions = []
-
     # access reads from bam file using pysam
     bamfile = pysam.AlignmentFile(
         os.path.join(
@@ -2117,133 +2598,264 @@ def build_clusters_from_cigars(data, sample):
             "{}-mapped-sorted.bam".format(sample.name)),
         'rb')
 
-    # output path 
-    opath = os.path.join(
-        data.dirs.clusts, "{}.clustS.gz".format(sample.name))
     out = gzip.open(opath, 'wt')
-    idx = 0
+    clustidx = clustdb.ClustIndex()
+    ispair = "pair" in data.params.datatype
+    declone = data.hackersonly.declone_PCR_duplicates
 
     # iterate over all regions to build clusters
     clusters = []
     for reg in regions:
-        # uncomment and compare against ref sequence when testing
-        # ref = get_ref_region(data.paramsdict["reference_sequence"], *reg)
-        reads = bamfile.fetch(*reg)
-
-        # store reads in a dict
-        rdict = {}
-
-        # paired-end data cluster building
-        if "pair" in data.params.datatype:
-
-            # match paired reads together in a dictionary
-            for read in reads:
-                if read.qname not in rdict:
-                    rdict[read.qname] = [read, None]
-                else:
-                    rdict[read.qname][1] = read
-
-            # sort keys by derep number
-            keys = sorted(
-                rdict.keys(),
-                key=lambda x: int(x.split("=")[-1]), reverse=True)
-
-            # build the cluster based on map positions, orientation, cigar
-            clust = []
-            for key in keys:
-                r1, r2 = rdict[key]
-                if r1 and r2:
-
-                    #lref = len(ref[1])
-                    lref = reg[2] - reg[1]
-                    arr1 = np.zeros(lref, dtype="U1")
-                    arr2 = np.zeros(lref, dtype="U1")
-                    arr1.fill("-")
-                    arr2.fill("-")
-
-                    # how far ahead of the start does this read begin
-                    seq = cigared(r1.seq, r1.cigar)
-                    start = r1.reference_start - reg[1] 
-                    arr1[start:start + len(seq)] = list(seq)
-
-                    seq = cigared(r2.seq, r2.cigar)
-                    start = r2.reference_start - reg[1] 
-                    arr2[start:start + len(seq)] = list(seq)
-
-                    arr3 = join_arrays(arr1, arr2)
-                    pairseq = "".join(arr3)
-
-                    ori = "+"
-                    if r1.is_reverse:
-                        ori = "-"
-                    derep = r1.qname.split("=")[-1]
-
-                    if data.hackersonly.declone_PCR_duplicates:
-                        tag = r1.qname.split(";")[-2]
-                        rname = "{}:{}-{};{};size={};{}".format(
-                            reg[0], reg[1], reg[2], tag, derep, ori,
-                        )
-                    else:
-                        rname = "{}:{}-{};size={};{}".format(
-                            reg[0], reg[1], reg[2], derep, ori,
-                        )
-                    # *reg, derep, ori)
-                    clust.append("{}\n{}".format(rname, pairseq))
-
-        # single-end data cluster building
-        else:   
-            mstart = int(9e12)
-            mend = 0
-
-            for read in reads:
-                rdict[read.qname] = read
-                mstart = min(mstart, read.aend - read.alen)
-                mend = max(mend, read.aend)
-
-            # sort keys by derep number
-            keys = sorted(
-                rdict.keys(),
-                key=lambda x: int(x.split("=")[-1]), reverse=True)
-
-            # build the cluster based on map positions, orientation, cigar
-            clust = []
-            for key in keys:
-                r1 = rdict[key]
-
-                #aref = np.array(list(ref[1]))
-                lref = mend - mstart
-                arr1 = np.zeros(lref, dtype="U1")
-                arr1.fill("-")
-
-                # how far ahead of the start does this read begin
-                seq = cigared(r1.seq, r1.cigar)
-                rstart = (r1.aend - r1.alen) - mstart
-                arr1[rstart:rstart + len(seq)] = list(seq)
-                aseq = "".join(arr1)
-
-                ori = "+"
-                if r1.is_reverse:
-                    ori = "-"
-                derep = r1.qname.split("=")[-1]
-                rname = "{}:{}-{};size={};{}".format(
-                    reg[0], mstart, mend, derep, ori)
-                clust.append("{}\n{}".format(rname, aseq))
+        if ispair:
+            clust = get_pair_region_cluster(bamfile, reg, declone)
+        else:
+            clust = get_single_region_cluster(bamfile, reg)
 
         # store this cluster
         if clust:
-            clusters.append("\n".join(clust))
-            idx += 1
+            clusters.append(clust)
 
         # if 1000 clusters stored then write to disk
-        if not idx % 1000:
-            if clusters:
-                out.write("\n//\n//\n".join(clusters) + "\n//\n//\n")
-                clusters = []
+        if len(clusters) == 1000:
+            dat = "\n//\n//\n".join(clusters) + "\n//\n//\n"
+            out.write(dat)
+            clustidx.add(dat)
+            clusters = []
 
     # write final remaining clusters to disk
     if clusters:
-        out.write("\n//\n//\n".join(clusters) + "\n//\n//\n")
+        dat = "\n//\n//\n".join(clusters) + "\n//\n//\n"
+        out.write(dat)
+        clustidx.add(dat)
     out.close()
+    bamfile.close()
+    clustidx.save(opath)
+    return clustidx.offset
+
+
+def get_region_shards(data, sample, nshards):
+    """
+    Writes the merged regions of the mapped reads of a sample to a bed 
+    file in tmpdir, and returns (start, end) line ranges that split them
+    into up to nshards contiguous shards with about equal numbers of reads.
+    """
+    bedfile = os.path.join(data.tmpdir, "{}.regions.bed".format(sample.name))
+    result = bedtools_merge(data, sample, count=True).strip().split("\n")
+    if not result[0]:
+        open(bedfile, 'w').close()
+        return [(0, 0)]
+
+    # regions to file, and the read counts in them
+    regions, counts = zip(*[i.rsplit("\t", 1) for i in result])
+    with open(bedfile, 'w') as out:
+        out.write("\n".join(regions) + "\n")
+
+    # cut after the region where each equal share of reads is reached
+    cumsum = np.cumsum(np.array(counts, dtype=np.int64))
+    targets = cumsum[-1] * np.arange(1, nshards) / float(nshards)
+    cuts = np.searchsorted(cumsum, targets) + 1
+    bounds = sorted(set([0, len(regions)] + cuts.tolist()))
+    bounds = [i for i in bounds if i <= len(regions)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def build_region_shard(data, sample, sidx, rstart, rend):
+    """
+    Builds the clusters of lines rstart to rend of a sample's regions bed
+    file to a shard of its clustS file in tmpdir. Returns the text length.
+    """
+    bedfile = os.path.join(data.tmpdir, "{}.regions.bed".format(sample.name))
+    with open(bedfile, 'r') as inbed:
+        regions = [i.split("\t") for i in islice(inbed, rstart, rend)]
+    regions = [(i, int(j), int(k)) for (i, j, k) in regions]
+    opath = os.path.join(
+        data.tmpdir, "{}.clustS.shard{}.gz".format(sample.name, sidx))
+    return build_region_clusters(data, sample, regions, opath)
+
+
+def concat_region_shards(data, sample, lengths):
+    """
+    Concatenates the gzip shards of a sample's clusters in order (as gzip
+    members) into its clustS file, and joins their cluster indices with
+    offsets shifted by the lengths of the shards before them.
+    """
+    opath = os.path.join(
+        data.dirs.clusts, "{}.clustS.gz".format(sample.name))
+    shards = [
+        os.path.join(
+            data.tmpdir, "{}.clustS.shard{}.gz".format(sample.name, sidx))
+        for sidx in range(len(lengths))
+    ]
+    with open(opath, 'wb') as out:
+        for shard in shards:
+            with open(shard, 'rb') as infile:
+                shutil.copyfileobj(infile, out)
+
+    # join indices after the clusters file is written
+    idxs = []
+    shift = 0
+    for shard, length in zip(shards, lengths):
+        idx = np.load(clustdb.get_clustidx_path(shard))
+        idx["offset"] += shift
+        shift += length
+        idxs.append(idx)
+        os.remove(clustdb.get_clustidx_path(shard))
+        os.remove(shard)
+    with open(clustdb.get_clustidx_path(opath), 'wb') as out:
+        np.save(out, np.concatenate(idxs))
+    os.remove(os.path.join(
+        data.tmpdir, "{}.regions.bed".format(sample.name)))
+
+
+def get_pair_region_cluster(bamfile, reg, declone=False):
+    """
+    Returns the cluster text of the read pairs in a region, ordered by 
+    derep number, with read1 and read2 joined in the region matrix.
+    """
+    # match paired reads together in a dictionary, first seen mate first
+    rdict = {}
+    for read in bamfile.fetch(*reg):
+        if read.qname not in rdict:
+            rdict[read.qname] = [read, None]
+        else:
+            rdict[read.qname][1] = read
+
+    # sort keys by derep number, and keep only complete pairs
+    keys = sorted(
+        rdict.keys(),
+        key=lambda x: int(x.split("=")[-1]), reverse=True)
+    pairs = [rdict[i] for i in keys if rdict[i][1] is not None]
+    if not pairs:
+        return ""
+
+    # place mates in region matrices and resolve their overlaps
+    width = reg[2] - reg[1]
+    reads1 = [i[0] for i in pairs]
+    reads2 = [i[1] for i in pairs]
+    arr1 = place_region_reads(
+        reads1, [i.reference_start - reg[1] for i in reads1], width)
+    arr2 = place_region_reads(
+        reads2, [i.reference_start - reg[1] for i in reads2], width)
+    arr3 = join_read_matrices(arr1, arr2)
+
+    # encode the cluster
+    clust = []
+    for ridx, (read1, _) in enumerate(pairs):
+        ori = "-" if read1.is_reverse else "+"
+        derep = read1.qname.split("=")[-1]
+        if declone:
+            tag = read1.qname.split(";")[-2]
+            rname = "{}:{}-{};{};size={};{}".format(
+                reg[0], reg[1], reg[2], tag, derep, ori)
+        else:
+            rname = "{}:{}-{};size={};{}".format(
+                reg[0], reg[1], reg[2], derep, ori)
+        clust.append("{}\n{}".format(rname, arr3[ridx].tobytes().decode()))
+    return "\n".join(clust)
+
+
+def get_single_region_cluster(bamfile, reg):
+    """
+    Returns the cluster text of the reads in a region, ordered by derep
+    number, in a matrix spanning from the first to the last mapped base.
+    Reads start at aend - alen, as the cluster builder always placed them.
+    """
+    rdict = {}
+    mstart = int(9e12)
+    mend = 0
+    for read in bamfile.fetch(*reg):
+        rdict[read.qname] = read
+        mstart = min(mstart, read.aend - read.alen)
+        mend = max(mend, read.aend)
+    if not rdict:
+        return ""
+
+    # sort keys by derep number
+    keys = sorted(
+        rdict.keys(),
+        key=lambda x: int(x.split("=")[-1]), reverse=True)
+    reads = [rdict[i] for i in keys]
+    arr1 = place_region_reads(
+        reads, [(i.aend - i.alen) - mstart for i in reads], mend - mstart)
+
+    # encode the cluster
+    clust = []
+    for ridx, read in enumerate(reads):
+        ori = "-" if read.is_reverse else "+"
+        derep = read.qname.split("=")[-1]
+        rname = "{}:{}-{};size={};{}".format(reg[0], mstart, mend, derep, ori)
+        clust.append("{}\n{}".format(rname, arr1[ridx].tobytes().decode()))
+    return "\n".join(clust)
+
+
+def place_region_reads(reads, starts, width):
+    """
+    Returns a (nreads, width) uint8 matrix of pysam reads placed at their 
+    starts (column offsets), with their cigars applied.
+    """
+    seqs = np.frombuffer(
+        "".join([i.query_sequence for i in reads]).encode(), dtype=np.uint8)
+    seqoffs = np.zeros(len(reads) + 1, dtype=np.int64)
+    seqoffs[1:] = np.cumsum([i.query_length for i in reads])
+    cigoffs = np.zeros(len(reads) + 1, dtype=np.int64)
+    cigoffs[1:] = np.cumsum([len(i.cigartuples) for i in reads])
+    cigars = np.array(
+        list(chain(*[i.cigartuples for i in reads])), dtype=np.int64,
+    ).reshape(-1, 2)
+    starts = np.array(starts, dtype=np.int64)
+    return cigar_matrix(seqs, seqoffs, cigars, cigoffs, starts, width)
+
+
+@njit
+def cigar_matrix(seqs, seqoffs, cigars, cigoffs, starts, width):
+    """
+    Fills a matrix of '-' with reads by their cigars, as cigared() does: 
+    matches are copied, deletions are left as -, and inserted and clipped
+    bases are skipped.
+    """
+    nreads = starts.shape[0]
+    arr = np.full((nreads, width), 45, dtype=np.uint8)
+    for ridx in range(nreads):
+        col = starts[ridx]
+        pos = seqoffs[ridx]
+        for cidx in range(cigoffs[ridx], cigoffs[ridx + 1]):
+            flag = cigars[cidx, 0]
+            add = cigars[cidx, 1]
+            if flag == 0:
+                for _ in range(add):
+                    if 0 <= col < width:
+                        arr[ridx, col] = seqs[pos]
+                    col += 1
+                    pos += 1
+            elif flag == 2:
+                col += add
+            else:
+                pos += add
+    return arr
+
+
+@njit
+def join_read_matrices(arr1, arr2):
+    "join read1 and read2 matrices and resolve overlaps, as join_arrays()"
+    arr3 = np.empty_like(arr1)
+    for ridx in range(arr1.shape[0]):
+        for col in range(arr1.shape[1]):
+            base1 = arr1[ridx, col]
+            base2 = arr2[ridx, col]
+            # same, or one is N or - and the other is a base, N wins over -
+            if base1 == base2:
+                arr3[ridx, col] = base1
+            elif base1 == 78:
+                arr3[ridx, col] = 78 if base2 == 45 else base2
+            elif base2 == 78:
+                arr3[ridx, col] = 78 if base1 == 45 else base1
+            elif base1 == 45:
+                arr3[ridx, col] = base2
+            elif base2 == 45:
+                arr3[ridx, col] = base1
+            else:
+                arr3[ridx, col] = 78
+    return arr3
 
 
 def split_endtoend_reads(data, sample):
@@ -2388,7 +3000,8 @@ def cigared(sequence, cigartups):
 
 def get_quick_depths(data, sample):
     """
-    iterate over clustS files to get data returns maxlen and depths arrays
+    get the aligned length and depth of each cluster of a sample, returns
+    maxlen and depths arrays
     """
 
     ## use existing sample cluster path if it exists, since this
@@ -2400,8 +3013,14 @@ def get_quick_depths(data, sample):
             data.dirs.clusts,
             "{}.clustS.gz".format(sample.name))
 
+    # read depths and lengths from the index written with the clusters.
+    # maxlens have always counted the newline of the last seq, so +1.
+    clustidx = clustdb.load_clustidx(sample.files.clusters)
+    if clustidx is not None:
+        return clustidx["length"].astype(np.int64) + 1, clustidx["depth"]
+
     try:
-        # get new clustered loci
+        # else iterate over the clusters (e.g., files from before the index)
         with gzip.open(sample.files.clusters, 'rt') as infile:
             pairdealer = izip(*[iter(infile)] * 2)
 
@@ -2515,10 +3134,7 @@ def store_sample_stats(data, sample, maxlens, depths):
         unmapped = os.path.join(
             data.dirs.refmapping, 
             sample.name + "-unmapped.bam")
-        samplesam = os.path.join(
-            data.dirs.refmapping, 
-            sample.name + ".sam")
-        for rfile in [unmapped, samplesam]:
+        for rfile in [unmapped]:
             if os.path.exists(rfile):
                 os.remove(rfile)
 
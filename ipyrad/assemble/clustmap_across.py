@@ -15,6 +15,7 @@ import os
 import pty
 import gzip
 import glob
+import json
 import time
 import shutil
 import random
@@ -26,6 +27,8 @@ import numpy as np
 from pysam import AlignmentFile, FastaFile
 import ipyrad
 from .utils import IPyradError, fullcomp, chroms2ints
+from .utils import sort_userout, iter_sorted_userout
+from .clustmap import align_fastas
 
 
 class Step6:
@@ -35,7 +38,10 @@ class Step6:
         self.isref = bool('ref' in self.data.params.assembly_method)
         self.force = force
         self.ipyclient = ipyclient
+        self.incremental = False
+        self.dbsamples = []
         self.print_headers()
+        self.finish_incremental_swap()
         self.samples = self.get_subsamples()
         self.setup_dirs(force)
 
@@ -112,12 +118,26 @@ class Step6:
             subsamples = [self.data.samples[i] for i in subs]
 
         else:
-            # tell user which samples have already completed step 6
+            # with step6_incremental, samples that already completed step 6
+            # are kept in the database and new samples in state 5 are 
+            # clustered against its seeds.
             if state6.any():
-                raise IPyradError(
-                    "Some samples are already in state==6. If you wish to \n" \
-                  + "  create a new database for across sample comparisons \n" \
-                  + "  use the force=True (-f) argument.")
+                dbsamples = [self.data.samples[i] for i in state6]
+                if not (
+                    self.data.hackersonly.step6_incremental and 
+                    state5.any() and 
+                    self.can_add_samples(dbsamples)
+                ):
+                    raise IPyradError(
+                        "Some samples are already in state==6. If you wish to \n" \
+                      + "  create a new database for across sample comparisons \n" \
+                      + "  use the force=True (-f) argument.")
+                self.incremental = True
+                self.dbsamples = dbsamples
+                self.data._print(
+                    "adding samples to existing database:\n{}"
+                    .format(state5.tolist()))
+
             # run all samples in state 5
             subsamples = [self.data.samples[i] for i in state5]
 
@@ -139,6 +159,57 @@ class Step6:
         return checked_samples        
 
 
+    def can_add_samples(self, dbsamples):
+        """
+        True if new samples can be added to the existing denovo database,
+        which requires its seeds and consens from a single-tier clustering
+        and that it was built from all of the samples in state 6.
+        """
+        if self.data.params.assembly_method != "denovo":
+            return False
+        across = os.path.realpath(os.path.join(
+            self.data.params.project_dir,
+            "{}_across".format(self.data.name)))
+        database = os.path.join(
+            across, self.data.name + "_clust_database.fa")
+        required = [
+            database,
+            os.path.join(across, "{}-0.htemp".format(self.data.name)),
+            os.path.join(across, "{}-0-catcons.gz".format(self.data.name)),
+        ]
+        if not all(os.path.exists(i) for i in required):
+            return False
+        with open(database, 'r') as indata:
+            snames = indata.readline().strip()[1:].split(",@")
+        return set(i.name for i in dbsamples).issubset(snames)
+
+
+    def finish_incremental_swap(self):
+        """
+        Finishes moving the new database files into place if a run that 
+        added samples was interrupted while doing so (see 
+        store_incremental_seeds), sets the added samples to state 6, and
+        removes the other new-sample files.
+        """
+        swapfile = os.path.realpath(os.path.join(
+            self.data.params.project_dir,
+            "{}_across".format(self.data.name),
+            "{}-swap.json".format(self.data.name)))
+        if not os.path.exists(swapfile):
+            return
+        with open(swapfile, 'r') as infile:
+            swap = json.load(infile)
+        for src, dst in swap["moves"]:
+            if os.path.exists(src):
+                os.rename(src, dst)
+        for sname in swap["samples"]:
+            if sname in self.data.samples:
+                self.data.samples[sname].stats.state = 6
+        for tmpfile in glob.glob(swapfile.replace("-swap.json", "-n[-.]*")):
+            os.remove(tmpfile)
+        os.remove(swapfile)
+
+
     def assign_groups(self):
         "assign samples to groups if not user provided for hierarchical clust"
 
@@ -231,8 +302,30 @@ class Step6:
 
     def run(self):
 
+        # DENOVO (adding new samples to an existing database)
+        if self.incremental:
+
+            # prepare new consens reads behind the seeds of the database
+            self.remote_build_concats_incremental()
+
+            # cluster new reads to the existing seeds and to each other
+            self.remote_cluster_tiers("n")
+
+            # add hits to existing loci and build new loci
+            self.remote_build_incremental_clusters()
+
+            # re-align the touched and new clusters
+            self.remote_align_denovo_clusters()
+
+            # concat untouched and aligned clusters for all samples to a
+            # tmp database that is moved into place with the new seeds
+            newsamples = self.samples
+            self.samples = newsamples + self.dbsamples
+            self.concat_alignments(self.data.clust_database + ".tmp")
+            self.store_incremental_seeds(newsamples)
+
         # DENOVO
-        if self.data.params.assembly_method == "denovo":
+        elif self.data.params.assembly_method == "denovo":
 
             # prepare clustering inputs for hierarchical clustering
             self.remote_build_concats_tier1()
@@ -387,43 +480,103 @@ class Step6:
         if not os.path.exists(uhandle):
             uhandle = uhandle.replace("-x.utemp", "-0.utemp")
             buildfunc = build_single_denovo_clusters
-        usort = uhandle + ".sort"
-
-        # sort utemp files, count seeds.
+        # group hits by seed, which also counts the seeds
         start = time.time()
         printstr = ("building clusters   ", "s6")
         async1 = self.lbview.apply(sort_seeds, uhandle)
         while 1:
             ready = [async1.ready()]
-            self.data._progressbar(3, sum(ready), start, printstr)
+            self.data._progressbar(2, sum(ready), start, printstr)
             time.sleep(0.1)
             if all(ready):
                 break
+        nseeds = async1.get()
 
-        async2 = self.lbview.apply(count_seeds, usort)
+        # send the clust bit building job to work and track progress
+        async2 = self.lbview.apply(
+            buildfunc, *(self.data, uhandle, nseeds, list(self.cgroups.keys())))
         while 1:
             ready = [async1.ready(), async2.ready()]
-            self.data._progressbar(3, sum(ready), start, printstr)
+            self.data._progressbar(2, sum(ready), start, printstr)
             time.sleep(0.1)
             if all(ready):
                 break
-        nseeds = async2.get()
+        self.data._print("")
 
-        # send the clust bit building job to work and track progress
-        async3 = self.lbview.apply(
-            buildfunc, *(self.data, usort, nseeds, list(self.cgroups.keys())))
+        # check for errors
+        for job in [async1, async2]:
+            if not job.successful():
+                job.get()
+
+
+    def remote_build_concats_incremental(self):
+        "prepares concatenated consens of new samples after the old seeds"
+        start = time.time()
+        printstr = ("concatenating inputs", "s6")
+        args = (self.data, self.samples, self.randomseed)
+        rasync = self.lbview.apply(build_concat_incremental, *args)
         while 1:
-            ready = [async1.ready(), async2.ready(), async3.ready()]
-            self.data._progressbar(3, sum(ready), start, printstr)
-            time.sleep(0.1)
-            if all(ready):
+            ready = rasync.ready()
+            self.data._progressbar(1, int(ready), start, printstr)
+            time.sleep(0.5)
+            if ready:
                 break
+
+        # check for errors
         self.data._print("")
+        if not rasync.successful():
+            rasync.get()
+
+
+    def remote_build_incremental_clusters(self):
+        "add new hits to the existing loci and build new loci"
+        start = time.time()
+        printstr = ("building clusters   ", "s6")
+        rasync = self.lbview.apply(build_incremental_denovo_clusters, self.data)
+        while 1:
+            ready = rasync.ready()
+            self.data._progressbar(1, int(ready), start, printstr)
+            time.sleep(0.1)
+            if ready:
+                break
 
         # check for errors
-        for job in [async1, async2, async3]:
-            if not job.successful():
-                job.get()
+        self.data._print("")
+        if not rasync.successful():
+            rasync.get()
+
+
+    def store_incremental_seeds(self, newsamples):
+        """
+        Replaces the database, its seeds, and its catcons with those of 
+        the new clustering (old and new samples) together. The new files 
+        are written next to the old ones, then the list of moves is saved
+        to a swap file, so that an interrupted swap is finished on the 
+        next run by finish_incremental_swap() instead of leaving seeds 
+        and catcons that do not match the database.
+        """
+        prefix = os.path.join(self.data.dirs.across, self.data.name)
+
+        # gzip files concatenate as a valid gzip file
+        shutil.copyfile(prefix + "-0-catcons.gz", prefix + "-0-catcons.gz.tmp")
+        with open(prefix + "-0-catcons.gz.tmp", 'ab') as out:
+            with open(prefix + "-n-catcons.gz", 'rb') as infile:
+                shutil.copyfileobj(infile, out)
+
+        # the swap file is complete when it is moved into place
+        swapfile = prefix + "-swap.json"
+        with open(swapfile + ".tmp", 'w') as out:
+            json.dump({
+                "moves": [
+                    (self.data.clust_database + ".tmp", 
+                        self.data.clust_database),
+                    (prefix + "-n.htemp", prefix + "-0.htemp"),
+                    (prefix + "-0-catcons.gz.tmp", prefix + "-0-catcons.gz"),
+                ],
+                "samples": [i.name for i in newsamples],
+            }, out)
+        os.rename(swapfile + ".tmp", swapfile)
+        self.finish_incremental_swap()
 
 
     def remote_align_denovo_clusters(self):
@@ -461,13 +614,14 @@ class Step6:
         self.data._print("")
 
 
-    def concat_alignments(self):
+    def concat_alignments(self, outfile=None):
         """
         This step is not necessary... we just chunk it up again in step 7...
         it's nice having a file as a product, but why bother...
 
         It creates a header with names of all samples that were present when
-        step 6 was completed. 
+        step 6 was completed. The database is written to outfile if entered
+        (e.g., a tmp file that is moved into place later).
         """
         # get files
         globlist = glob.glob(os.path.join(self.data.tmpdir, "aligned_*.fa"))
@@ -492,7 +646,7 @@ class Step6:
 
         # write clusters to file with a header that has all samples in db        
         snames = sorted([i.name for i in self.samples])
-        with open(self.data.clust_database, 'wt') as out:
+        with open(outfile or self.data.clust_database, 'wt') as out:
             out.write("#{}\n".format(",@".join(snames)))
             for clustfile in clustbits:
                 with open(clustfile, 'r') as indata:
@@ -866,6 +1020,29 @@ def build_concat_two(data, jobids, randomseed):
     proc1.stdout.close()
 
 
+def build_concat_incremental(data, samples, randomseed):
+    """
+    [This is run on an ipengine]
+    Make the length-sorted/shuffled consens file of new samples (jobid n) 
+    and put the seeds of the existing database in front of it, so that
+    the old seeds are centroids before any new reads are clustered.
+    """
+    build_concat_files(data, "n", samples, randomseed)
+    catshuf = os.path.join(
+        data.dirs.across, 
+        "{}-n-catshuf.fa".format(data.name))
+    seeds = os.path.join(
+        data.dirs.across, 
+        "{}-0.htemp".format(data.name))
+
+    tmpshuf = catshuf + ".tmp"
+    with open(tmpshuf, 'wb') as out:
+        for fname in (seeds, catshuf):
+            with open(fname, 'rb') as infile:
+                shutil.copyfileobj(infile, out)
+    os.rename(tmpshuf, catshuf)
+
+
 def build_concat_files(data, jobid, samples, randomseed):
     """
     [This is returnn on an ipengine]
@@ -1037,31 +1214,12 @@ def cluster(data, jobid, nthreads, print_progress=False):
         print(100)
 
 
-def count_seeds(uhandle):
-    "uses bash commands to quickly count N seeds from utemp file"
-    with open(uhandle, 'r') as insort:
-        cmd1 = ["cut", "-f", "2"]
-        cmd2 = ["uniq"]
-        cmd3 = ["wc"]
-        proc1 = sps.Popen(cmd1, stdin=insort, stdout=sps.PIPE, close_fds=True)
-        proc2 = sps.Popen(cmd2, stdin=proc1.stdout, stdout=sps.PIPE, close_fds=True)
-        proc3 = sps.Popen(cmd3, stdin=proc2.stdout, stdout=sps.PIPE, close_fds=True)
-        res = proc3.communicate()
-        nseeds = int(res[0].split()[0])
-        proc1.stdout.close()
-        proc2.stdout.close()
-        proc3.stdout.close()
-    return nseeds
-
-
 def sort_seeds(uhandle):
-    "sort seeds from cluster results"
-    cmd = ["sort", "-k", "2", uhandle, "-o", uhandle + ".sort"]
-    proc = sps.Popen(cmd, close_fds=True)
-    proc.communicate()
+    "group hits by seed from cluster results and return the number of seeds"
+    return sort_userout(uhandle)
 
 
-def build_single_denovo_clusters(data, usort, nseeds, *args):
+def build_single_denovo_clusters(data, uhandle, nseeds, *args):
     "use this function when not hierarchical clustering"
     # load all concat fasta files into a dictionary (memory concerns here...)
     conshandle = os.path.join(
@@ -1075,73 +1233,66 @@ def build_single_denovo_clusters(data, usort, nseeds, *args):
             nnn, sss = [i.strip() for i in (namestr, seq)]
             allcons[nnn[1:]] = sss
 
-    # load all utemp files into a dictionary
-    usortfile = os.path.join(
-        data.dirs.across,
-        "{}-0.utemp.sort".format(data.name)
-    )
-
     # set optim to approximately 4 chunks per core. Smaller allows for a bit
     # cleaner looking progress bar. 40 cores will make 160 files.
     # This often does not work as intended. iao 10/26/19
     # optim = ((nseeds // (data.ncpus * 4)) + (nseeds % (data.ncpus * 4)))
     optim = np.ceil(nseeds / (data.ncpus * 4))
 
-    # iterate through usort grabbing seeds and matches
-    with open(usortfile, 'rt') as insort:
-        # iterator, seed null, and seqlist null
-        isort = iter(insort)
-        loci = 0
-        lastseed = 0
-        fseqs = []
-        seqlist = []
-        seqsize = 0
+    # iterate through hits grouped by seed grabbing seeds and matches
+    # iterator, seed null, and seqlist null
+    isort = iter_sorted_userout(uhandle)
+    loci = 0
+    lastseed = 0
+    fseqs = []
+    seqlist = []
+    seqsize = 0
 
-        while 1:
-            try:
-                hit, seed, ori = next(isort).strip().split()
-            except StopIteration:
-                break
-        
-            # store hit if still matching to same seed
-            if seed == lastseed:
-                if ori == "-":
-                    seq = fullcomp(allcons[hit])[::-1]
-                else:
-                    seq = allcons[hit]
-                fseqs.append(">{}\n{}".format(hit, seq))
-
-            # store seed and hit (to a new cluster) if new seed.
-            else:  
-                # store the last fseq, count it, and clear it
-                if fseqs:
-                    seqlist.append("\n".join(fseqs))
-                    seqsize += 1
-                    fseqs = []
-
-                # occasionally write to file
-                if seqsize >= optim:
-                    if seqlist:
-                        loci += seqsize
-                        pathname = os.path.join(
-                            data.tmpdir, 
-                            "{}.chunk_{}".format(data.name, loci))
-                        with open(pathname, 'wt') as clustout:
-                            clustout.write(
-                                "\n//\n//\n".join(seqlist) + "\n//\n//\n")
-                        # reset counter and list
-                        seqlist = []
-                        seqsize = 0
-
-                # store the new seed on top of fseqs
-                fseqs.append(">{}\n{}".format(seed, allcons[seed]))
-                lastseed = seed
-
-                # store the first hit to the seed
+    while 1:
+        try:
+            hit, seed, ori = next(isort).strip().split()
+        except StopIteration:
+            break
+    
+        # store hit if still matching to same seed
+        if seed == lastseed:
+            if ori == "-":
+                seq = fullcomp(allcons[hit])[::-1]
+            else:
                 seq = allcons[hit]
-                if ori == "-":
-                    seq = fullcomp(seq)[::-1]
-                fseqs.append(">{}\n{}".format(hit, seq))
+            fseqs.append(">{}\n{}".format(hit, seq))
+
+        # store seed and hit (to a new cluster) if new seed.
+        else:  
+            # store the last fseq, count it, and clear it
+            if fseqs:
+                seqlist.append("\n".join(fseqs))
+                seqsize += 1
+                fseqs = []
+
+            # occasionally write to file
+            if seqsize >= optim:
+                if seqlist:
+                    loci += seqsize
+                    pathname = os.path.join(
+                        data.tmpdir, 
+                        "{}.chunk_{}".format(data.name, loci))
+                    with open(pathname, 'wt') as clustout:
+                        clustout.write(
+                            "\n//\n//\n".join(seqlist) + "\n//\n//\n")
+                    # reset counter and list
+                    seqlist = []
+                    seqsize = 0
+
+            # store the new seed on top of fseqs
+            fseqs.append(">{}\n{}".format(seed, allcons[seed]))
+            lastseed = seed
+
+            # store the first hit to the seed
+            seq = allcons[hit]
+            if ori == "-":
+                seq = fullcomp(seq)[::-1]
+            fseqs.append(">{}\n{}".format(hit, seq))
 
     # write whatever is left over to the clusts file
     if fseqs:
@@ -1158,7 +1309,7 @@ def build_single_denovo_clusters(data, usort, nseeds, *args):
     del allcons
 
 
-def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
+def build_hierarchical_denovo_clusters(data, uhandle, nseeds, jobids):
     "use this function when building clusters from hierarchical clusters"
     # load all concat fasta files into a dictionary (memory concerns here...)
     allcons = {}
@@ -1195,9 +1346,8 @@ def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
     # cleaner looking progress bar. 40 cores will make 160 files.
     optim = ((nseeds // (data.ncpus * 4)) + (nseeds % (data.ncpus * 4)))
 
-    # iterate through usort grabbing seeds and matches
-    insort = open(usort, 'rt')
-    isort = iter(insort)
+    # iterate through hits grouped by seed grabbing seeds and matches
+    isort = iter_sorted_userout(uhandle)
 
     # seed null, and seqlist null
     loci = 0
@@ -1261,9 +1411,6 @@ def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
                 seq = fullcomp(seq)[::-1]
             fseqs.append(">{}\n{}".format(sname, seq))
 
-    # close handle
-    insort.close()
-
     ## write whatever is left over to the clusts file
     if fseqs:
         seqlist.append("\n".join(fseqs))
@@ -1280,6 +1427,100 @@ def build_hierarchical_denovo_clusters(data, usort, nseeds, jobids):
     del allcons
 
 
+def build_incremental_denovo_clusters(data):
+    """
+    Adds the new consens reads that hit an existing seed to its locus in
+    the clust database, and builds new loci from new seeds (or old seeds
+    that were not in a locus) with their hits. Untouched loci are copied
+    as is to aligned_0.fa, while touched and new loci are de-gapped and
+    written to chunks to be re-aligned by align_to_array.
+    """
+    # load the new consens reads into a dictionary
+    conshandle = os.path.join(
+        data.dirs.across, 
+        "{}-n-catcons.gz".format(data.name))
+    newcons = {}
+    with gzip.open(conshandle, 'rt') as iocons:
+        cons = izip(*[iter(iocons)] * 2)
+        for namestr, seq in cons:
+            nnn, sss = [i.strip() for i in (namestr, seq)]
+            newcons[nnn[1:]] = sss
+
+    # group new hits by seed, skip old seeds that hit each other
+    hits = {}
+    uhandle = os.path.join(
+        data.dirs.across, 
+        "{}-n.utemp".format(data.name))
+    with open(uhandle, 'r') as inhits:
+        for line in inhits:
+            hit, seed, ori = line.strip().split()
+            if hit in newcons:
+                seq = newcons[hit]
+                if ori == "-":
+                    seq = fullcomp(seq)[::-1]
+                hits.setdefault(seed, []).append(">{}\n{}".format(hit, seq))
+
+    # copy untouched loci and de-gap loci that have new hits
+    clusts = []
+    untouched = open(os.path.join(data.tmpdir, "aligned_0.fa"), 'wt')
+    with open(data.clust_database, 'rt') as indata:
+        indata.readline()
+        locus = []
+        for line in indata:
+            if not line.strip():
+                continue
+            if line[0] != "/":
+                locus.append(line)
+                continue
+            if not locus:
+                continue
+            names = [i[1:].strip() for i in locus[::2]]
+            seeds = [i for i in names if i in hits]
+            if seeds:
+                clust = [
+                    "{}\n{}".format(i.strip(), j.strip().replace("-", ""))
+                    for i, j in zip(locus[::2], locus[1::2])
+                ]
+                for seed in seeds:
+                    clust.extend(hits.pop(seed))
+                clusts.append("\n".join(clust))
+            else:
+                untouched.write("".join(locus) + "//\n//\n")
+            locus = []
+    untouched.close()
+
+    # old seeds with hits that were not in a locus are in the old catcons
+    oldseeds = {}
+    if any(i not in newcons for i in hits):
+        conshandle = os.path.join(
+            data.dirs.across, 
+            "{}-0-catcons.gz".format(data.name))
+        with gzip.open(conshandle, 'rt') as iocons:
+            cons = izip(*[iter(iocons)] * 2)
+            for namestr, seq in cons:
+                nnn = namestr.strip()[1:]
+                if nnn in hits:
+                    oldseeds[nnn] = seq.strip()
+
+    # new loci from seeds and their hits
+    for seed in hits:
+        seq = newcons.get(seed, oldseeds.get(seed))
+        if seq is None:
+            raise IPyradError(
+                "seed {} not found in consens files".format(seed))
+        clusts.append("\n".join([">{}\n{}".format(seed, seq)] + hits[seed]))
+
+    # write clusters to chunks to be aligned, about 4 chunks per core
+    optim = max(1, int(np.ceil(len(clusts) / float(data.ncpus * 4))))
+    for loci in range(0, len(clusts), optim):
+        pathname = os.path.join(
+            data.tmpdir, 
+            "{}.chunk_{}".format(data.name, loci + optim))
+        with open(pathname, 'wt') as clustout:
+            clustout.write(
+                "\n//\n//\n".join(clusts[loci:loci + optim]) + "\n//\n//\n")
+
+
 def align_to_array(data, samples, chunk):
     """
     Opens a tmp clust chunk and iterates over align jobs.
@@ -1291,8 +1532,8 @@ def align_to_array(data, samples, chunk):
     # snames to ensure sorted order
     samples.sort(key=lambda x: x.name)
 
-    # create a persistent shell for running muscle in. 
-    proc = sps.Popen(["bash"], stdin=sps.PIPE, stdout=sps.PIPE, bufsize=0)
+    # small clusters are aligned natively, others with muscle
+    native_max = data.hackersonly.native_align_max_seqs
 
     # iterate over clusters until finished
     allstack = []
@@ -1322,8 +1563,8 @@ def align_to_array(data, samples, chunk):
             right = [i.split("nnnn")[1] for i in seqs]
 
             # align separately
-            istack1 = muscle_it(proc, names, left)
-            istack2 = muscle_it(proc, names, right)
+            istack1 = muscle_it(names, left, native_max)
+            istack2 = muscle_it(names, right, native_max)
 
             # combine in order
             for sdx in range(len(istack1)):
@@ -1333,19 +1574,12 @@ def align_to_array(data, samples, chunk):
 
         # no insert just align a single locus
         except IndexError:
-            istack = muscle_it(proc, names, seqs)
+            istack = muscle_it(names, seqs, native_max)
             
         # store the locus
         if istack:
             allstack.append("\n".join(istack))
 
-    # cleanup
-    proc.stdout.close()
-    if proc.stderr:
-        proc.stderr.close()
-    proc.stdin.close()
-    proc.wait()
-
     # write to file when chunk is finished
     odx = chunk.rsplit("_")[-1]
     alignfile = os.path.join(data.tmpdir, "aligned_{}.fa".format(odx))
@@ -1354,7 +1588,7 @@ def align_to_array(data, samples, chunk):
 
 
 
-def muscle_it(proc, names, seqs):
+def muscle_it(names, seqs, native_max):
     """
     Align with muscle, ensure name order, and return as string
     """  
@@ -1369,18 +1603,11 @@ def muscle_it(proc, names, seqs):
     # store allele (lowercase) info, returns mask with lowercases
     amask, abool = store_alleles(seqs)
 
-    # send align1 to the bash shell (TODO: check for pipe-overflow)
-    cmd1 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-            .format(cl1, ipyrad.bins.muscle, "//\n"))
-    proc.stdin.write(cmd1.encode())
-
-    # read the stdout by line until splitter is reached
-    align1 = []
-    for line in iter(proc.stdout.readline, b'//\n'):
-        align1.append(line.decode())
+    # align natively if small and similar, else send to muscle
+    align1 = align_fastas([cl1], native_max)[0]
 
     # reorder b/c muscle doesn't keep order
-    lines = "".join(align1)[1:].split("\n>")
+    lines = align1[1:].split("\n>")
     dalign1 = dict([i.split("\n", 1) for i in lines])
     keys = sorted(
         dalign1.keys(), 
@@ -10,6 +10,10 @@ try:
 except ImportError:
     from itertools import islice
     izip = zip
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # external imports
 import os
@@ -18,30 +22,46 @@ import gzip
 import glob
 import time
 import shutil
+import zlib
+import json
+import copy
+import fcntl
+import hashlib
 import pickle
+import multiprocessing as mp
 import numpy as np
 import subprocess as sps
-from collections import Counter
+from numba import njit
+from collections import Counter, OrderedDict
 
 # ipyrad imports
 from ipyrad.core.sample import Sample
 from ipyrad.assemble.utils import IPyradError, ambigcutters, BADCHARS
+from ipyrad.assemble.utils import ReadCounts, count_fastq_reads
+from ipyrad.assemble.utils import open_fastq, iter_fastq_blocks
+from ipyrad.assemble.utils import fastq_line_offsets
+from ipyrad.assemble.rawedit import ReadTrimmer, check_adapters
+from ipyrad.assemble.rawedit import parse_builtin_results, assembly_cleanup
 
 
 
 class Step1:
-    def __init__(self, data, force, ipyclient):
+    def __init__(self, data, force, ipyclient, fused=False):
         # store attrs
         self.data = data
         self.force = force
         self.ipyclient = ipyclient
         self.skip = False
+        self.resume = False
 
         # check input data files
         self.sfiles = self.data.params.sorted_fastq_path
         self.rfiles = self.data.params.raw_fastq_path
         self.print_headers()
         self.select_method()
+
+        # demultiplexed reads can be trimmed as they are sorted (step 2)
+        self.fused = bool(fused and self.method == "demultiplex")
         self.setup_dirs()
 
 
@@ -67,9 +87,17 @@ class Step1:
             if os.path.exists(self.data.dirs.fastqs):
                 shutil.rmtree(self.data.dirs.fastqs)
 
-        # bail out if overwrite necessary but no force flag.
+        # resume an interrupted run if its journal exists, else bail out 
+        # if overwrite necessary but no force flag.
         else:
-            if os.path.exists(self.data.dirs.fastqs):
+            journal = os.path.join(
+                self.data.dirs.fastqs, "tmpdir", "s1_journal.txt")
+            if os.path.exists(journal) and self.method == "demultiplex":
+                self.resume = True
+                self.data._print(
+                    "{}resuming interrupted step 1 in {}"
+                    .format(self.data._spacer, self.data.dirs.fastqs))
+            elif os.path.exists(self.data.dirs.fastqs):
                 raise IPyradError(
                     "Fastq dir {} already exists: use force to overwrite"
                     .format(self.data.dirs.fastqs))
@@ -83,6 +111,34 @@ class Step1:
         if not os.path.exists(self.data.dirs.fastqs):
             os.mkdir(self.data.dirs.fastqs)
 
+        # fused runs write trimmed reads to the step 2 edits dir
+        if self.fused:
+            self.setup_edits_dir()
+            check_adapters(self.data)
+
+
+    def setup_edits_dir(self):
+        "create the edits dir and remove edits left by an earlier run."
+        if self.data._cli:
+            self.data._print(
+                "{}Step 2: Filtering and trimming reads while sorting"
+                .format(self.data._spacer))
+        self.data.dirs.edits = os.path.realpath(os.path.join(
+            self.data.params.project_dir,
+            "{}_edits".format(self.data.name)))
+        if not os.path.exists(self.data.dirs.edits):
+            os.makedirs(self.data.dirs.edits)
+
+        # edits are appended to by each job, so start from empty files
+        # unless resuming, in which case the journal finishes the commits
+        # that were interrupted.
+        if not self.resume:
+            groups = get_replicate_groups(self.data.barcodes)
+            for sname in set(groups.values()):
+                for fname in glob.glob(os.path.join(
+                    self.data.dirs.edits, sname + ".trimmed_R*_.fastq.gz")):
+                    os.remove(fname)
+
 
     def print_headers(self):
         # print headers
@@ -215,19 +271,19 @@ class FileLinker:
                 self.data.samples[sname] = newsamp
                 createdinc += 1
 
-        # send jobs to engines for counting with cat/zcat | wc
+        # get counts from the cache, or send jobs to engines for counting
+        counts = ReadCounts(self.data)
+        cached = {}
         rasyncs = {}
         if createdinc:
             for sample in self.data.samples.values():
-
-                # get zip var
-                gzipped = bool(sample.files.fastqs[0][0].endswith(".gz"))
-
-                # submit job to count lines and store async
-                rasyncs[sample.name] = self.lbview.apply(
-                    zbufcountlines, 
-                    *(sample.files.fastqs[0][0], gzipped)
-                )
+                fname = sample.files.fastqs[0][0]
+                nreads = counts.get(fname)
+                if nreads is not None:
+                    cached[sample.name] = nreads
+                else:
+                    rasyncs[sample.name] = self.lbview.apply(
+                        count_fastq_reads, fname)
 
         # wait for link jobs to finish if parallel
         start = time.time()
@@ -240,9 +296,13 @@ class FileLinker:
                 self.data._print("")
                 break
 
-        # collect link job results           
+        # collect link job results and store new counts in the cache
         for sname in rasyncs:
-            res = rasyncs[sname].get() / 4
+            cached[sname] = rasyncs[sname].get()
+            counts.put(self.data.samples[sname].files.fastqs[0][0], cached[sname])
+        counts.save()
+
+        for sname, res in cached.items():
             self.data.samples[sname].stats.reads_raw = res
             self.data.samples[sname].stats_dfs.s1["reads_raw"] = res
             self.data.samples[sname].state = 1
@@ -281,6 +341,8 @@ class Demultiplexer:
         self.input = step.rfiles
         self.fastqs = glob.glob(self.input)
         self.ipyclient = step.ipyclient
+        self.resume = step.resume
+        self.fused = step.fused
         # single engine jobs
         self.iview = self.ipyclient.load_balanced_view(targets=[0])
 
@@ -291,6 +353,11 @@ class Demultiplexer:
             targets = self.ipyclient.ids[:4]
         self.lbview = self.ipyclient.load_balanced_view(targets=targets)
 
+        # streaming mode runs one reader and several matching processes 
+        # inside each lbview job, using the cores of the skipped engines.
+        self.streaming = self.data.hackersonly.demultiplex_streaming
+        self.nworkers = max(1, len(self.ipyclient.ids) // len(targets) - 1)
+
         # re-parse the barcodes file in case hackers options changed
         # e.g., (i7 demuxing or merge technical replicates)
         self.data._link_barcodes()
@@ -303,7 +370,7 @@ class Demultiplexer:
 
         # attrs filled by get_barcode_dict
         self.cutters = None
-        self.matchdict = {}       
+        self.bindex = None
         self.get_barcode_dict()        
 
         # store stats for each file handle (grouped results of chunks)
@@ -313,14 +380,16 @@ class Demultiplexer:
         # Estimate size of files to plan parallelization. 
         self.setup_for_splitting()
 
-        # work load; i.e., is there one giant file or many small files?
-        self.splitfiles()
+        # stream each raw file through matching workers without chunking
+        if self.streaming:
+            self.remote_run_streaming()
 
-        # process the files or chunked file bits        
-        self.remote_run_barmatch()
+        else:
+            # work load; i.e., is there one giant file or many small files?
+            self.splitfiles()
 
-        # concatenate chunks
-        self.concatenate_chunks()
+            # process the files or chunked file bits        
+            self.remote_run_barmatch()
 
         # store stats and create Sample objects in Assembly
         self.store_stats()
@@ -383,8 +452,8 @@ class Demultiplexer:
         ]
         assert self.cutters, "Must enter a restriction_overhang for demultiplexing."
 
-        # get matchdict
-        self.matchdict = inverse_barcodes(self.data)
+        # get compiled index of barcodes and their mismatch neighbours
+        self.bindex = BarcodeIndex.from_data(self.data)
 
 
     def setup_for_splitting(self, omin=int(8e6)):
@@ -392,22 +461,52 @@ class Demultiplexer:
         Decide to split or not based on whether 1/16th of file size is 
         bigger than omin, which is default to 8M reads.
         """
-        # create a tmpdir for chunked_files and a chunk optimizer 
+        # create a tmpdir for chunked_files and a chunk optimizer. It is
+        # kept when resuming since it holds the chunks and journal.
         self.tmpdir = os.path.realpath(
             os.path.join(self.data.dirs.fastqs, "tmpdir")
         )
-        if os.path.exists(self.tmpdir):
+        if os.path.exists(self.tmpdir) and not self.resume:
             shutil.rmtree(self.tmpdir)
-        os.makedirs(self.tmpdir)
+        if not os.path.exists(self.tmpdir):
+            os.makedirs(self.tmpdir)
+
+        # finished jobs, split files, and the chunking plan of the run
+        # being resumed. Interrupted commits are finished and outputs of 
+        # jobs that did not commit are removed.
+        self.journal = os.path.join(self.tmpdir, "s1_journal.txt")
+        self.jobsdone, self.splits, plan = recover_journal(self.journal)
+        if plan:
+            self.optim, self.do_file_split = plan[:2]
+            if bool(plan[2:] and plan[2]) != self.fused:
+                raise IPyradError(
+                    "Cannot resume step 1 in {} with a different "
+                    "fuse_steps_1_2 setting: use force to restart"
+                    .format(self.data.dirs.fastqs))
 
-        # chunk into 16 pieces
-        self.nreads = estimate_nreads(self.data, self.ftuples[0][0])
+            # jobids differ between modes, so committed raws would be redone
+            if bool(plan[3:] and plan[3]) != bool(self.streaming):
+                raise IPyradError(
+                    "Cannot resume step 1 in {} with a different "
+                    "demultiplex_streaming setting: use force to restart"
+                    .format(self.data.dirs.fastqs))
+            return
+
+        # chunk into 16 pieces, using the exact count if it is cached
+        self.nreads = ReadCounts(self.data).get(self.ftuples[0][0])
+        if self.nreads is None:
+            self.nreads = estimate_nreads(self.ftuples[0][0])
         self.optim = int(self.nreads / 16)
 
         # if more files than cpus or optim<8M: no chunking
         self.do_file_split = 0
         if (len(self.ftuples) > len(self.ipyclient)) or (self.optim > omin):
             self.do_file_split = 1
+        journal_append(
+            self.journal, 
+            {"plan": [
+                self.optim, self.do_file_split, self.fused, 
+                bool(self.streaming)]})
 
 
     def splitfiles(self):
@@ -431,6 +530,10 @@ class Demultiplexer:
             if not self.do_file_split:
                 chunksdict[handle] = [ftup]
 
+            # already split before an interruption
+            elif handle in self.splits:
+                chunksdict[handle] = [tuple(i) for i in self.splits[handle]]
+
             # chunk file into 4 bits using zcat_make_temps                
             else:               
                 args = (self.data, ftup, fidx, self.tmpdir, self.optim, start)
@@ -449,9 +552,11 @@ class Demultiplexer:
                 self.data._progressbar(njobs, done, start, printstr)
                 time.sleep(0.5)
 
-            # store results
+            # store results and record them in the journal
             for key, val in rasyncs.items():
                 chunksdict[key] = val.get()       
+                journal_append(
+                    self.journal, {"split": key, "chunks": chunksdict[key]})
 
             # clean up                    
             self.ipyclient.purge_everything()                    
@@ -474,22 +579,32 @@ class Demultiplexer:
         rasyncs = {}
         ridx = 0
         for handle, ftuplist in self.chunksdict.items():
+
+            # get ready to receive stats: 'total', 'cutfound', 'matched'
+            self.stats.perfile[handle] = np.zeros(3, dtype=np.int)
+
             for fidx, ftuple in enumerate(ftuplist):
+
+                # chunks finished before an interruption only need stats
+                jobid = "{}-{}".format(handle, fidx)
+                if jobid in self.jobsdone:
+                    for pkl in self.jobsdone[jobid]:
+                        self.stats.fill_from_pickle(pkl, handle)
+                    continue
+
                 args = (
                     self.data,
                     ftuple,
                     self.longbar,
                     self.cutters,
-                    self.matchdict,
-                    fidx,
+                    self.bindex,
+                    jobid,
+                    self.fused,
                     )
                 rasync = self.lbview.apply(barmatch, args)
                 rasyncs[ridx] = (handle, rasync)
                 ridx += 1
 
-            # get ready to receive stats: 'total', 'cutfound', 'matched'
-            self.stats.perfile[handle] = np.zeros(3, dtype=np.int)
-
         # collect and store results as jobs finish
         njobs = len(rasyncs)
         done = 0
@@ -513,64 +628,57 @@ class Demultiplexer:
                 break
 
 
-    def concatenate_chunks(self):
-        """ 
-        If multiple chunk files match to the same sample name but with 
-        different barcodes (i.e., they are technical replicates) then this
-        will assign all the files to the same sample name file.
+    def remote_run_streaming(self):
+        """
+        Submit each raw file to barmatch_streaming(), which decompresses it
+        once and passes blocks of reads to matching processes, and collect
+        the stats pickles written by each matching process.
         """
-        # collate files progress bar
         start = time.time()
-        printstr = ("writing/compressing ", "s1")
-        self.data._progressbar(10, 0, start, printstr) 
+        printstr = ("sorting reads       ", "s1")
 
-        # get all the files
-        ftmps = glob.glob(os.path.join(
-            self.data.dirs.fastqs, 
-            "tmpdir", 
-            "tmp_*.fastq"))
-
-        # a dict to assign tmp files to names/reads
-        r1dict = {}
-        r2dict = {}
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            r1dict[sname] = []
-            r2dict[sname] = []
-
-        # assign to name keys
-        for ftmp in ftmps:
-            base, orient, _ = ftmp.rsplit("_", 2)
-            sname = base.rsplit("/", 1)[-1].split("tmp_", 1)[1]
-            if orient == "R1":
-                r1dict[sname].append(ftmp)
-            else:
-                r2dict[sname].append(ftmp)
-
-        ## concatenate files
-        snames = []
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            snames.append(sname)
-
-        writers = []
-        for sname in set(snames):
-            tmp1s = sorted(r1dict[sname])
-            tmp2s = sorted(r2dict[sname])
-            writers.append(
-                self.iview.apply(
-                    collate_files, 
-                    *(self.data, sname, tmp1s, tmp2s))
+        rasyncs = {}
+        for ridx, ftuple in enumerate(self.ftuples):
+            handle = os.path.splitext(os.path.basename(ftuple[0]))[0]
+            self.stats.perfile[handle] = np.zeros(3, dtype=np.int)
+
+            # files finished before an interruption only need stats
+            jobid = "{}-stream".format(handle)
+            if jobid in self.jobsdone:
+                for pkl in self.jobsdone[jobid]:
+                    self.stats.fill_from_pickle(pkl, handle)
+                continue
+
+            args = (
+                self.data,
+                ftuple,
+                self.longbar,
+                self.cutters,
+                self.bindex,
+                jobid,
+                self.fused,
                 )
+            rasyncs[ridx] = (
+                handle, 
+                self.lbview.apply(barmatch_streaming, args, self.nworkers),
+            )
 
-        total = len(writers)
+        # collect and store results as jobs finish
+        njobs = len(rasyncs)
+        done = 0
         while 1:
-            ready = [i.ready() for i in writers]
-            self.data._progressbar(total, sum(ready), start, printstr)
+            finished = [i for (i, j) in rasyncs.items() if j[1].ready()]
+            for ridx in finished:
+                handle, rasync = rasyncs[ridx]
+                for pkl in rasync.get():
+                    self.stats.fill_from_pickle(pkl, handle)
+                del rasyncs[ridx]
+                done += 1
+
+            # print progress
+            self.data._progressbar(njobs, done, start, printstr)
             time.sleep(0.1)
-            if all(ready):
+            if njobs == done:
                 self.data._print("")
                 break
 
@@ -610,27 +718,31 @@ class Demultiplexer:
             .format("sample_name", "total_reads"))
 
         # names alphabetical. Write to file. Will save again below to Samples.
-        snames = set()
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            snames.add(sname)
+        groups = get_replicate_groups(self.data.barcodes)
+        snames = set(groups.values())
 
         for sname in sorted(list(snames)):
             outfile.write("{:<35}  {:>13}\n"
                 .format(sname, self.stats.fsamplehits[sname]))
 
+        # reads from each technical replicate merged into the samples above
+        replicates = [i for i in groups if groups[i] != i]
+        if replicates:
+            outfile.write(
+                "\n{:<35}  {:>13}\n"
+                .format("replicate_name", "total_reads"))
+            for rname in replicates:
+                outfile.write("{:<35}  {:>13}\n"
+                    .format(rname, self.stats.freplicatehits[rname]))
+
         ## spacer, which barcodes were found -----------------------------------
         outfile.write('\n{:<35}  {:>13} {:>13} {:>13}\n'
             .format("sample_name", "true_bar", "obs_bar", "N_records"))
 
         ## write sample results
         for sname in sorted(self.data.barcodes):
-            if "-technical-replicate-" in sname:
-                fname = sname.rsplit("-technical-replicate", 1)[0]  
-            else:
-                fname = sname
-                
+            fname = groups[sname]
+
             # write perfect hit
             hit = self.data.barcodes[sname]
             offhitstring = ""
@@ -670,16 +782,7 @@ class Demultiplexer:
             sample = Sample(sname)
 
             # allow multiple barcodes if its a replicate. 
-            barcodes = []
-            for n in range(500):
-                fname = "{}-technical-replicate-{}".format(sname, n)
-                fbar = self.data.barcodes.get(fname)
-                if fbar:
-                    barcodes.append(fbar)
-            if barcodes:
-                sample.barcode = barcodes
-            else:
-                sample.barcode = self.data.barcodes[sname]
+            sample.barcode = get_sample_barcode(self.data, groups, sname)
 
             # file names        
             if 'pair' in self.data.params.datatype:
@@ -711,8 +814,33 @@ class Demultiplexer:
             else:
                 print("Excluded sample: no data found for", sname)
 
-        # initiate s1 key for data object
+        # every read was counted, so store exact counts of the R1 files that
+        # are read back: raws for chunking a re-run and sorted fastqs for 
+        # linking them as sorted_fastq_path (e.g., in a new assembly).
+        counts = ReadCounts(self.data)
+        for ftup in self.ftuples:
+            handle = os.path.splitext(os.path.basename(ftup[0]))[0]
+            counts.put(ftup[0], self.stats.perfile[handle][0])
+
+        # reads trimmed while sorting fill the step 2 stats and edits
+        # files, and the sorted (untrimmed) fastqs are not written.
+        if self.fused:
+            for sample in self.data.samples.values():
+                if sample.name in snames:
+                    parse_builtin_results(
+                        self.data, sample, 
+                        self.stats.ftrimstats.get(sample.name, Counter()))
+        else:
+            for sample in self.data.samples.values():
+                if sample.name in snames:
+                    counts.put(
+                        sample.files.fastqs[0][0], sample.stats.reads_raw)
+        counts.save()
+
+        # initiate s1 (and s2) key for data object
         self.data.stats_dfs.s1 = self.data._build_stat("s1")
+        if self.fused:
+            assembly_cleanup(self.data)
 
         # cleanup
         shutil.rmtree(self.tmpdir)
@@ -721,46 +849,73 @@ class Demultiplexer:
 # this class is created and run inside the barmatch function() that is run
 # on remote engines for parallelization.
 class BarMatch:
-    def __init__(self, data, ftuple, longbar, cutters, matchdict, fidx):
+    def __init__(self, data, ftuple, longbar, cutters, bindex, fidx, 
+        fused=False):
         """
         Sorts reads to samples based on barcodes and writes stats to a pickle.
+        If fused the sorted reads are trimmed and filtered as in step 2.
         """
         # store attrs
         self.data = data
         self.longbar = longbar
         self.cutters = cutters
         self.ftuple = ftuple
-        self.matchdict = matchdict
+        self.bindex = bindex
+        self.matchdict = bindex.matchdict
         self.fidx = fidx
 
-        # when to write to disk
-        self.chunksize = int(1e6) 
+        # how many reads to parse at once in the batched matcher.
+        self.batchsize = int(5e4)
+
+        # match i7+i5 in read names if the barcodes are dual indexes
+        self.dualindex = (
+            self.data.hackersonly.demultiplex_on_i7_tags and 
+            any("+" in i for i in self.data.barcodes.values())
+        )
         self.epid = os.getpid()
         self.filestat = np.zeros(3, dtype=int)
         
-        # store reads per sample (group technical replicates)
+        # technical replicates are matched to their own name in matchdict
+        # and their reads are routed to the merged sample {rname: sname}.
+        self.groups = bindex.groups
+
+        # store reads per sample (group technical replicates) and replicate
         self.samplehits = {}
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
+        self.rephits = {}
+        for rname, sname in self.groups.items():
             self.samplehits[sname] = 0
+            self.rephits[rname] = 0
 
         # store all barcodes observed
         self.barhits = {}
         for barc in self.matchdict:
             self.barhits[barc] = 0
 
-        # store reads and bars matched to samples
-        self.read1s = {} 
-        self.read2s = {} 
+        # store bars matched to samples
         self.dbars = {} 
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            self.read1s[sname] = []
-            self.read2s[sname] = []
+        for sname in self.groups.values():
             self.dbars[sname] = set()
 
+        # trims the reads of each sample before they are written
+        trimmers = None
+        if fused:
+            trimmers = {}
+            for sname in set(self.groups.values()):
+                sample = Sample(sname)
+                sample.barcode = get_sample_barcode(data, self.groups, sname)
+                trimmers[sname] = ReadTrimmer(copy.deepcopy(data), sample)
+
+        # buffers matched reads and writes them to sample files in a dir
+        # of parts that are appended to the final files when finished.
+        self.writer = SampleWriter(
+            os.path.join(
+                self.data.dirs.fastqs, 
+                "tmpdir",
+                "parts-{}-{}".format(self.fidx, self.epid)),
+            'pair' in self.data.params.datatype,
+            trimmers=trimmers,
+        )
+
         # store counts of what didn't match to samples
         self.misses = {}
         self.misses['_'] = 0
@@ -769,9 +924,51 @@ class BarMatch:
     def run(self):
         self.demux = self.get_matching_function()
         self.open_read_generators()
-        pkl = self.sort_reads()
+        if self.is_batchable():
+            ofile2 = (self.ofile2 if self.ftuple[1] else None)
+            self.sort_reads_batched(
+                iter_fastq_blocks(self.ofile1, ofile2, self.batchsize))
+        else:
+            self.sort_reads()
         self.close_read_generators()
-        return pkl
+        self.writer.close()
+        return self.dump_stats()
+
+
+    def run_stream(self, blocks):
+        """
+        Sorts reads from an iterator of (R1, R2) fastq blocks instead of 
+        from files. Used by the matching processes of barmatch_streaming.
+        """
+        self.demux = self.get_matching_function()
+        if self.is_batchable():
+            self.sort_reads_batched(blocks)
+        else:
+            self.quarts = iter_block_quarts(blocks)
+            self.sort_reads()
+        self.writer.close()
+        return self.dump_stats()
+
+
+    def is_batchable(self):
+        """
+        Barcodes at the start of R1 (fixed length, or variable length ending
+        at the cutter), or i7 (+i5) indexes in read names, can be found in a
+        block of reads at once. Other datatypes use the per-read parser.
+        """
+        if self.data.hackersonly.demultiplex_on_i7_tags:
+            maxlen = max(len(i) for i in self.data.barcodes.values())
+            return maxlen <= MAXPACKLEN
+        if self.longbar[0] > MAXPACKLEN:
+            return False
+        if self.longbar[1] != 'same':
+            if not any(self.cutters[0]):
+                return False
+        if self.data.params.datatype == '2brad':
+            return False
+        if '3rad' in self.data.params.datatype:
+            return False
+        return True
 
 
     def get_matching_function(self):
@@ -831,7 +1028,9 @@ class BarMatch:
 
             # i7 barcodes (get from name string instead of sequence)
             if self.data.hackersonly.demultiplex_on_i7_tags:
-                barcode = read1[0].decode().rsplit(":", 1)[-1].split("+")[0]
+                barcode = read1[0].decode().rsplit(":", 1)[-1].strip()
+                if not self.dualindex:
+                    barcode = barcode.split("+")[0]
 
             else:
                 # COMBINATORIAL BARCODES (BCODE1+BCODE2)
@@ -852,15 +1051,19 @@ class BarMatch:
                 pass          
 
             # find if it matches 
-            sname_match = self.matchdict.get(barcode)
+            rname_match = self.matchdict.get(barcode)
+
+            if rname_match:
 
-            if sname_match:
+                # merge technical replicates into their sample
+                sname_match = self.groups[rname_match]
 
                 # add to observed set of bars
                 self.dbars[sname_match].add(barcode)
                 self.filestat[1:] += 1
 
                 self.samplehits[sname_match] += 1
+                self.rephits[rname_match] += 1
                 self.barhits[barcode] += 1
                 if barcode in self.barhits:
                     self.barhits[barcode] += 1
@@ -895,39 +1098,109 @@ class BarMatch:
                     read2[1] = read2[1][lenbar2:]
                     read2[3] = read2[3][lenbar2:]
 
-                # append to sorted reads list
-                self.read1s[sname_match].append(b"".join(read1).decode())
+                # append to sorted reads buffer
                 if 'pair' in self.data.params.datatype:
-                    self.read2s[sname_match].append(b"".join(read2).decode())
+                    self.writer.add(
+                        sname_match, b"".join(read1), b"".join(read2))
+                else:
+                    self.writer.add(sname_match, b"".join(read1))
 
             else:
                 self.misses["_"] += 1
                 if barcode:
                     self.filestat[1] += 1
 
-            # Write to each sample file (pid's have different handles)
-            if not self.filestat[0] % int(1e6):
 
-                # write reads to file
-                write_to_file(self.data, self.read1s, 1, self.epid)
-                if 'pair' in self.data.params.datatype:
-                    write_to_file(self.data, self.read2s, 2, self.epid)
 
-                # clear out lits of sorted reads
-                for sname in self.data.barcodes:
-                    if "-technical-replicate-" in sname:
-                        sname = sname.rsplit("-technical-replicate", 1)[0]
-                    self.read1s[sname] = []
-                    self.read2s[sname] = []             
+    def sort_reads_batched(self, blocks):
+        """
+        Takes blocks of fastq records as contiguous buffers, slices the 
+        barcode of every read in the block at once, and resolves sample 
+        names with one lookup per unique barcode. Matched reads are then 
+        grouped by sample (keeping read order) and trimmed in one pass.
+        """
+        snames = self.bindex.snames
+        rnames = self.bindex.rnames
+        rgroups = self.bindex.rgroups
+        paired = 'pair' in self.data.params.datatype
+
+        for block1, block2 in blocks:
+            buf1 = np.frombuffer(block1, dtype=np.uint8)
+            lines1 = fastq_line_offsets(buf1)
+            nreads = lines1.shape[0]
+
+            # get packed barcodes for all reads in the block and look up 
+            # their samples in the compiled index.
+            if self.data.hackersonly.demultiplex_on_i7_tags:
+                keys, valid, empty = get_index_keys(
+                    buf1, lines1, self.dualindex)
+                trims = np.zeros(nreads, dtype=np.int64)
+            else:
+                keys, trims, valid, empty = get_barcode_keys(
+                    buf1, lines1, self.longbar, self.cutters)
+            # replicate indices are mapped to their sample's index so that
+            # merged replicates are grouped into one output stream.
+            ridxs, rpos = self.bindex.lookup(keys)
+            ridxs[~valid] = -1
+            matched = ridxs >= 0
+            nmatched = int(matched.sum())
+            rsids = np.where(matched, rgroups[ridxs], -1)
+
+            # fill stats: any non-empty barcode counts as 'found'. The 
+            # barhits are counted twice per read to match sort_reads().
+            self.filestat[0] += nreads
+            self.filestat[1] += nreads - int(empty.sum())
+            self.filestat[2] += nmatched
+            self.misses["_"] += nreads - nmatched
+            upos, ucounts = np.unique(rpos[matched], return_counts=True)
+            for pos, count in zip(upos, ucounts):
+                barcode = self.bindex.barcodes[pos]
+                rname = rnames[self.bindex.ridxs[pos]]
+                sname = self.groups[rname]
+                self.barhits[barcode] += 2 * int(count)
+                self.samplehits[sname] += int(count)
+                self.rephits[rname] += int(count)
+                self.dbars[sname].add(barcode)
+
+            # group matched reads by sample, stable to keep read order
+            midx = np.flatnonzero(matched)
+            order = midx[np.argsort(rsids[midx], kind="mergesort")]
+            scounts = np.bincount(rsids[midx], minlength=len(snames))
+
+            # trim barcodes and write grouped reads into one buffer
+            out1, bounds1 = gather_grouped_reads(
+                buf1, lines1, order, scounts, trims)
+            if paired:
+                buf2 = np.frombuffer(block2, dtype=np.uint8)
+                lines2 = fastq_line_offsets(buf2)
+                if lines2.shape[0] != nreads:
+                    raise IPyradError(
+                        "R1 and R2 files have different numbers of reads: {}"
+                        .format(self.ftuple))
+                out2, bounds2 = gather_grouped_reads(
+                    buf2, lines2, order, scounts, np.zeros_like(trims))
+
+            # store bytes of each sample to be written
+            for sidx in np.flatnonzero(scounts):
+                sname = snames[sidx]
+                if paired:
+                    self.writer.add(
+                        sname,
+                        out1[bounds1[sidx]:bounds1[sidx + 1]].tobytes(),
+                        out2[bounds2[sidx]:bounds2[sidx + 1]].tobytes(),
+                    )
+                else:
+                    self.writer.add(
+                        sname, out1[bounds1[sidx]:bounds1[sidx + 1]].tobytes())
 
-        ## write the remaining reads to file
-        write_to_file(self.data, self.read1s, 1, self.epid)
-        if 'pair' in self.data.params.datatype:
-            write_to_file(self.data, self.read2s, 2, self.epid)
 
+    def dump_stats(self):
         ## return stats in saved pickle b/c return_queue is too small
         ## and the size of the match dictionary can become quite large
-        samplestats = [self.samplehits, self.barhits, self.misses, self.dbars]
+        samplestats = [
+            self.samplehits, self.barhits, self.misses, self.dbars, 
+            self.rephits, self.writer.trimstats,
+        ]
         pklname = os.path.join(
             self.data.dirs.fastqs, 
             "tmpdir",
@@ -948,6 +1221,10 @@ class Stats:
         self.fsamplehits = Counter()
         self.fbarhits = Counter()
         self.fmisses = Counter()
+        self.freplicatehits = Counter()
+
+        # step 2 stats for each sample if trimmed while sorting
+        self.ftrimstats = {}
 
 
     def fill_from_pickle(self, pkl, handle):
@@ -960,11 +1237,14 @@ class Stats:
         self.perfile[handle] += filestats
 
         ## update sample stats
-        samplehits, barhits, misses, dbars = samplestats
+        samplehits, barhits, misses, dbars, rephits, trimstats = samplestats
         self.fsamplehits.update(samplehits)
         self.fbarhits.update(barhits)
         self.fmisses.update(misses)
         self.fdbars.update(dbars)
+        self.freplicatehits.update(rephits)
+        for sname, stats in trimstats.items():
+            self.ftrimstats.setdefault(sname, Counter()).update(stats)
 
 
 # -------------------------------------
@@ -974,11 +1254,114 @@ class Stats:
 def barmatch(args):
     # run procesor
     bar = BarMatch(*args)
-    # writes reads t ofile and writes stats to pickle
+    # writes reads to parts files and writes stats to pickle
     pkl = bar.run()
+    # append parts to sample files and record the chunk as finished
+    commit_parts(
+        bar.data, bar.fidx, [bar.writer.outdir], [pkl], bar.ftuple)
     return pkl
 
 
+def barmatch_streaming(args, nworkers):
+    """
+    Decompresses one raw file (pair) once in this process and hands blocks
+    of reads to nworkers BarMatch processes over a bounded queue. Each 
+    worker writes its own parts files and stats pickle, which are committed
+    together when the file is finished. Returns the list of stats pickles.
+    """
+    data, ftuple, longbar, cutters, bindex, jobid, fused = args
+    batchsize = int(5e4)
+
+    # start matching processes
+    blockq = mp.Queue(maxsize=2 * nworkers)
+    pklq = mp.Queue()
+
+    # don't hang at exit flushing blocks to workers that died. Blocks are 
+    # only dropped in this case since results wait on workers finishing.
+    blockq.cancel_join_thread()
+    workers = []
+    for widx in range(nworkers):
+        fidx = "{}-{}".format(jobid, widx)
+        proc = mp.Process(
+            target=stream_worker,
+            args=(
+                data, ftuple, longbar, cutters, bindex, fidx, fused, 
+                blockq, pklq),
+        )
+        proc.start()
+        workers.append(proc)
+
+    # read and send blocks, then one stop signal per worker
+    ofile1 = open_fastq(ftuple[0])
+    ofile2 = (open_fastq(ftuple[1]) if ftuple[1] else None)
+    try:
+        for blocks in iter_fastq_blocks(ofile1, ofile2, batchsize):
+            put_block(blockq, blocks, workers, ftuple)
+        for _ in workers:
+            put_block(blockq, None, workers, ftuple)
+    finally:
+        ofile1.close()
+        if ofile2:
+            ofile2.close()
+
+    # collect stats pickles and parts dirs
+    results = []
+    while len(results) < len(workers):
+        try:
+            results.append(pklq.get(timeout=5))
+        except queue.Empty:
+            check_workers(workers, ftuple)
+    for proc in workers:
+        proc.join()
+
+    # append parts to sample files and record the file as finished
+    pkls = [i[0] for i in results]
+    commit_parts(data, jobid, [i[1] for i in results], pkls, ftuple)
+    return pkls
+
+
+def put_block(blockq, blocks, workers, ftuple):
+    "put on the bounded queue, checking that workers are still taking"
+    while 1:
+        try:
+            blockq.put(blocks, timeout=5)
+            return
+        except queue.Full:
+            check_workers(workers, ftuple)
+
+
+def check_workers(workers, ftuple):
+    "raise if a matching process died, rather than wait on its queue"
+    for proc in workers:
+        if (not proc.is_alive()) and proc.exitcode:
+            for other in workers:
+                other.terminate()
+            raise IPyradError(
+                "error in barmatch_streaming worker on {}".format(ftuple[0]))
+
+
+def stream_worker(
+    data, ftuple, longbar, cutters, bindex, fidx, fused, blockq, pklq):
+    "Run BarMatch on blocks pulled from blockq until a None is received"
+    bar = BarMatch(data, ftuple, longbar, cutters, bindex, fidx, fused)
+    pklq.put((bar.run_stream(iter(blockq.get, None)), bar.writer.outdir))
+
+
+def iter_block_quarts(blocks):
+    "Yields per-read (R1, R2) line tuples from (R1, R2) fastq blocks"
+    for block1, block2 in blocks:
+        fr1 = iter(io.BytesIO(block1))
+        quart1 = izip(fr1, fr1, fr1, fr1)
+        if block2:
+            fr2 = iter(io.BytesIO(block2))
+            quart2 = izip(fr2, fr2, fr2, fr2)
+            for quarts in izip(quart1, quart2):
+                yield quarts
+        else:
+            for quart in quart1:
+                yield quart, 0
+
+
 # CALLED BY FILELINKER
 def get_name_from_file(fname, splitnames, fields):
     "Grab Sample names from demultiplexed input fastq file names"
@@ -1024,22 +1407,6 @@ def get_name_from_file(fname, splitnames, fields):
     return base
 
 
-def zbufcountlines(filename, gzipped):
-    "Fast line counter using unix utils"
-    if gzipped:
-        cmd1 = ["gunzip", "-c", filename]
-    else:
-        cmd1 = ["cat", filename]
-    cmd2 = ["wc"]
-    proc1 = sps.Popen(cmd1, stdout=sps.PIPE, stderr=sps.PIPE)
-    proc2 = sps.Popen(cmd2, stdin=proc1.stdout, stdout=sps.PIPE, stderr=sps.PIPE)
-    res = proc2.communicate()[0]
-    if proc2.returncode:
-        raise IPyradError("error zbufcountlines {}:".format(res))
-    nlines = int(res.split()[0])
-    return nlines
-
-
 def find3radbcode(cutters, longbar, read):
     "find barcode sequence in the beginning of read"
     # default barcode string
@@ -1099,107 +1466,758 @@ def getbarcode3(cutters, read1, longbar):
     return barcode[0] 
 
 
-
-def write_to_file(data, dsort, read, pid):
-    "Writes sorted data to tmp files"
-    if read == 1:
-        rrr = "R1"
+def get_barcode_keys(buf, lines, longbar, cutters):
+    """
+    Finds the barcode at the start of every read in a fastq buffer and 
+    returns it as a packed integer key (see pack_barcode), the barcode 
+    lengths, a mask of reads with a valid barcode, and a mask of reads 
+    with an empty barcode. Fixed-length barcodes are sliced at a fixed 
+    offset. Variable-length barcodes end at the last occurrence of the 
+    first cutter (in order) found in the first longbar + len(cutter) + 1
+    bases, the same as getbarcode3(). Barcodes with bases other than CATGN
+    are not valid.
+    """
+    nreads = lines.shape[0]
+    seqlens = lines[:, 2] - lines[:, 1] - 1
+    if longbar[1] == 'same':
+        width = longbar[0]
+    else:
+        width = longbar[0] + max(len(i) for i in cutters[0]) + 1
+
+    # window of the first bases of each read, zeroed past the read end
+    cols = np.arange(width)
+    window = buf[np.minimum(lines[:, 1, None] + cols, buf.size - 1)]
+    window[cols >= seqlens[:, None]] = 0
+
+    # get barcode lengths
+    if longbar[1] == 'same':
+        blens = np.repeat(longbar[0], nreads)
+        valid = seqlens >= longbar[0]
+        empty = np.zeros(nreads, dtype=np.bool_)
     else:
-        rrr = "R2"
+        blens = np.zeros(nreads, dtype=np.int64)
+        valid = np.zeros(nreads, dtype=np.bool_)
+        for cutter in cutters[0]:
+            if not cutter:
+                continue
+            cut = np.frombuffer(cutter.encode(), dtype=np.uint8)
+            pos, found = find_last_cutter(window, cut)
+            found &= ~valid
+            blens[found] = pos[found]
+            valid |= found
+        empty = valid & (blens == 0)
+        valid &= ~empty
 
-    # appends to file for each sample, avoids parallel fighting by using 
-    # pid assigned file handle.
-    for sname in dsort:
+    # pack the prefix of each read and select its barcode length
+    keys, packed = pack_prefixes(window, blens)
+    valid &= packed
+    return keys, blens, valid, empty
 
-        # file out handle
-        handle = os.path.join(
-            data.dirs.fastqs, 
-            "tmpdir",
-            "tmp_{}_{}_{}.fastq".format(sname, rrr, pid))
 
-        # append to this sample name
-        with open(handle, 'a') as out:
-            out.write("".join(dsort[sname]))
+def get_index_keys(buf, lines, dual):
+    """
+    Finds the index field after the last ':' of every read name in a 
+    fastq buffer (only the i7 part before a '+' unless dual) and returns
+    it as a packed integer key, a mask of valid keys, and a mask of reads
+    with an empty index.
+    """
+    keys = np.zeros(lines.shape[0], dtype=np.int64)
+    valid = np.zeros(lines.shape[0], dtype=np.bool_)
+    empty = np.zeros(lines.shape[0], dtype=np.bool_)
+    fill_index_keys(buf, lines, dual, BASECODES, MAXPACKLEN, keys, valid, empty)
+    return keys, valid, empty
+
+
+@njit
+def fill_index_keys(buf, lines, dual, codes, maxlen, keys, valid, empty):
+    "scans read names from the end for the index field and packs it"
+    for idx in range(lines.shape[0]):
+        # end of the name w/o newline, \r or trailing spaces
+        end = lines[idx, 1] - 1
+        while end > lines[idx, 0] and (buf[end - 1] == 13 or buf[end - 1] == 32):
+            end -= 1
+
+        # back up to the last colon
+        start = end
+        while start > lines[idx, 0] and buf[start - 1] != 58:
+            start -= 1
+
+        # i7 only ends at the '+'
+        if not dual:
+            for pos in range(start, end):
+                if buf[pos] == 43:
+                    end = pos
+                    break
 
+        if end == start:
+            empty[idx] = True
+            continue
+        if end - start > maxlen:
+            continue
+
+        key = 1
+        ok = True
+        for pos in range(start, end):
+            code = codes[buf[pos]]
+            if code == 7:
+                ok = False
+            key = (key << 3) | code
+        keys[idx] = key
+        valid[idx] = ok
+
+
+def find_last_cutter(window, cut):
+    "returns start of the last occurrence of cut in each row, and a mask"
+    npos = window.shape[1] - cut.size + 1
+    hits = np.ones((window.shape[0], npos), dtype=np.bool_)
+    for idx in range(cut.size):
+        hits &= window[:, idx:idx + npos] == cut[idx]
+    found = hits.any(axis=1)
+    pos = npos - 1 - np.argmax(hits[:, ::-1], axis=1)
+    return pos, found
+
+
+def pack_prefixes(window, blens):
+    """
+    Packs the first blens[i] bases of each row of a uint8 window into an
+    integer key, and returns the keys and a mask of rows that contained
+    only CATGN in that prefix.
+    """
+    nreads, width = window.shape
+    codes = BASECODES[window]
+    keys = np.zeros(nreads, dtype=np.int64)
+    packed = np.ones(nreads, dtype=np.bool_)
+    for col in range(width):
+        inbar = col < blens
+        keys[inbar] = (keys[inbar] << 3) | codes[inbar, col]
+        packed[inbar & (codes[:, col] == 7)] = False
+    keys |= (np.int64(1) << (3 * blens))
+    return keys, packed
+
+
+def pack_barcode(barcode):
+    """
+    Returns a barcode string packed 3 bits per base (A, C, G, T, N, +) into an
+    integer, with a leading 1 bit marking its length, or -1 if it contains
+    other characters or is too long.
+    """
+    if len(barcode) > MAXPACKLEN:
+        return -1
+    key = 1
+    for base in barcode:
+        if ord(base) > 255:
+            return -1
+        code = BASECODES[ord(base)]
+        if code == 7:
+            return -1
+        key = (key << 3) | int(code)
+    return key
+
+
+def gather_grouped_reads(buf, lines, order, scounts, trims):
+    """
+    Returns a buffer of the records in 'order' with trims[i] bases removed 
+    from the start of the seq and qual lines of read i, and the byte 
+    boundaries of each sample group in it.
+    """
+    reclens = lines[order, 4] - lines[order, 0] - (2 * trims[order])
+    ends = np.zeros(order.size + 1, dtype=np.int64)
+    ends[1:] = np.cumsum(reclens)
+    bounds = ends[np.concatenate(([0], np.cumsum(scounts)))]
+    out = np.empty(ends[-1], dtype=np.uint8)
+    fill_trimmed_records(buf, lines, order, trims, out)
+    return out, bounds
+
+
+@njit
+def fill_trimmed_records(buf, lines, order, trims, out):
+    "copies records in order into out with barcodes trimmed from seq/qual"
+    pos = 0
+    for idx in order:
+        trim = trims[idx]
+        # header line
+        nbytes = lines[idx, 1] - lines[idx, 0]
+        out[pos:pos + nbytes] = buf[lines[idx, 0]:lines[idx, 1]]
+        pos += nbytes
+        # seq line w/o barcode and '+' line
+        nbytes = lines[idx, 3] - lines[idx, 1] - trim
+        out[pos:pos + nbytes] = buf[lines[idx, 1] + trim:lines[idx, 3]]
+        pos += nbytes
+        # qual line w/o barcode
+        nbytes = lines[idx, 4] - lines[idx, 3] - trim
+        out[pos:pos + nbytes] = buf[lines[idx, 3] + trim:lines[idx, 4]]
+        pos += nbytes
+
+
+class BarcodeIndex:
+    """
+    Compiled lookup of every allowed barcode and its mismatch neighbours,
+    with the same sample assignments (and collision warnings) as 
+    inverse_barcodes(). Barcodes are stored as sorted packed integer keys 
+    so that a whole block of reads is looked up at once, by direct index
+    into a key table when all barcodes are short (<8 bases) or else in an
+    open addressing hash table of the keys. The index is cached in the 
+    project dir keyed by a hash of the barcodes file and the params that
+    change it, so re-runs skip the build.
+    """
+    def __init__(self, matchdict):
+        # the full dict is still used by the per-read parser and for stats
+        self.matchdict = matchdict
+
+        # barcodes match to replicate names, which are merged into samples
+        # by the int map rgroups (replicate index -> sample index).
+        self.rnames = sorted(set(matchdict.values()))
+        self.groups = get_replicate_groups(self.rnames)
+        self.snames = sorted(set(self.groups.values()))
+        sidxs = {sname: idx for idx, sname in enumerate(self.snames)}
+        ridxs = {rname: idx for idx, rname in enumerate(self.rnames)}
+        self.rgroups = np.array(
+            [sidxs[self.groups[i]] for i in self.rnames], dtype=np.int64)
+
+        # barcodes w/ ambiguous bases (or 3rad pairs) are not packed since 
+        # they are only looked up by the per-read parser.
+        packed = [
+            (pack_barcode(bar), bar, ridxs[rname]) 
+            for (bar, rname) in matchdict.items()
+        ]
+        packed = sorted(i for i in packed if i[0] >= 0)
+        self.keys = np.array([i[0] for i in packed], dtype=np.int64)
+        self.barcodes = [i[1] for i in packed]
+        self.ridxs = np.array([i[2] for i in packed], dtype=np.int64)
+
+        # short barcodes are looked up in a table indexed by key, which 
+        # maps to the position of the key in the index (-1 if absent).
+        # Longer ones are hashed into a table of at least twice the keys.
+        self.table = None
+        self.slots = None
+        if self.keys.size and self.keys[-1] < MAXTABLEKEY:
+            self.table = np.full(self.keys[-1] + 1, -1, dtype=np.int64)
+            self.table[self.keys] = np.arange(self.keys.size)
+        elif self.keys.size:
+            nslots = 1 << int(2 * self.keys.size).bit_length()
+            self.slots = np.full(nslots, -1, dtype=np.int64)
+            fill_key_slots(self.keys, self.slots)
+
+
+    @classmethod
+    def from_data(cls, data):
+        "load the index from the cache file or build and cache it"
+        cachefile = os.path.join(
+            data.params.project_dir, 
+            "barcode_index_{}.npz".format(barcodes_hash(data)))
+        if os.path.exists(cachefile):
+            try:
+                with np.load(cachefile) as cached:
+                    matchdict = dict(zip(
+                        cached["barcodes"].tolist(), 
+                        cached["snames"].tolist()))
+                    warnings = cached["warnings"].tolist()
+                # re-emit the collision warnings of the build
+                for message in warnings:
+                    print(message)
+                return cls(matchdict)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
 
+        # build and write to a tmp file that is moved when complete
+        warnings = []
+        bindex = cls(inverse_barcodes(data, warnings))
+        tmpfile = cachefile + ".tmp.{}.npz".format(os.getpid())
+        np.savez(
+            tmpfile,
+            barcodes=np.array(list(bindex.matchdict.keys()), dtype=str),
+            snames=np.array(list(bindex.matchdict.values()), dtype=str),
+            warnings=np.array(warnings, dtype=str),
+        )
+        os.rename(tmpfile, cachefile)
+        return bindex
 
-def collate_files(data, sname, tmp1s, tmp2s):
+
+    def lookup(self, keys):
+        """
+        Returns the replicate index of each key (-1 if not a barcode) and 
+        the position of the key in the index.
+        """
+        if not self.keys.size:
+            return np.repeat(-1, keys.size), np.zeros(keys.size, dtype=int)
+        if self.table is not None:
+            inrange = (keys > 0) & (keys < self.table.size)
+            pos = self.table[np.where(inrange, keys, 0)]
+            pos[~inrange] = -1
+            ridxs = np.where(pos >= 0, self.ridxs[pos], -1)
+            return ridxs, np.maximum(pos, 0)
+        pos = np.empty(keys.size, dtype=np.int64)
+        find_key_slots(self.keys, self.slots, keys, pos)
+        ridxs = np.where(pos >= 0, self.ridxs[pos], -1)
+        return ridxs, np.maximum(pos, 0)
+
+
+@njit
+def hash_key(key, mask):
+    "Fibonacci hash of a packed barcode key into a slot in [0, mask]"
+    return ((np.uint64(key) * np.uint64(0x9E3779B97F4A7C15)) >> 32) & mask
+
+
+@njit
+def fill_key_slots(keys, slots):
+    "stores the position of each key in slots by linear probing"
+    mask = np.uint64(slots.size - 1)
+    for pos in range(keys.size):
+        slot = hash_key(keys[pos], mask)
+        while slots[slot] >= 0:
+            slot = (slot + np.uint64(1)) & mask
+        slots[slot] = pos
+
+
+@njit
+def find_key_slots(keys, slots, query, out):
+    "fills out with the position of each query key in keys, or -1"
+    mask = np.uint64(slots.size - 1)
+    for idx in range(query.size):
+        slot = hash_key(query[idx], mask)
+        out[idx] = -1
+        while slots[slot] >= 0:
+            if keys[slots[slot]] == query[idx]:
+                out[idx] = slots[slot]
+                break
+            slot = (slot + np.uint64(1)) & mask
+
+
+def barcodes_hash(data):
+    """
+    md5 of the barcodes file and the params that change the matching 
+    barcodes (mismatches, replicate labels, datatype).
+    """
+    md5 = hashlib.md5()
+    if os.path.exists(data.params.barcodes_path):
+        with open(data.params.barcodes_path, 'rb') as infile:
+            md5.update(infile.read())
+    md5.update(repr(sorted(data.barcodes.items())).encode())
+    md5.update(repr(data.params.max_barcode_mismatch).encode())
+    md5.update(repr(data.params.datatype).encode())
+    md5.update(BARCODE_INDEX_VERSION.encode())
+    return md5.hexdigest()
+
+
+def get_sample_barcode(data, groups, sname):
+    "Returns the barcode of a sample, or a list of its replicates' barcodes"
+    barcodes = [
+        data.barcodes[i] for i in groups if groups[i] == sname and i != sname
+    ]
+    if barcodes:
+        return barcodes
+    return data.barcodes[sname]
+
+
+def get_replicate_groups(names):
+    """
+    Returns an ordered dict mapping each sample name to the name of the 
+    sample it is merged into, removing -technical-replicate-N if present.
+    Replicates of a sample are ordered by N.
+    """
+    def sortkey(name):
+        if "-technical-replicate-" in name:
+            sname, rep = name.rsplit("-technical-replicate-", 1)
+            if rep.isdigit():
+                return (sname, int(rep))
+        return (name, -1)
+
+    groups = OrderedDict()
+    for name in sorted(names, key=sortkey):
+        if "-technical-replicate-" in name:
+            groups[name] = name.rsplit("-technical-replicate", 1)[0]
+        else:
+            groups[name] = name
+    return groups
+
+
+class SampleWriter:
+    """
+    Buffers matched reads for each sample and appends them to 
+    {sname}_R1_.fastq.gz (and _R2_) files in outdir as gzip members when a
+    sample's buffer is full. Each process writes its own outdir, which is
+    appended to the final sample files by commit_parts(). A limited number
+    of file handles is kept open, closing the least recently used. If 
+    trimmers {sname: ReadTrimmer} are given, buffers are trimmed and 
+    filtered as in step 2 and written as {sname}.trimmed_R1_.fastq.gz.
+    """
+    def __init__(self, outdir, paired, maxbuf=int(2e6), maxtotal=int(2.5e8), 
+        maxopen=64, compresslevel=6, trimmers=None):
+
+        self.outdir = outdir
+        self.paired = paired
+        self.maxbuf = maxbuf
+        self.maxtotal = maxtotal
+        self.maxopen = maxopen
+        self.compresslevel = compresslevel
+
+        # {sname: [bytes, ...]} and their sizes
+        self.buf1 = {}
+        self.buf2 = {}
+        self.bufsize = {}
+        self.total = 0
+
+        # {sname: (R1 handle, R2 handle)} in order of last use
+        self.handles = OrderedDict()
+
+        # {sname: ReadTrimmer} and {sname: Counter} of their s2 stats
+        self.trimmers = trimmers
+        self.trimstats = {}
+        self.fname = "{}_R{}_.fastq.gz"
+        if self.trimmers:
+            self.fname = "{}.trimmed_R{}_.fastq.gz"
+
+
+    def add(self, sname, read1, read2=b""):
+        "store bytes of one or more fastq records for a sample"
+        if sname not in self.buf1:
+            self.buf1[sname] = []
+            self.buf2[sname] = []
+            self.bufsize[sname] = 0
+        self.buf1[sname].append(read1)
+        self.buf2[sname].append(read2)
+        nbytes = len(read1) + len(read2)
+        self.bufsize[sname] += nbytes
+        self.total += nbytes
+
+        # write this sample, or all samples if total memory is too big
+        if self.bufsize[sname] >= self.maxbuf:
+            self.flush(sname)
+        if self.total >= self.maxtotal:
+            self.flush_all()
+
+
+    def flush(self, sname):
+        "compress and append the buffered reads for one sample"
+        if not self.bufsize.get(sname):
+            return
+        block1 = b"".join(self.buf1[sname])
+        block2 = b"".join(self.buf2[sname])
+        if self.trimmers:
+            arrs, stats = self.trimmers[sname].trim(block1, block2)
+            self.trimstats.setdefault(sname, Counter()).update(stats)
+            block1 = arrs[0].tobytes()
+            block2 = (arrs[1].tobytes() if self.paired else b"")
+        member1 = self.compress(block1)
+        member2 = b""
+        if self.paired:
+            member2 = self.compress(block2)
+
+        out1, out2 = self.get_handles(sname)
+        out1.write(member1)
+        if self.paired:
+            out2.write(member2)
+
+        self.total -= self.bufsize[sname]
+        self.buf1[sname] = []
+        self.buf2[sname] = []
+        self.bufsize[sname] = 0
+
+
+    def flush_all(self):
+        for sname in list(self.bufsize):
+            self.flush(sname)
+
+
+    def close(self):
+        "write all remaining reads and close files"
+        self.flush_all()
+        while self.handles:
+            self.close_handles(next(iter(self.handles)))
+
+
+    def compress(self, data):
+        "return data as a complete gzip member"
+        zobj = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 31)
+        return zobj.compress(data) + zobj.flush()
+
+
+    def get_handles(self, sname):
+        "return open append handles for a sample, closing the oldest"
+        if sname in self.handles:
+            handles = self.handles.pop(sname)
+        else:
+            if len(self.handles) >= self.maxopen:
+                self.close_handles(next(iter(self.handles)))
+            if not os.path.exists(self.outdir):
+                os.makedirs(self.outdir)
+            out1 = open(os.path.join(
+                self.outdir, self.fname.format(sname, 1)), 'ab')
+            out2 = None
+            if self.paired:
+                out2 = open(os.path.join(
+                    self.outdir, self.fname.format(sname, 2)), 'ab')
+            handles = (out1, out2)
+        self.handles[sname] = handles
+        return handles
+
+
+    def close_handles(self, sname):
+        out1, out2 = self.handles.pop(sname)
+        out1.close()
+        if out2:
+            out2.close()
+
+
+
+def journal_append(journal, record):
+    "append a json record to the step 1 journal while holding its lock"
+    with open(journal, 'a') as jfile:
+        fcntl.flock(jfile, fcntl.LOCK_EX)
+        try:
+            jfile.write(json.dumps(record) + "\n")
+            jfile.flush()
+            os.fsync(jfile.fileno())
+        finally:
+            fcntl.flock(jfile, fcntl.LOCK_UN)
+
+
+def commit_parts(data, jobid, partdirs, pkls, source):
+    """
+    Adds the parts files written for one job (a chunk or a raw file) to 
+    the final sample files (trimmed edits of fused runs go to the edits
+    dir). Holding the journal lock, a part that starts a sample file is 
+    moved into place, and each other part reserves a byte range at the 
+    end of its sample file, and the job is recorded as begun. Parts are 
+    then copied into their ranges without the lock, so that jobs copy 
+    in parallel, and the job is recorded as done with its stats pickles.
+    recover_journal() finishes commits that were interrupted.
+    """
+    journal = os.path.join(data.dirs.fastqs, "tmpdir", "s1_journal.txt")
+    parts = []
+    for partdir in partdirs:
+        if os.path.exists(partdir):
+            for fname in sorted(os.listdir(partdir)):
+                outdir = data.dirs.fastqs
+                if ".trimmed_R" in fname:
+                    outdir = data.dirs.edits
+                parts.append((
+                    os.path.join(partdir, fname),
+                    os.path.join(outdir, fname),
+                ))
+
+    # parts must survive a crash to finish the commit from them
+    for part, _ in parts:
+        sync_file(part)
+
+    with open(journal, 'a') as jfile:
+        fcntl.flock(jfile, fcntl.LOCK_EX)
+        try:
+            moves, ranges, ends = plan_commit(parts)
+            jfile.write(json.dumps({
+                "begin": jobid, "moves": moves, "ranges": ranges, 
+                "pkls": pkls, "source": list(source)}) + "\n")
+            jfile.flush()
+            os.fsync(jfile.fileno())
+            for part, final, _ in moves:
+                os.rename(part, final)
+            for final, end in ends.items():
+                with open(final, 'ab') as out:
+                    out.truncate(end)
+        finally:
+            fcntl.flock(jfile, fcntl.LOCK_UN)
+
+    for part, final, offset, size in ranges:
+        copy_range(part, final, offset, size)
+    journal_append(
+        journal, {"done": jobid, "pkls": pkls, "source": list(source)})
+
+    for partdir in partdirs:
+        if os.path.exists(partdir):
+            shutil.rmtree(partdir)
+
+
+def plan_commit(parts):
+    """
+    Returns the parts [(part, final, size)] to move to final files that
+    do not exist yet (if on the same filesystem), the parts [(part, final,
+    offset, size)] to copy into ranges at the end of the final files, and
+    the end of each final file with its ranges {final: end}.
+    """
+    moves = []
+    ranges = []
+    ends = {}
+    for part, final in parts:
+        size = os.path.getsize(part)
+        if final not in ends and os.path.exists(final):
+            ends[final] = os.path.getsize(final)
+        if final in ends:
+            ranges.append((part, final, ends[final], size))
+            ends[final] += size
+        elif same_device(part, final):
+            moves.append((part, final, size))
+            ends[final] = size
+        else:
+            ranges.append((part, final, 0, size))
+            ends[final] = size
+
+    # only files with ranges need to be extended
+    ranged = set(i[1] for i in ranges)
+    ends = {i: j for (i, j) in ends.items() if i in ranged}
+    return moves, ranges, ends
+
+
+def same_device(part, final):
+    "True if a part can be renamed to final"
+    pdev = os.stat(os.path.dirname(part)).st_dev
+    return pdev == os.stat(os.path.dirname(final)).st_dev
+
+
+def sync_file(path):
+    "flush a file to disk"
+    with open(path, 'rb') as infile:
+        os.fsync(infile.fileno())
+
+
+def copy_range(part, final, offset, size):
+    """
+    Copies a part into the byte range reserved for it in a final file, 
+    in the kernel where possible, and flushes it to disk.
+    """
+    done = 0
+    with open(part, 'rb') as infile:
+        with open(final, 'r+b') as out:
+            if hasattr(os, "copy_file_range"):
+                try:
+                    while done < size:
+                        nbytes = os.copy_file_range(
+                            infile.fileno(), out.fileno(), size - done, 
+                            done, offset + done)
+                        if not nbytes:
+                            break
+                        done += nbytes
+                except OSError:
+                    pass
+
+            # the rest (or all) of it through python
+            infile.seek(done)
+            out.seek(offset + done)
+            while done < size:
+                chunk = infile.read(min(size - done, int(2 ** 22)))
+                if not chunk:
+                    break
+                out.write(chunk)
+                done += len(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+    if done < size:
+        raise IPyradError(
+            "parts file {} is shorter than its range in {}"
+            .format(part, final))
+
+
+def recover_journal(journal):
+    """
+    Reads the step 1 journal of an interrupted run and returns the jobs
+    that were done {jobid: [pkls]}, the split raw files {handle: chunks},
+    and the chunking plan. Commits that were begun but did not finish are
+    completed from their parts files, and parts files of jobs that did 
+    not begin to commit are removed.
+    """
+    jobsdone = {}
+    splits = {}
+    plan = None
+    begun = OrderedDict()
+    reserved = {}
+    if not os.path.exists(journal):
+        return jobsdone, splits, plan
+
+    with open(journal, 'r') as jfile:
+        for line in jfile:
+            # a partly written last line is ignored
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "plan" in record:
+                plan = record["plan"]
+            elif "split" in record:
+                splits[record["split"]] = record["chunks"]
+            elif "begin" in record:
+                begun[record["begin"]] = record
+                for _, final, size in record["moves"]:
+                    reserved.setdefault(final, []).append(
+                        (record["begin"], 0, size))
+                for _, final, offset, size in record["ranges"]:
+                    reserved.setdefault(final, []).append(
+                        (record["begin"], offset, size))
+            elif "done" in record:
+                begun.pop(record["done"], None)
+                jobsdone[record["done"]] = record["pkls"]
+
+    # finish the commits that were interrupted
+    for jobid, record in begun.items():
+        finish_commit(journal, record, reserved)
+        jobsdone[jobid] = record["pkls"]
+
+    # remove outputs of jobs that did not get to commit
+    tmpdir = os.path.dirname(journal)
+    for partdir in glob.glob(os.path.join(tmpdir, "parts-*")):
+        shutil.rmtree(partdir)
+    return jobsdone, splits, plan
+
+
+def finish_commit(journal, record, reserved):
+    """
+    Completes an interrupted commit_parts() from its parts files: parts 
+    that were not moved are moved (or appended if another job has since
+    started the file), and ranges are copied again. A range that was not
+    reserved before the job was interrupted, and was then reserved by 
+    another job, cannot be recovered.
+    """
+    jobid = record["begin"]
+    for part, final, _ in record["moves"]:
+        if not os.path.exists(part):
+            continue
+        if not os.path.exists(final):
+            os.rename(part, final)
+        else:
+            offset = os.path.getsize(final)
+            size = os.path.getsize(part)
+            with open(final, 'ab') as out:
+                out.truncate(offset + size)
+            copy_range(part, final, offset, size)
+
+    for part, final, offset, size in record["ranges"]:
+        clash = [
+            i for i in reserved.get(final, []) if i[0] != jobid and 
+            i[1] < offset + size and offset < i[1] + i[2]
+        ]
+        if clash or not os.path.exists(part) or (
+                os.path.getsize(part) != size):
+            raise IPyradError(
+                "Cannot resume step 1: the interrupted commit of {} to {} "
+                "cannot be completed: use force to restart"
+                .format(jobid, final))
+        if os.path.getsize(final) < offset + size:
+            with open(final, 'ab') as out:
+                out.truncate(offset + size)
+        copy_range(part, final, offset, size)
+    journal_append(
+        journal, {"done": jobid, "pkls": record["pkls"], 
+            "source": record["source"]})
+
+
+def inverse_barcodes(data, warnings=None):
     """ 
-    Collate temp fastq files in tmp-dir into 1 gzipped sample.
+    Build full inverse barcodes dictionary. Barcode collision warnings are
+    printed, and also appended to the list 'warnings' if one is entered.
     """
-    ## out handle
-    out1 = os.path.join(data.dirs.fastqs, "{}_R1_.fastq.gz".format(sname))
-    out = io.BufferedWriter(gzip.open(out1, 'w'))
-
-    ## build cmd
-    cmd1 = ['cat']
-    for tmpfile in tmp1s:
-        cmd1 += [tmpfile]
-
-    ## compression function
-    proc = sps.Popen(['which', 'pigz'], 
-        stderr=sps.PIPE, 
-        stdout=sps.PIPE).communicate()
-    if proc[0].strip():
-        compress = ["pigz"]
-    else:
-        compress = ["gzip"]
+    def warn(message):
+        print(message)
+        if warnings is not None:
+            warnings.append(message)
 
-    ## call cmd
-    proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-    proc2 = sps.Popen(compress, 
-        stdin=proc1.stdout, 
-        stderr=sps.PIPE, 
-        stdout=out)
-    err = proc2.communicate()
-    if proc2.returncode:
-        raise IPyradError("error in collate_files R1 %s", err)
-    proc1.stdout.close()
-    out.close()
-
-    ## then cleanup
-    for tmpfile in tmp1s:
-        os.remove(tmpfile)
-
-    if 'pair' in data.params.datatype:
-        ## out handle
-        out2 = os.path.join(data.dirs.fastqs, "{}_R2_.fastq.gz".format(sname))
-        out = io.BufferedWriter(gzip.open(out2, 'w'))
-
-        ## build cmd
-        cmd1 = ['cat']
-        for tmpfile in tmp2s:
-            cmd1 += [tmpfile]
-
-        ## call cmd
-        proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-        proc2 = sps.Popen(compress, 
-            stdin=proc1.stdout,
-            stderr=sps.PIPE, 
-            stdout=out)
-        err = proc2.communicate()
-        if proc2.returncode:
-            raise IPyradError("error in collate_files R2 %s", err)
-        proc1.stdout.close()
-        out.close()
-
-        ## then cleanup
-        for tmpfile in tmp2s:
-            os.remove(tmpfile)
-
-
-def inverse_barcodes(data):
-    """ Build full inverse barcodes dictionary """
     matchdict = {}
     bases = set("CATGN")
     poss = set()
 
+    # technical replicates keep their own names here, but barcodes that
+    # are close to a replicate of the same sample are not a conflict.
+    groups = get_replicate_groups(data.barcodes)
+
     # do perfect matches
     for sname, barc in data.barcodes.items():
-        
-        # remove -technical-replicate-N if present
-        if "-technical-replicate-" in sname:
-            sname = sname.rsplit("-technical-replicate", 1)[0]
 
         # store {barcode: name} mapping
         matchdict[barc] = sname
@@ -1229,7 +2247,7 @@ def inverse_barcodes(data):
 
                     # if it has been seen in another taxon, problem.
                     else:
-                        print("""\n
+                        warn("""\n
         Warning: 
         Sample: {} ({})
         is within {} base changes of sample ({})
@@ -1258,8 +2276,9 @@ def inverse_barcodes(data):
                                     matchdict[tbar2] = sname                    
                                     poss.add(tbar2)
                                 else:
-                                    if matchdict.get(tbar2) != sname:
-                                        print("""\
+                                    other = matchdict.get(tbar2)
+                                    if groups.get(other) != groups[sname]:
+                                        warn("""\
         Note: barcodes {}:{} and {}:{} are within {} base change of each other\
              Ambiguous barcodes that match to both samples will arbitrarily
              be assigned to the first sample. If you do not like this idea 
@@ -1270,43 +2289,23 @@ def inverse_barcodes(data):
     return matchdict
 
 
-def estimate_nreads(data, testfile):
+def estimate_nreads(testfile):
     """ 
-    Estimate a reasonable optim value by grabbing a chunk of sequences, 
-    decompressing and counting them, to estimate the full file size.
+    Estimate a reasonable optim value by reading the first 10000 reads 
+    and dividing the file size by the compressed bytes they used.
     """
-    ## count the len of one file and assume all others are similar len
-    insize = os.path.getsize(testfile)
-    tmp_file_name = os.path.join(
-        data.params.project_dir, 
-        "tmp-step1-count.fq")
-
-    if testfile.endswith(".gz"):
-        infile = gzip.open(testfile)
-        outfile = gzip.open(tmp_file_name, 'w', compresslevel=5)
-    else:
-        infile = open(testfile)
-        outfile = open(tmp_file_name, 'w')
-        
-    ## We'll take the average of the size of a file based on the
-    ## first 10000 reads to approximate number of reads in the main file
-    try:
-        dat = b"".join(islice(infile, 40000))
-    except TypeError:
-        dat = "".join(islice(infile, 40000))
-    outfile.write(dat)
-    outfile.close()
-    infile.close()
-
-    ## Get the size of the tmp file
-    tmp_size = os.path.getsize(tmp_file_name)
-
-    # divide by the tmp file size and multiply by 10000 to approximate
-    # the size of the input .fq files
-    inputreads = int(insize / tmp_size) * 10000
-    os.remove(tmp_file_name)
+    with open(testfile, 'rb') as rawfile:
+        if testfile.endswith(".gz"):
+            infile = gzip.GzipFile(fileobj=rawfile)
+        else:
+            infile = rawfile
+        nlines = sum(1 for _ in islice(infile, 40000))
+        used = rawfile.tell()
 
-    return inputreads
+    # the whole file was read
+    if nlines < 40000:
+        return nlines // 4
+    return int(os.path.getsize(testfile) / used * 10000)
 
 
 # used by splitfiles()
@@ -1378,6 +2377,21 @@ def zcat_make_temps(data, ftup, num, tmpdir, optim, start):
 
 
 ## GLOBALS
+# 3-bit codes for packing barcodes, anything but CATGN or the '+' that 
+# joins dual barcodes is 7 (no match)
+BASECODES = np.full(256, 7, dtype=np.int64)
+for _code, _base in enumerate("ACGTN+"):
+    BASECODES[ord(_base)] = _code
+
+# longest barcode that fits in an int64 key with its length bit
+MAXPACKLEN = 20
+
+# keys below this (barcodes up to 7 bases) are looked up in a direct table
+MAXTABLEKEY = 1 << 22
+
+# bump when the contents of the cached barcode index change
+BARCODE_INDEX_VERSION = "3"
+
 NO_RAWS = """\
     No data found in {}. Fix path to data files.
     """
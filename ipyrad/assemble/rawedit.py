@@ -11,9 +11,16 @@ from __future__ import print_function
 import os
 import io
 import time
+import zlib
+import socket
+import multiprocessing as mp
 import numpy as np
 import subprocess as sps
+from numba import njit
+from collections import Counter
 from .utils import IPyradError, fullcomp
+from .utils import open_fastq, iter_fastq_blocks, fastq_line_offsets
+from .utils import fifo_concat
 
 
 class Step2(object):
@@ -21,7 +28,6 @@ class Step2(object):
         self.data = data
         self.force = force
         self.ipyclient = ipyclient
-        self.lbview = self.ipyclient.load_balanced_view(self.ipyclient.ids[::2])
         self.print_headers()
         self.samples = self.get_subsamples()
         self.check_binaries()
@@ -86,6 +92,8 @@ class Step2(object):
 
 
     def check_binaries(self):
+        if self.data.hackersonly.trim_engine == "builtin":
+            return
         cmd = ['which', 'cutadapt']
         proc = sps.Popen(cmd, stderr=sps.PIPE, stdout=sps.PIPE)
         comm = proc.communicate()[0]
@@ -94,100 +102,75 @@ class Step2(object):
 
 
     def check_adapters(self):
-        """
-        Allow extra adapters if filters=3, and add poly repeats if not 
-        in list of adapters. 
-        """
-        if int(self.data.params.filter_adapters) == 3:
-            if not self.data.hackersonly.p3_adapters_extra:
-                for poly in ["A" * 8, "T" * 8, "C" * 8, "G" * 8]:
-                    self.data.hackersonly.p3_adapters_extra = (
-                        self.data.hackersonly.p3_adapters_extra + [poly])
-
-            if not self.data.hackersonly.p5_adapters_extra:
-                for poly in ["A" * 8, "T" * 8, "C" * 8, "G" * 8]:
-                    self.data.hackersonly.p5_adapters_extra = (
-                        self.data.hackersonly.p5_adapters_extra + [poly])
-        else:
-            self.data.hackersonly.p5_adapters_extra = []
-            self.data.hackersonly.p3_adapters_extra = []        
+        check_adapters(self.data)
 
 
     def run(self):
-        self.remote_concat_multiple_raws()
         self.remote_run_cutadapt()
         self.assembly_cleanup()
         self.data.save()
 
 
-    def remote_concat_multiple_raws(self):
-        "concatenate multiple raw files into a single file."
-
-        # if no samples have multiple then just move on
-        if not any([len(i.files.fastqs) > 1 for i in self.samples]):
-            for sample in self.samples:
-                sample.files.concat = sample.files.fastqs
-
-        # otherwise concatenate them
-        else:
-            # run on single engine due to i/o limits
-            start = time.time()
-            printstr = ("concatenating inputs", "s2")
-            finished = 0
-            catjobs = {}
-            for sample in self.samples:
-                if len(sample.files.fastqs) > 1:
-                    catjobs[sample.name] = self.lbview.apply(
-                        concat_multiple_inputs, *(self.data, sample))
-                else:
-                    sample.files.concat = sample.files.fastqs
-
-            # wait for all to finish
-            while 1:
-                finished = sum([i.ready() for i in catjobs.values()])
-                self.data._progressbar(len(catjobs), finished, start, printstr)
-                time.sleep(0.1)
-                if finished == len(catjobs):
-                    break
-
-            # collect results, which are concat file handles.
-            self.data._print("")
-            for rasync in catjobs:
-                self.data.samples[rasync].files.concat = catjobs[rasync].get()
-
-
     def remote_run_cutadapt(self):
-        # choose cutadapt function based on datatype
+        """
+        Trims samples largest first, giving each job a number of engines
+        (threads) on one host in proportion to its share of the reads, so
+        that large samples finish about when the many small samples packed
+        around them do. Engines are returned to their host as jobs finish.
+        """
         start = time.time()
         printstr = ("processing reads    ", "s2")
-        finished = 0
         rawedits = {}
 
-        # send samples to cutadapt filtering
-        for sample in self.samples:
-            if "pair" in self.data.params.datatype:
-                rasync = self.lbview.apply(
-                    cutadaptit_pairs, *(self.data, sample))
-            else:
-                rasync = self.lbview.apply(
-                    cutadaptit_single, *(self.data, sample))
-            rawedits[sample.name] = rasync
+        # free engines on each host, and the threads each sample should get
+        hostd = self.get_host_engines()
+        ncores = sum(len(i) for i in hostd.values())
+        maxthreads = max(len(i) for i in hostd.values())
+        total = sum(i.stats.reads_raw for i in self.samples)
+        queued = list(self.samples)
+        running = {}
+        walltimes = {}
 
-        # wait for all to finish
         while 1:
-            finished = sum([i.ready() for i in rawedits.values()])
-            self.data._progressbar(len(rawedits), finished, start, printstr)
+            # return engines of finished jobs
+            for sname in [i for i in running if running[i][0].ready()]:
+                rasync, host, eids, jstart = running.pop(sname)
+                hostd[host].extend(eids)
+                walltimes[sname] = (len(eids), time.time() - jstart)
+
+            # start queued samples on the host with the most free engines
+            while queued:
+                host = max(hostd, key=lambda x: len(hostd[x]))
+                if not hostd[host]:
+                    break
+                sample = queued.pop(0)
+                nthreads = min(
+                    len(hostd[host]), 
+                    get_sample_threads(
+                        sample.stats.reads_raw, total, ncores, maxthreads),
+                )
+                eids = [hostd[host].pop(0) for _ in range(nthreads)]
+                rasync = self.send_trim_job(sample, eids[0], nthreads)
+                rawedits[sample.name] = rasync
+                running[sample.name] = (rasync, host, eids, time.time())
+
+            self.data._progressbar(
+                len(self.samples), len(walltimes), start, printstr)
             time.sleep(0.1)
-            if finished == len(rawedits):
-                print("")
+            if not (queued or running):
+                self.data._print("")
                 break
+        self.write_walltimes(walltimes)
 
         # collect results, report failures, store stats. async = sample.name
         faildict = {}
         for rasync in rawedits:
             try:
                 res = rawedits[rasync].get()
-                if "pair" not in self.data.params.datatype:
+                if self.data.hackersonly.trim_engine == "builtin":
+                    parse_builtin_results(
+                        self.data, self.data.samples[rasync], res)
+                elif "pair" not in self.data.params.datatype:
                     parse_single_results(
                         self.data, self.data.samples[rasync], res)
                 else:
@@ -208,6 +191,47 @@ class Step2(object):
                                                                     s2_fail_log))
 
 
+    def get_host_engines(self):
+        """
+        returns {hostname: [engine ids]} for engines of the ipyclient. A
+        job runs one thread per engine it holds, so engines beyond the 
+        number of cores on a host are left out to avoid oversubscribing it.
+        """
+        dview = self.ipyclient.direct_view()
+        hosts = dview.apply_sync(socket.gethostname)
+        cpus = dview.apply_sync(mp.cpu_count)
+        hostd = {}
+        for host, ncpu, eid in zip(hosts, cpus, self.ipyclient.ids):
+            engines = hostd.setdefault(host, [])
+            if len(engines) < ncpu:
+                engines.append(eid)
+        return hostd
+
+
+    def send_trim_job(self, sample, eid, nthreads):
+        "send a sample to cutadapt (or the builtin trimmer) on engine eid"
+        view = self.ipyclient.load_balanced_view(targets=[eid])
+        if self.data.hackersonly.trim_engine == "builtin":
+            return view.apply(trimreads, *(self.data, sample, nthreads))
+        if "pair" in self.data.params.datatype:
+            return view.apply(cutadaptit_pairs, *(self.data, sample, nthreads))
+        return view.apply(cutadaptit_single, *(self.data, sample, nthreads))
+
+
+    def write_walltimes(self, walltimes):
+        "write the threads and wall time used by each sample to a table"
+        outfile = os.path.join(self.data.dirs.edits, 's2_sample_times.txt')
+        with open(outfile, 'w') as out:
+            out.write("{:<35}  {:>13} {:>8} {:>10}\n".format(
+                "sample_name", "reads_raw", "threads", "seconds"))
+            for sample in self.samples:
+                if sample.name in walltimes:
+                    nthreads, elapsed = walltimes[sample.name]
+                    out.write("{:<35}  {:>13} {:>8} {:>10.1f}\n".format(
+                        sample.name, sample.stats.reads_raw, nthreads, 
+                        elapsed))
+
+
     def assembly_cleanup(self):
         # build s2 results data frame
         self.data.stats_dfs.s2 = self.data._build_stat("s2")
@@ -238,6 +262,39 @@ def assembly_cleanup(data):
 
 
 
+def get_sample_threads(nreads, total, ncores, maxthreads):
+    """
+    Returns the threads for a sample with nreads of the total reads, so 
+    that it takes about as long as its share of ncores would: i.e., a
+    sample with 30% of reads gets 30% of cores (at least 1, at most 
+    maxthreads).
+    """
+    if not total:
+        return 1
+    nthreads = int(np.ceil(ncores * nreads / float(total)))
+    return max(1, min(maxthreads, nthreads))
+
+
+def check_adapters(data):
+    """
+    Allow extra adapters if filters=3, and add poly repeats if not 
+    in list of adapters. 
+    """
+    if int(data.params.filter_adapters) == 3:
+        if not data.hackersonly.p3_adapters_extra:
+            for poly in ["A" * 8, "T" * 8, "C" * 8, "G" * 8]:
+                data.hackersonly.p3_adapters_extra = (
+                    data.hackersonly.p3_adapters_extra + [poly])
+
+        if not data.hackersonly.p5_adapters_extra:
+            for poly in ["A" * 8, "T" * 8, "C" * 8, "G" * 8]:
+                data.hackersonly.p5_adapters_extra = (
+                    data.hackersonly.p5_adapters_extra + [poly])
+    else:
+        data.hackersonly.p5_adapters_extra = []
+        data.hackersonly.p3_adapters_extra = []
+
+
 def parse_single_results(data, sample, res1):
     """ parse results from cutadapt into sample data"""
 
@@ -278,17 +335,7 @@ def parse_single_results(data, sample, res1):
             sample.stats_dfs.s2["reads_passed_filter"] = value
 
     # save to stats summary
-    if sample.stats_dfs.s2.reads_passed_filter:
-        sample.stats.state = 2
-        sample.stats.reads_passed_filter = (
-            sample.stats_dfs.s2.reads_passed_filter)
-        sample.files.edits = [
-            (os.path.join(
-                data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 0)]
-
-    else:
-        print("{}No reads passed filtering in Sample: {}"
-              .format(data._spacer, sample.name))
+    store_edit_files(data, sample)
 
 
 
@@ -347,29 +394,47 @@ def parse_pair_results(data, sample, res):
             sample.stats_dfs.s2["reads_passed_filter"] = value
 
     # save to stats 
+    store_edit_files(data, sample)
+
+
+def parse_builtin_results(data, sample, res):
+    """ store the stats counters returned by trimreads() into sample data"""
+    for key in sample.stats_dfs.s2.index:
+        if ("read2" not in key) or ("pair" in data.params.datatype):
+            sample.stats_dfs.s2[key] = int(res[key])
+
+    # save to stats
+    store_edit_files(data, sample)
+
+
+def store_edit_files(data, sample):
+    """ advance state and link trimmed files if any reads passed filters"""
     if sample.stats_dfs.s2.reads_passed_filter:
         sample.stats.state = 2
         sample.stats.reads_passed_filter = (
             sample.stats_dfs.s2.reads_passed_filter)
-        sample.files.edits = [(
-            os.path.join(
-                data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 
-            os.path.join(
-                data.dirs.edits, sample.name + ".trimmed_R2_.fastq.gz")
-            )]
+        if "pair" in data.params.datatype:
+            sample.files.edits = [(
+                os.path.join(
+                    data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 
+                os.path.join(
+                    data.dirs.edits, sample.name + ".trimmed_R2_.fastq.gz")
+                )]
+        else:
+            sample.files.edits = [
+                (os.path.join(
+                    data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 0)]
+
     else:
-        print("No reads passed filtering in Sample: {}".format(sample.name))
+        print("{}No reads passed filtering in Sample: {}"
+              .format(data._spacer, sample.name))
 
 
-# CALLED BY STEP
-def cutadaptit_single(data, sample):
-    """ 
-    Applies quality and adapter filters to reads using cutadapt. If the ipyrad
-    filter param is set to 0 then it only filters to hard trim edges and uses
-    mintrimlen. If filter=1, we add quality filters. If filter=2 we add
-    adapter filters. 
+def get_single_adapters(data, sample):
+    """
+    Returns the 3' adapter to search for in single-end reads and the list 
+    of extra adapters (e.g., poly repeats if filter_adapters=3).
     """
-    sname = sample.name
     # if (GBS, ddRAD) we look for the second cut site + adapter. For SE
     # data we don't bother trying to remove the second barcode since it's not
     # as critical as with PE data.
@@ -410,90 +475,14 @@ def cutadaptit_single(data, sample):
                 data.hackersonly.p3_adapter, 
             ])
 
-    # get length trim parameter from new or older version of ipyrad params
-    trim5r1 = trim3r1 = []
-    trimlen = data.params.trim_reads
-
-    # trim 5' end
-    if trimlen[0]:
-        trim5r1 = ["-u", str(trimlen[0])]
-    if trimlen[1] < 0:
-        trim3r1 = ["-u", str(trimlen[1])]
-    if trimlen[1] > 0:
-        trim3r1 = ["--length", str(trimlen[1])]
-    # else:
-        # trimlen = data.paramsdict.get("edit_cutsites")
-        # trim5r1 = ["--cut", str(trimlen[0])]
-
-    # testing new 'trim_reads' setting
-    cmdf1 = ["cutadapt"]
-    if trim5r1:
-        cmdf1 += trim5r1
-    if trim3r1:
-        cmdf1 += trim3r1
-    cmdf1 += [
-        "--minimum-length", str(data.params.filter_min_trim_len),
-        "--max-n", str(data.params.max_low_qual_bases),
-        "--trim-n", 
-        "--output", os.path.join(
-            data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
-        sample.files.concat[0][0],
-        ]
-
-    if int(data.params.filter_adapters):
-        # NEW: only quality trim the 3' end for SE data.
-        cmdf1.insert(1, "20")
-        cmdf1.insert(1, "-q")
-        cmdf1.insert(1, str(data.params.phred_Qscore_offset))
-        cmdf1.insert(1, "--quality-base")
-
-    # if filter_adapters==3 then p3_adapters_extra will already have extra
-    # poly adapters added to its list. 
-    if int(data.params.filter_adapters) > 1:
-
-        # TODO: ------------
-        # first enter extra cuts (order of input is reversed) --------------------
-        for extracut in list(set(data.hackersonly.p3_adapters_extra))[::-1]:
-
-            cmdf1.insert(1, extracut)
-            cmdf1.insert(1, "-a")
-        # then put the main cut so it appears first in command
-        cmdf1.insert(1, adapter)
-        cmdf1.insert(1, "-a")
-
-    # do modifications to read1 and write to tmp file
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    try:
-        res1 = proc1.communicate()[0]
-    except KeyboardInterrupt:
-        proc1.kill()
-        raise KeyboardInterrupt
-
-    # raise errors if found
-    if proc1.returncode:
-        raise IPyradError(" error in {}\n {}".format(" ".join(cmdf1), res1))
-
-    # return result string to be parsed outside of engine
-    return res1
+    return adapter, list(set(data.hackersonly.p3_adapters_extra))[::-1]
 
 
-# CALLED BY STEP
-# BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
-def cutadaptit_pairs(data, sample):
+def get_pair_adapters(data, sample):
     """
-    Applies trim & filters to pairs, including adapter detection. If we have
-    barcode information then we use it to trim reversecut+bcode+adapter from 
-    reverse read, if not then we have to apply a more general cut to make sure 
-    we remove the barcode, this uses wildcards and so will have more false 
-    positives that trim a little extra from the ends of reads. Should we add
-    a warning about this when filter_adapters=2 and no barcodes?
+    Returns the R1 and R2 adapters to search for in paired reads and lists
+    of extra adapters for each (e.g., poly repeats, technical replicates).
     """
-    sname = sample.name
-
-    ## applied to read pairs
-    finput_r1 = sample.files.concat[0][0]
-    finput_r2 = sample.files.concat[0][1]
-
     ## Get adapter sequences. This is very important. For the forward adapter
     ## we don't care all that much about getting the sequence just before the 
     ## Illumina adapter, b/c it will either be random (in RAD), or the reverse
@@ -566,6 +555,133 @@ def cutadaptit_pairs(data, sample):
         adapter1 = data.hackersonly.p3_adapter
         adapter2 = fullcomp(data.hackersonly.p5_adapter)
 
+    # if technical replicates then add other copies
+    if int(data.params.filter_adapters) > 1:
+        if isinstance(sample.barcode, list):
+            for extrabar in sample.barcode[1:]:
+
+                data.hackersonly.p5_adapters_extra.append(
+                    "".join([
+                        fullcomp(data.params.restriction_overhang[0])[::-1], 
+                        fullcomp(extrabar)[::-1], 
+                        data.hackersonly.p5_adapter
+                    ])
+                )
+
+                data.hackersonly.p5_adapters_extra.append(
+                    "".join([
+                        fullcomp(data.params.restriction_overhang[1])[::-1], 
+                        data.hackersonly.p3_adapter,
+                    ])
+                )
+
+    zcut1 = list(set(data.hackersonly.p3_adapters_extra))[::-1]
+    zcut2 = list(set(data.hackersonly.p5_adapters_extra))[::-1]
+    return adapter1, adapter2, zcut1, zcut2
+
+
+# CALLED BY STEP
+def cutadaptit_single(data, sample, nthreads=1):
+    """ 
+    Applies quality and adapter filters to reads using cutadapt. If the ipyrad
+    filter param is set to 0 then it only filters to hard trim edges and uses
+    mintrimlen. If filter=1, we add quality filters. If filter=2 we add
+    adapter filters. Runs cutadapt on nthreads cores.
+    """
+    sname = sample.name
+    adapter, extras = get_single_adapters(data, sample)
+
+    # get length trim parameter from new or older version of ipyrad params
+    trim5r1 = trim3r1 = []
+    trimlen = data.params.trim_reads
+
+    # trim 5' end
+    if trimlen[0]:
+        trim5r1 = ["-u", str(trimlen[0])]
+    if trimlen[1] < 0:
+        trim3r1 = ["-u", str(trimlen[1])]
+    if trimlen[1] > 0:
+        trim3r1 = ["--length", str(trimlen[1])]
+    # else:
+        # trimlen = data.paramsdict.get("edit_cutsites")
+        # trim5r1 = ["--cut", str(trimlen[0])]
+
+    # testing new 'trim_reads' setting
+    cmdf1 = ["cutadapt"]
+    if nthreads > 1:
+        cmdf1 += ["-j", str(nthreads)]
+    if trim5r1:
+        cmdf1 += trim5r1
+    if trim3r1:
+        cmdf1 += trim3r1
+    cmdf1 += [
+        "--minimum-length", str(data.params.filter_min_trim_len),
+        "--max-n", str(data.params.max_low_qual_bases),
+        "--trim-n", 
+        "--output", os.path.join(
+            data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
+        ]
+
+    if int(data.params.filter_adapters):
+        # NEW: only quality trim the 3' end for SE data.
+        cmdf1.insert(1, "20")
+        cmdf1.insert(1, "-q")
+        cmdf1.insert(1, str(data.params.phred_Qscore_offset))
+        cmdf1.insert(1, "--quality-base")
+
+    # if filter_adapters==3 then p3_adapters_extra will already have extra
+    # poly adapters added to its list. 
+    if int(data.params.filter_adapters) > 1:
+
+        # TODO: ------------
+        # first enter extra cuts (order of input is reversed) --------------------
+        for extracut in extras:
+
+            cmdf1.insert(1, extracut)
+            cmdf1.insert(1, "-a")
+        # then put the main cut so it appears first in command
+        cmdf1.insert(1, adapter)
+        cmdf1.insert(1, "-a")
+
+    # do modifications to read1 and write to tmp file. Multiple inputs 
+    # are streamed through a named pipe.
+    with fifo_concat(
+        [i[0] for i in sample.files.fastqs], 
+        get_concat_fifo(data, sample, 1)) as finput_r1:
+        cmdf1.append(finput_r1)
+        proc1 = sps.Popen(
+            cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
+        try:
+            res1 = proc1.communicate()[0]
+        except KeyboardInterrupt:
+            proc1.kill()
+            raise KeyboardInterrupt
+
+    # raise errors if found
+    if proc1.returncode:
+        raise IPyradError(" error in {}\n {}".format(" ".join(cmdf1), res1))
+
+    # return result string to be parsed outside of engine
+    return res1
+
+
+# CALLED BY STEP
+# BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
+def cutadaptit_pairs(data, sample, nthreads=1):
+    """
+    Applies trim & filters to pairs, including adapter detection. If we have
+    barcode information then we use it to trim reversecut+bcode+adapter from 
+    reverse read, if not then we have to apply a more general cut to make sure 
+    we remove the barcode, this uses wildcards and so will have more false 
+    positives that trim a little extra from the ends of reads. Should we add
+    a warning about this when filter_adapters=2 and no barcodes? Runs 
+    cutadapt on nthreads cores.
+    """
+    sname = sample.name
+
+    # get adapters (and extra adapters) for each read
+    adapter1, adapter2, zcut1, zcut2 = get_pair_adapters(data, sample)
+
     # parse trim_reads
     trim5r1 = trim5r2 = trim3r1 = trim3r2 = []
     trimlen = data.params.trim_reads
@@ -592,6 +708,8 @@ def cutadaptit_pairs(data, sample):
 
     # testing new 'trim_reads' setting
     cmdf1 = ["cutadapt"]
+    if nthreads > 1:
+        cmdf1 += ["-j", str(nthreads)]
     if trim5r1:
         cmdf1 += trim5r1
     if trim3r1:
@@ -609,8 +727,6 @@ def cutadaptit_pairs(data, sample):
             data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
         "-p", os.path.join(
             data.dirs.edits, sname + ".trimmed_R2_.fastq.gz"),
-        finput_r1,
-        finput_r2,
         ]
 
     # additional args
@@ -626,28 +742,7 @@ def cutadaptit_pairs(data, sample):
         cmdf1.insert(1, "--quality-base")
 
     if int(data.params.filter_adapters) > 1:
-        # if technical replicates then add other copies
-        if isinstance(sample.barcode, list):
-            for extrabar in sample.barcode[1:]:
-
-                data.hackersonly.p5_adapters_extra.append(
-                    "".join([
-                        fullcomp(data.params.restriction_overhang[0])[::-1], 
-                        fullcomp(extrabar)[::-1], 
-                        data.hackersonly.p5_adapter
-                    ])
-                )
-
-                data.hackersonly.p5_adapters_extra.append(
-                    "".join([
-                        fullcomp(data.params.restriction_overhang[1])[::-1], 
-                        data.hackersonly.p3_adapter,
-                    ])
-                )
-
         # first enter extra cuts
-        zcut1 = list(set(data.hackersonly.p3_adapters_extra))[::-1]
-        zcut2 = list(set(data.hackersonly.p5_adapters_extra))[::-1]
         for ecut1, ecut2 in zip(zcut1, zcut2):
             cmdf1.insert(1, ecut1)
             cmdf1.insert(1, "-a")
@@ -659,59 +754,418 @@ def cutadaptit_pairs(data, sample):
         cmdf1.insert(1, adapter2)
         cmdf1.insert(1, '-A')         
 
-    # do modifications to read1 and write to tmp file
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    res1 = proc1.communicate()[0]
+    # applied to read pairs. Multiple inputs are streamed through named 
+    # pipes.
+    with fifo_concat(
+        [i[0] for i in sample.files.fastqs],
+        get_concat_fifo(data, sample, 1)) as finput_r1:
+        with fifo_concat(
+            [i[1] for i in sample.files.fastqs],
+            get_concat_fifo(data, sample, 2)) as finput_r2:
+            cmdf1 += [finput_r1, finput_r2]
+            proc1 = sps.Popen(
+                cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
+            res1 = proc1.communicate()[0]
     if proc1.returncode:
         raise IPyradError("error in cutadapt: {}".format(res1.decode()))
     return res1
 
 
 # CALLED BY STEP
-def concat_multiple_inputs(data, sample):
-    """ 
-    If multiple fastq files were appended into the list of fastqs for samples
-    then we merge them here before proceeding. 
+def trimreads(data, sample, nthreads=1):
     """
-    # if more than one tuple in fastq list
-    if len(sample.files.fastqs) > 1:
-        # create a cat command to append them all (doesn't matter if they 
-        # are gzipped, cat still works). Grab index 0 of tuples for R1s.
-        cmd1 = ["cat"] + [i[0] for i in sample.files.fastqs]
-
-        isgzip = ".gz"
-        if not sample.files.fastqs[0][0].endswith(".gz"):
-            isgzip = ""
-
-        # write to new concat handle
-        conc1 = os.path.join(
-            data.dirs.edits, sample.name + "_R1_concat.fq{}".format(isgzip))
-        with open(conc1, 'w') as cout1:
-            proc1 = sps.Popen(
-                cmd1, stderr=sps.STDOUT, stdout=cout1, close_fds=True)
-            res1 = proc1.communicate()[0]
-        if proc1.returncode:
-            raise IPyradError("error in: {}, {}".format(cmd1, res1))
+    Built-in alternative to cutadaptit_single/pairs (trim_engine='builtin')
+    that applies the same edge, quality, adapter and N trims and filters to
+    blocks of reads at once, splitting blocks of a sample across nthreads 
+    processes. Writes the trimmed edits files and returns a Counter of s2 
+    stats instead of a text report.
+    """
+    paired = "pair" in data.params.datatype
+    trimmer = ReadTrimmer(data, sample)
+
+    # output handles for R1 and R2 edits
+    outs = [
+        os.path.join(data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz")]
+    if paired:
+        outs.append(
+            os.path.join(
+                data.dirs.edits, sample.name + ".trimmed_R2_.fastq.gz"))
+
+    # blocks are trimmed and compressed in parallel, written in order.
+    stats = Counter()
+    ofile1 = open_fastq([i[0] for i in sample.files.fastqs])
+    ofile2 = (
+        open_fastq([i[1] for i in sample.files.fastqs]) if paired else None)
+    jobs = (
+        (trimmer, block1, block2) for (block1, block2) 
+        in iter_fastq_blocks(ofile1, ofile2, trimmer.batchsize)
+    )
+    pool = (mp.Pool(nthreads) if nthreads > 1 else None)
+    handles = []
+    try:
+        handles = [open(i, 'wb') for i in outs]
+        if pool:
+            results = pool.imap(trim_block, jobs)
+        else:
+            results = (trim_block(i) for i in jobs)
+        for chunks, bstats in results:
+            for handle, chunk in zip(handles, chunks):
+                handle.write(chunk)
+            stats.update(bstats)
+    finally:
+        if pool:
+            pool.terminate()
+        for handle in handles:
+            handle.close()
+        ofile1.close()
+        if ofile2:
+            ofile2.close()
+    return stats
+
+
+def trim_block(args):
+    "trim a block of reads and return the gzipped edits and stats counter"
+    trimmer, block1, block2 = args
+    return trimmer.trim_block(block1, block2)
+
+
+class ReadTrimmer(object):
+    """
+    Trims fastq blocks like the cutadapt commands built above: trim_reads 
+    edges are cut, ends are quality trimmed (BWA algorithm), the leftmost 
+    3' adapter match is removed, Ns are trimmed from the ends, and reads 
+    shorter than filter_min_trim_len or with more than max_low_qual_bases 
+    Ns are filtered (pairs are filtered if either read fails). Adapters 
+    match with up to 10% edits over at least 3 bases, and non-ACGT adapter
+    bases match any base. Rare ties between adapter alignments can be cut
+    one base off from cutadapt.
+    """
+    def __init__(self, data, sample):
+        self.paired = "pair" in data.params.datatype
+        self.batchsize = int(5e4)
+        self.minlen = int(data.params.filter_min_trim_len)
+        self.maxn = int(data.params.max_low_qual_bases)
+        self.qbase = int(data.params.phred_Qscore_offset)
+
+        # edge trims (5' cut, 3' cut, max length) from trim_reads. Like 
+        # cutadapt --length, a R2 max length also applies to R1.
+        trimlen = list(data.params.trim_reads) + [0, 0, 0, 0]
+        self.edges1 = get_edge_trims(trimlen[0], trimlen[1])
+        self.edges2 = get_edge_trims(trimlen[2], trimlen[3])
+        if self.paired:
+            maxlen = (self.edges2[2] or self.edges1[2])
+            self.edges1[2] = self.edges2[2] = maxlen
+
+        # quality cutoffs (5', 3'). Only the 3' end of SE reads is trimmed.
+        self.quals = np.zeros(2, dtype=np.int64)
+        if int(data.params.filter_adapters):
+            self.quals[:] = ((20, 20) if self.paired else (0, 20))
+
+        # adapters with the main adapter first
+        adapters1 = adapters2 = []
+        if int(data.params.filter_adapters) > 1:
+            if self.paired:
+                adapter1, adapter2, zcut1, zcut2 = get_pair_adapters(
+                    data, sample)
+                adapters1 = [adapter1] + zcut1
+                adapters2 = [adapter2] + zcut2
+            else:
+                adapter, extras = get_single_adapters(data, sample)
+                adapters1 = [adapter] + extras
+        self.adapters1 = encode_adapters(adapters1)
+        self.adapters2 = encode_adapters(adapters2)
 
-        # Only set conc2 if R2 actually exists
-        conc2 = 0
-        if "pair" in data.params.datatype:
-            cmd2 = ["cat"] + [i[1] for i in sample.files.fastqs]
-            conc2 = os.path.join(
-                data.dirs.edits, sample.name + "_R2_concat.fq{}".format(isgzip))
-            with open(conc2, 'w') as cout2:
-                proc2 = sps.Popen(
-                    cmd2, stderr=sps.STDOUT, stdout=cout2, close_fds=True)
-                proc2.communicate()[0]
-            if proc2.returncode:
-                raise IPyradError(
-                    "Error concatenating fastq files. Make sure all " +
-                    "these files exist: {}\nError message: {}"
-                    .format(cmd2, proc2.returncode))
 
-        # store new file handles
-        sample.files.concat = [(conc1, conc2)]
-    return sample.files.concat
+    def trim_block(self, block1, block2):
+        """
+        Returns the gzipped R1 (and R2) records that passed filters in a 
+        block of reads, and a Counter of the s2 stats for the block.
+        """
+        arrs, stats = self.trim(block1, block2)
+        return [gzip_member(i) for i in arrs], stats
+
+
+    def trim(self, block1, block2):
+        """
+        Returns the R1 (and R2) records that passed filters in a block of 
+        reads as uint8 arrays, and a Counter of the s2 stats for the block.
+        """
+        buf1 = np.frombuffer(block1, dtype=np.uint8)
+        lines1 = fastq_line_offsets(buf1)
+        bounds1, qtrim1, adapt1, nbases1 = get_trim_bounds(
+            buf1, lines1, self.edges1, self.quals, self.qbase, 
+            *self.adapters1)
+        short = (bounds1[:, 1] - bounds1[:, 0]) < self.minlen
+        maxns = nbases1 > self.maxn
+
+        stats = Counter()
+        stats["reads_raw"] = lines1.shape[0]
+        stats["trim_adapter_bp_read1"] = int(adapt1.sum())
+        stats["trim_quality_bp_read1"] = int(qtrim1.sum())
+
+        # pairs fail if either read fails
+        if self.paired:
+            buf2 = np.frombuffer(block2, dtype=np.uint8)
+            lines2 = fastq_line_offsets(buf2)
+            if lines2.shape[0] != lines1.shape[0]:
+                raise IPyradError(
+                    "R1 and R2 files have different numbers of reads")
+            bounds2, qtrim2, adapt2, nbases2 = get_trim_bounds(
+                buf2, lines2, self.edges2, self.quals, self.qbase, 
+                *self.adapters2)
+            short |= (bounds2[:, 1] - bounds2[:, 0]) < self.minlen
+            maxns |= nbases2 > self.maxn
+            stats["trim_adapter_bp_read2"] = int(adapt2.sum())
+            stats["trim_quality_bp_read2"] = int(qtrim2.sum())
+
+        # too short is checked before too many Ns
+        maxns &= ~short
+        keep = np.flatnonzero(~(short | maxns))
+        stats["reads_filtered_by_minlen"] = int(short.sum())
+        stats["reads_filtered_by_Ns"] = int(maxns.sum())
+        stats["reads_passed_filter"] = int(keep.size)
+
+        # trimmed records
+        arrs = [gather_trimmed_reads(buf1, lines1, keep, bounds1)]
+        if self.paired:
+            arrs.append(gather_trimmed_reads(buf2, lines2, keep, bounds2))
+        return arrs, stats
+
+
+def get_edge_trims(cut, trim3):
+    """
+    Returns (5' cut, 3' cut, max length) from a pair of trim_reads values, 
+    where negative values trim from the 3' end and a positive 3' value is
+    a max length (cutadapt -u/-U and --length).
+    """
+    edges = np.zeros(3, dtype=np.int64)
+    if cut > 0:
+        edges[0] = cut
+    if cut < 0:
+        edges[1] = -cut
+    if trim3 < 0:
+        edges[1] += -trim3
+    if trim3 > 0:
+        edges[2] = trim3
+    return edges
+
+
+def encode_adapters(adapters):
+    """
+    Returns adapters as a (n, maxlen) uint8 array and their lengths. Bases 
+    other than ACGT are stored as 0, which matches any base.
+    """
+    adapters = [i.upper() for i in adapters if i]
+    alens = np.array([len(i) for i in adapters], dtype=np.int64)
+    arr = np.zeros(
+        (len(adapters), (max(alens) if adapters else 0)), dtype=np.uint8)
+    for idx, adapter in enumerate(adapters):
+        for pos, base in enumerate(adapter):
+            if base in "ACGT":
+                arr[idx, pos] = ord(base)
+    return arr, alens
+
+
+@njit
+def get_trim_bounds(buf, lines, edges, quals, qbase, adapters, alens):
+    """
+    Returns the (start, stop) of the trimmed seq of each read in a fastq 
+    buffer, the bp removed by quality trimming, whether an adapter was 
+    found, and the number of Ns left in the trimmed read.
+    """
+    nreads = lines.shape[0]
+    bounds = np.zeros((nreads, 2), dtype=np.int64)
+    qtrim = np.zeros(nreads, dtype=np.int64)
+    adapt = np.zeros(nreads, dtype=np.bool_)
+    nbases = np.zeros(nreads, dtype=np.int64)
+
+    # rows of the adapter alignment matrix
+    prev = np.zeros(adapters.shape[1] + 1, dtype=np.int64)
+    curr = np.zeros(adapters.shape[1] + 1, dtype=np.int64)
+
+    for idx in range(nreads):
+        seq = lines[idx, 1]
+        qual = lines[idx, 3]
+        seqlen = lines[idx, 2] - seq - 1
+
+        # unconditional edge trims
+        start = min(edges[0], seqlen)
+        stop = max(start, seqlen - edges[1])
+
+        # quality trim 5' then 3' end: cut where the running sum of 
+        # (cutoff - qscore) is maximal before it falls below zero.
+        if quals[0]:
+            score = 0
+            best = 0
+            cut = start
+            for pos in range(start, stop):
+                score += quals[0] - (buf[qual + pos] - qbase)
+                if score < 0:
+                    break
+                if score > best:
+                    best = score
+                    cut = pos + 1
+            qtrim[idx] += cut - start
+            start = cut
+        if quals[1]:
+            score = 0
+            best = 0
+            cut = stop
+            for pos in range(stop - 1, start - 1, -1):
+                score += quals[1] - (buf[qual + pos] - qbase)
+                if score < 0:
+                    break
+                if score > best:
+                    best = score
+                    cut = pos
+            qtrim[idx] += stop - cut
+            stop = cut
+
+        # leftmost match of any adapter, which can run off the 3' end. A 
+        # match w/ errors is moved one base right if that has no more 
+        # errors, since the first base was likely an insertion.
+        cut = stop
+        for adx in range(adapters.shape[0]):
+            alen = alens[adx]
+            for pos in range(start, min(cut, stop - min(3, alen) + 1)):
+                nerr = adapter_errors(
+                    buf, seq + pos, seq + stop, adapters[adx], alen, 
+                    prev, curr)
+                if nerr >= 0:
+                    if nerr and (pos + 1 < stop):
+                        nerr2 = adapter_errors(
+                            buf, seq + pos + 1, seq + stop, adapters[adx], 
+                            alen, prev, curr)
+                        if (nerr2 >= 0) and (nerr2 <= nerr):
+                            pos += 1
+                    cut = pos
+                    break
+        if cut < stop:
+            adapt[idx] = True
+            stop = cut
+
+        # max length
+        if edges[2] and (stop - start > edges[2]):
+            stop = start + edges[2]
+
+        # trim Ns from both ends and count the remaining Ns
+        while (start < stop) and (buf[seq + start] == 78):
+            start += 1
+        while (stop > start) and (buf[seq + stop - 1] == 78):
+            stop -= 1
+        for pos in range(start, stop):
+            if buf[seq + pos] == 78:
+                nbases[idx] += 1
+        bounds[idx, 0] = start
+        bounds[idx, 1] = stop
+    return bounds, qtrim, adapt, nbases
+
+
+@njit
+def adapter_errors(buf, start, stop, adapter, alen, prev, curr):
+    """
+    Returns the fewest edits in an alignment of the start of the adapter to
+    buf[start:] that reaches the end of the adapter, or the end of the read
+    (stop) with at least 3 adapter bases, or -1 if there is none with at 
+    most 10% errors. Only the band of the matrix within the max errors of
+    the full adapter is filled, and rows stop once all cells exceed it.
+    """
+    kmax = alen // 10
+    big = alen + 1
+    nrows = min(stop - start, alen + kmax)
+    best = big
+
+    # first row, adapter bases deleted
+    for col in range(min(alen, kmax) + 1):
+        prev[col] = col
+
+    for row in range(1, nrows + 1):
+        base = buf[start + row - 1]
+        lcol = max(0, row - kmax)
+        rcol = min(alen, row + kmax)
+        rowmin = big
+        for col in range(lcol, rcol + 1):
+            if col == 0:
+                cost = row
+            else:
+                abase = adapter[col - 1]
+                cost = prev[col - 1] + (0 if (not abase or abase == base) else 1)
+                if col <= row - 1 + kmax:
+                    cost = min(cost, prev[col] + 1)
+                if col > lcol:
+                    cost = min(cost, curr[col - 1] + 1)
+            curr[col] = cost
+            rowmin = min(rowmin, cost)
+
+        # full adapter aligned
+        if rcol == alen and curr[alen] <= kmax:
+            best = min(best, curr[alen])
+
+        # end of the read reached w/ a partial adapter
+        if row == stop - start:
+            for col in range(max(lcol, min(3, alen)), rcol + 1):
+                if curr[col] <= (col * 10) // 100:
+                    best = min(best, curr[col])
+
+        if rowmin > kmax:
+            break
+        prev, curr = curr, prev
+
+    if best == big:
+        return -1
+    return best
+
+
+def gather_trimmed_reads(buf, lines, keep, bounds):
+    "Returns a buffer of the records in keep with seq/qual cut to bounds"
+    reclens = (
+        lines[keep, 1] - lines[keep, 0] + 
+        2 * (bounds[keep, 1] - bounds[keep, 0]) + 4)
+    out = np.empty(int(reclens.sum()), dtype=np.uint8)
+    fill_bounded_records(buf, lines, keep, bounds, out)
+    return out
+
+
+@njit
+def fill_bounded_records(buf, lines, keep, bounds, out):
+    "copies header, trimmed seq, '+' and trimmed qual lines into out"
+    pos = 0
+    for idx in keep:
+        start = bounds[idx, 0]
+        stop = bounds[idx, 1]
+        # header line
+        nbytes = lines[idx, 1] - lines[idx, 0]
+        out[pos:pos + nbytes] = buf[lines[idx, 0]:lines[idx, 1]]
+        pos += nbytes
+        # seq line and '+' line
+        nbytes = stop - start
+        out[pos:pos + nbytes] = buf[lines[idx, 1] + start:lines[idx, 1] + stop]
+        pos += nbytes
+        out[pos] = 10
+        out[pos + 1] = 43
+        out[pos + 2] = 10
+        pos += 3
+        # qual line
+        out[pos:pos + nbytes] = buf[lines[idx, 3] + start:lines[idx, 3] + stop]
+        pos += nbytes
+        out[pos] = 10
+        pos += 1
+
+
+def gzip_member(arr, compresslevel=6):
+    "return a uint8 array as a complete gzip member"
+    zobj = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return zobj.compress(arr.tobytes()) + zobj.flush()
+
+
+def get_concat_fifo(data, sample, read):
+    "path of the named pipe a sample's raws are streamed to (see fifo_concat)"
+    isgzip = ".gz"
+    if not sample.files.fastqs[0][0].endswith(".gz"):
+        isgzip = ""
+    return os.path.join(
+        data.dirs.edits, 
+        "{}_R{}_concat.fq{}".format(sample.name, read, isgzip))
 
 
 # GLOBALS
@@ -7,14 +7,22 @@ parts of the pipeline
 
 from __future__ import print_function
 try:
-    from itertools import izip, takewhile
+    from itertools import izip, takewhile, islice
 except ImportError:
-    from itertools import takewhile
+    from itertools import takewhile, islice
     izip = zip
 
 import os
 import sys
+import gzip
+import json
+import mmap
+import struct
 import socket
+import hashlib
+import threading
+import subprocess as sps
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
 import string
@@ -113,6 +121,121 @@ class ObjDict(dict):
 
 
 
+class ReadCounts(object):
+    """
+    Cache of exact read counts for fastq files, stored as json in the 
+    project dir and keyed by file path, size and mtime, so that a file
+    is only ever counted once. Counts are filled in by count_fastq_reads()
+    on first sight, or for free by steps that already read every read 
+    (e.g., demultiplexing). Only the main process reads/writes the cache.
+    """
+    cachename = "ipyrad_read_counts.json"
+
+    def __init__(self, data):
+        self.cachefile = os.path.join(
+            data.params.project_dir, self.cachename)
+        self.counts = {}
+        if os.path.exists(self.cachefile):
+            try:
+                with open(self.cachefile, 'r') as infile:
+                    self.counts = json.load(infile)
+            except ValueError:
+                self.counts = {}
+
+
+    def get(self, fname):
+        "returns the cached count or None if missing or file has changed"
+        key = os.path.realpath(fname)
+        if key not in self.counts or not os.path.exists(key):
+            return None
+        size, mtime, nreads = self.counts[key]
+        fstat = os.stat(key)
+        if (fstat.st_size == size) and (fstat.st_mtime == mtime):
+            return nreads
+        return None
+
+
+    def put(self, fname, nreads):
+        "store count for the file as it is now. Call save() to write."
+        key = os.path.realpath(fname)
+        fstat = os.stat(key)
+        self.counts[key] = [fstat.st_size, fstat.st_mtime, int(nreads)]
+
+
+    def save(self):
+        "write to a tmp file and move it to the cachefile"
+        if not os.path.exists(os.path.dirname(self.cachefile)):
+            return
+        tmpfile = self.cachefile + ".tmp"
+        with open(tmpfile, 'w') as out:
+            json.dump(self.counts, out)
+        os.rename(tmpfile, self.cachefile)
+
+
+
+class FileHashes(ReadCounts):
+    """
+    Cache of sha1 hashes of file contents, stored and keyed the same as
+    ReadCounts, so that a file is only hashed again when it changes.
+    """
+    cachename = "ipyrad_file_hashes.json"
+
+    def put(self, fname, digest):
+        "store hash for the file as it is now. Call save() to write."
+        key = os.path.realpath(fname)
+        fstat = os.stat(key)
+        self.counts[key] = [fstat.st_size, fstat.st_mtime, digest]
+
+
+
+def hash_file(fname):
+    "Returns the sha1 hex digest of the contents of a file"
+    hasher = hashlib.sha1()
+    with open(fname, 'rb') as infile:
+        for block in iter(lambda: infile.read(int(2 ** 22)), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+
+def count_fastq_reads(fname):
+    """
+    Returns the exact number of reads in a (gzipped) fastq file by counting
+    newlines in large blocks. Uses pigz to decompress in a separate 
+    process (threads) if it is installed.
+    """
+    proc = None
+    if fname.endswith(".gz"):
+        pigz = sps.Popen(
+            ['which', 'pigz'], stderr=sps.PIPE, stdout=sps.PIPE
+        ).communicate()[0].strip()
+        if pigz:
+            proc = sps.Popen(
+                [pigz.decode(), "-dc", fname], 
+                stderr=sps.PIPE, stdout=sps.PIPE)
+            infile = proc.stdout
+        else:
+            infile = gzip.open(fname, 'rb')
+    else:
+        infile = open(fname, 'rb')
+
+    # count newlines in 4Mb blocks
+    nlines = 0
+    try:
+        for block in iter(lambda: infile.read(int(2 ** 22)), b""):
+            nlines += block.count(b"\n")
+    finally:
+        infile.close()
+
+    if proc:
+        err = proc.communicate()[1]
+        if proc.returncode:
+            raise IPyradError(
+                "error counting reads in {}: {}".format(fname, err.decode()))
+    return nlines // 4
+
+
+
 CDICT = {i: j for i, j in zip("CATG", "0123")}
 
 
@@ -193,6 +316,255 @@ AMBIGS = {
     }
 
 
+def open_fastq(fname):
+    """
+    Opens a fastq file for reading as bytes whether or not it is gzipped.
+    A list of files is opened as one file (e.g., the raws or edits of a 
+    sample in a merged assembly) without writing them to a concat file.
+    """
+    if isinstance(fname, (list, tuple)):
+        if len(fname) > 1:
+            return FastqChain(fname)
+        fname = fname[0]
+    if fname.endswith(".gz"):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+class FastqChain(object):
+    "Iterates over the lines of several (gzipped) fastq files in order"
+    def __init__(self, fnames):
+        self.fnames = list(fnames)
+        self.lines = self.iter_lines()
+
+    def iter_lines(self):
+        for fname in self.fnames:
+            with open_fastq(fname) as ofile:
+                for line in ofile:
+                    yield line
+
+    def __iter__(self):
+        return self.lines
+
+    def __next__(self):
+        return next(self.lines)
+    next = __next__
+
+    def close(self):
+        self.lines.close()
+
+
+@contextmanager
+def fifo_concat(fnames, fifo):
+    """
+    Yields a path that reads as the concatenation of fnames, for tools 
+    that take a single input file (cutadapt, vsearch, bwa). A single file
+    is yielded as is. Otherwise a named pipe is created at fifo and fed 
+    the files by a thread while in the context, so the concatenated reads
+    are never written to disk. Gzipped files concatenate as a valid gzip 
+    stream, so fifo should end in .gz if the inputs do.
+    """
+    fnames = list(fnames)
+    if len(fnames) == 1:
+        yield fnames[0]
+        return
+
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+    stop = threading.Event()
+    feeder = threading.Thread(target=feed_fifo, args=(fnames, fifo, stop))
+    feeder.daemon = True
+    feeder.start()
+    try:
+        yield fifo
+    finally:
+        # the feeder stops at its next chunk. Open the fifo in case no
+        # reader did, and drain it so that a blocked write returns.
+        stop.set()
+        if feeder.is_alive():
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                while feeder.is_alive():
+                    try:
+                        os.read(fd, int(2 ** 20))
+                    except OSError:
+                        pass
+                    feeder.join(0.01)
+            finally:
+                os.close(fd)
+        os.remove(fifo)
+
+
+def feed_fifo(fnames, fifo, stop):
+    """
+    Writes files to a named pipe once a reader opens it, stopping if the
+    reader closes it or when stop is set.
+    """
+    try:
+        with open(fifo, 'wb') as out:
+            for fname in fnames:
+                with open(fname, 'rb') as infile:
+                    while not stop.is_set():
+                        chunk = infile.read(int(2 ** 22))
+                        if not chunk:
+                            break
+                        out.write(chunk)
+    except (IOError, OSError):
+        pass
+
+
+def iter_fastq_blocks(ofile1, ofile2, nreads):
+    "Yields (R1, R2) blocks of nreads fastq records. R2 is b'' if unpaired"
+    while 1:
+        block1 = read_fastq_block(ofile1, nreads)
+        if not block1:
+            break
+        block2 = (read_fastq_block(ofile2, nreads) if ofile2 else b"")
+        yield block1, block2
+
+
+def read_fastq_block(ofile, nreads):
+    "Returns the next nreads fastq records from an open file as bytes"
+    block = b"".join(islice(ofile, 4 * nreads))
+    if block and not block.endswith(b"\n"):
+        block += b"\n"
+    return block
+
+
+def fastq_line_offsets(buf):
+    """
+    Returns an (nreads, 5) array with the start of the header, seq, '+', 
+    and qual lines of each fastq record in a uint8 buffer, and the end of 
+    the record in the last column.
+    """
+    newlines = np.flatnonzero(buf == 10)
+    if newlines.size % 4:
+        raise IPyradError(
+            "fastq block does not contain a multiple of 4 lines.")
+    nreads = newlines.size // 4
+    lines = np.zeros((nreads, 5), dtype=np.int64)
+    lines[:, 1:] = newlines.reshape(nreads, 4) + 1
+    lines[1:, 0] = lines[:-1, 4]
+    return lines
+
+
+USORT_DTYPE = np.dtype([("seed", np.int64), ("line", np.int64)])
+
+
+def sort_userout(uhandle, maxrecords=int(1e7)):
+    """
+    Groups the hits in a vsearch userout file (query, target, ...) by
+    their seed (target) and writes the grouped order to uhandle + '.sort'
+    as a binary array of (seed key, line offset) records, which is read
+    back by iter_sorted_userout. Records are distributed to buckets on
+    disk by their seed key so that each bucket can be sorted in memory
+    with numpy, which replaces a text `sort -k 2` and does not depend on
+    the locale. Seed keys are md5-derived (see get_seed_key) so the order
+    is the same in every run. Returns the number of seeds with hits.
+    """
+    usort = uhandle + ".sort"
+    nbuckets = 1 + os.path.getsize(uhandle) // (40 * maxrecords)
+    buckets = ["{}.bucket{}".format(usort, i) for i in range(nbuckets)]
+    for bucket in buckets:
+        open(bucket, 'wb').close()
+
+    # parse seed keys and line offsets in chunks and send to buckets
+    with open(uhandle, 'rb') as infile:
+        offset = 0
+        keys = []
+        offsets = []
+        for line in infile:
+            keys.append(get_seed_key(line.split(b"\t", 2)[1]))
+            offsets.append(offset)
+            offset += len(line)
+            if len(keys) == maxrecords:
+                write_buckets(keys, offsets, buckets)
+                keys = []
+                offsets = []
+        write_buckets(keys, offsets, buckets)
+
+    # sort each bucket and append to the sort file. Equal seed keys are
+    # adjacent in the result, and a stable sort keeps hits in file order
+    nseeds = 0
+    with open(usort, 'wb') as out:
+        for bucket in buckets:
+            arr = np.fromfile(bucket, dtype=USORT_DTYPE)
+            os.remove(bucket)
+            if not arr.size:
+                continue
+            arr = arr[np.argsort(arr["seed"], kind="mergesort")]
+            nseeds += 1 + np.count_nonzero(np.diff(arr["seed"]))
+            arr.tofile(out)
+    return int(nseeds)
+
+
+def get_seed_key(seed):
+    """
+    Returns a stable int64 key of a seed name (bytes). Unlike hash(), it
+    is not salted per process, so the order of seeds is reproducible.
+    Seeds that share a key are separated by name in split_key_run.
+    """
+    return struct.unpack("<q", hashlib.md5(seed).digest()[:8])[0]
+
+
+def write_buckets(keys, offsets, buckets):
+    "Appends (seed key, line offset) records to buckets by seed key"
+    if not keys:
+        return
+    arr = np.zeros(len(keys), dtype=USORT_DTYPE)
+    arr["seed"] = keys
+    arr["line"] = offsets
+    bidx = arr["seed"] % len(buckets)
+    for idx, bucket in enumerate(buckets):
+        with open(bucket, 'ab') as out:
+            arr[bidx == idx].tofile(out)
+
+
+def iter_sorted_userout(uhandle, chunksize=int(1e6)):
+    """
+    Yields the lines of a vsearch userout file grouped by seed in the
+    order written by sort_userout to uhandle + '.sort'.
+    """
+    if not os.path.getsize(uhandle + ".sort"):
+        return
+    records = np.memmap(uhandle + ".sort", dtype=USORT_DTYPE, mode='r')
+
+    with open(uhandle, 'rb') as infile:
+        umap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            run = []
+            runkey = None
+            for start in range(0, len(records), chunksize):
+                chunk = np.array(records[start:start + chunksize])
+                for key, offset in izip(
+                        chunk["seed"].tolist(), chunk["line"].tolist()):
+                    if key != runkey:
+                        for line in split_key_run(run):
+                            yield line
+                        run = []
+                        runkey = key
+                    end = umap.find(b"\n", offset)
+                    run.append(umap[offset:(end + 1 if end >= 0 else None)])
+            for line in split_key_run(run):
+                yield line
+        finally:
+            umap.close()
+    del records
+
+
+def split_key_run(run):
+    """
+    Returns the decoded lines of a run of hits with the same seed key,
+    regrouped by seed name in case different seeds share a key.
+    """
+    seeds = [line.split(b"\t", 2)[1] for line in run]
+    if len(set(seeds)) > 1:
+        order = sorted(range(len(run)), key=lambda i: seeds[i])
+        run = [run[i] for i in order]
+    return [line.decode() for line in run]
+
+
 def chroms2ints(data, intkeys):
     """
     Parse .fai to get a dict with {chroms/scaffolds: ints}, or reversed.
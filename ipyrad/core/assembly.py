@@ -314,6 +314,11 @@ class Assembly(object):
             bdf[2] = bdf[2].str.upper()
             self.barcodes = dict(zip(bdf[0], bdf[1] + "+" + bdf[2]))
 
+        # dual i7+i5 indexes are matched to the i7+i5 field of read names
+        elif self.hackersonly.demultiplex_on_i7_tags and bdf.shape[1] == 3:
+            bdf[2] = bdf[2].str.upper()
+            self.barcodes = dict(zip(bdf[0], bdf[1] + "+" + bdf[2]))
+
         # check barcodes sample names
         backup = self.barcodes 
         self.barcodes = {}
@@ -685,9 +690,19 @@ class Assembly(object):
             print("You must enter one or more steps to run, e.g., '123'")
             return 
 
-        # run step fuctions and save and clear memory after each
+        # run step fuctions and save and clear memory after each. Step 1
+        # can also do the work of step 2 when demultiplexing (fused).
+        fused = False
         for step in steps:
-            stepdict[step](self, force, ipyclient).run()
+            if step == "2" and fused:
+                continue
+            if step == "1":
+                fuse = ("2" in steps) and self.hackersonly.fuse_steps_1_2
+                runner = stepdict[step](self, force, ipyclient, fuse)
+                fused = runner.fused
+            else:
+                runner = stepdict[step](self, force, ipyclient)
+            runner.run()
             self.save()
             ipyclient.purge_everything()
 
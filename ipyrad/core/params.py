@@ -40,10 +40,16 @@ class Hackers(object):
             ("query_cov", None),
             ("bwa_args", ""),
             ("demultiplex_on_i7_tags", False),
+            ("demultiplex_streaming", False),
             ("declone_PCR_duplicates", False),
             ("merge_technical_replicates", True),
             ("exclude_reference", True),
             ("trim_loci_min_sites", 4),
+            ("trim_engine", "cutadapt"),
+            ("fuse_steps_1_2", False),
+            ("build_clusters_lowmem", False),
+            ("native_align_max_seqs", 10),
+            ("step6_incremental", False),
         ])
 
     # pretty printing of object
@@ -154,6 +160,13 @@ class Hackers(object):
     def demultiplex_on_i7_tags(self, value):
         self._data["demultiplex_on_i7_tags"] = bool(value)
 
+    @property
+    def demultiplex_streaming(self):
+        return self._data["demultiplex_streaming"]
+    @demultiplex_streaming.setter
+    def demultiplex_streaming(self, value):
+        self._data["demultiplex_streaming"] = bool(value)
+
     @property
     def declone_PCR_duplicates(self):
         return self._data["declone_PCR_duplicates"]
@@ -181,6 +194,44 @@ class Hackers(object):
     @trim_loci_min_sites.setter
     def trim_loci_min_sites(self, value):
         self._data["trim_loci_min_sites"] = int(value)
+
+    @property
+    def trim_engine(self):
+        return self._data["trim_engine"]
+    @trim_engine.setter
+    def trim_engine(self, value):
+        allowed = ("cutadapt", "builtin")
+        assert value in allowed, (
+            "trim_engine must be one of: {}".format(", ".join(allowed)))
+        self._data["trim_engine"] = str(value)
+
+    @property
+    def fuse_steps_1_2(self):
+        return self._data["fuse_steps_1_2"]
+    @fuse_steps_1_2.setter
+    def fuse_steps_1_2(self, value):
+        self._data["fuse_steps_1_2"] = bool(value)
+
+    @property
+    def build_clusters_lowmem(self):
+        return self._data["build_clusters_lowmem"]
+    @build_clusters_lowmem.setter
+    def build_clusters_lowmem(self, value):
+        self._data["build_clusters_lowmem"] = bool(value)
+
+    @property
+    def native_align_max_seqs(self):
+        return self._data["native_align_max_seqs"]
+    @native_align_max_seqs.setter
+    def native_align_max_seqs(self, value):
+        self._data["native_align_max_seqs"] = int(value)
+
+    @property
+    def step6_incremental(self):
+        return self._data["step6_incremental"]
+    @step6_incremental.setter
+    def step6_incremental(self, value):
+        self._data["step6_incremental"] = bool(value)
    
 
 class Params(object):